@@ -0,0 +1,28 @@
+"""
+PandaMania
+Native AIML 2.0 interpreter for the PandaMania meta-cognitive corpus
+"""
+
+__version__ = "2.0.0"
+
+from .aiml import AIMLError, Category, parse_file, parse_string
+from .bot import Bot, Session
+from .brain import Brain, discover_files
+from .graphmaster import Graphmaster, Match
+from .snapshot import SnapshotError, compile_brain, load_brain
+
+__all__ = [
+    "AIMLError",
+    "Bot",
+    "Brain",
+    "Category",
+    "Graphmaster",
+    "Match",
+    "Session",
+    "SnapshotError",
+    "compile_brain",
+    "discover_files",
+    "load_brain",
+    "parse_file",
+    "parse_string",
+]
@@ -0,0 +1,156 @@
+"""
+PandaMania AIML Parser
+Single-pass expat parser turning AIML 2.0 files into categories
+"""
+
+import os
+from xml.parsers import expat
+
+from .normalize import normalize_pattern
+from .template import Node, collapse
+
+
+class AIMLError(Exception):
+    """Raised when an AIML file cannot be parsed"""
+
+
+class Category:
+    """One AIML category with its source location"""
+
+    __slots__ = ("pattern", "that", "topic", "template", "filename", "line")
+
+    def __init__(self, pattern, that, topic, template, filename, line):
+        self.pattern = pattern
+        self.that = that
+        self.topic = topic
+        self.template = template
+        self.filename = filename
+        self.line = line
+
+    @property
+    def path(self):
+        """Full graphmaster path: pattern, <THAT> segment, <TOPIC> segment"""
+        return (list(self.pattern) + ["<THAT>"] + list(self.that)
+                + ["<TOPIC>"] + list(self.topic))
+
+    @property
+    def priority(self):
+        """<template priority="n">: breaks ties between identical paths"""
+        return int(self.template.attrs.get("priority", 0))
+
+    @property
+    def id(self):
+        """Stable identifier: source file and line"""
+        return f"{self.filename}:{self.line}"
+
+    def __repr__(self):
+        return f"<Category {' '.join(self.pattern)!r} {self.id}>"
+
+
+class _Builder:
+    """Expat event handlers building categories and template ASTs"""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.categories = []
+        self.topic_stack = []
+        self.category_line = None
+        self.fields = None
+        self.field = None
+        self.field_depth = 0
+        self.stack = []
+        self.text = []
+
+    def start(self, tag, attrs, line):
+        if self.stack:
+            self._flush()
+            node = Node(tag, attrs)
+            self.stack[-1].children.append(node)
+            self.stack.append(node)
+        elif self.field is not None:
+            # Markup inside <pattern>/<that>/<topic> is not supported; keep text
+            self.field_depth += 1
+        elif tag == "category":
+            self.category_line = line
+            self.fields = {"pattern": [], "that": [], "topic": []}
+        elif self.fields is not None and tag == "template":
+            self.text = []
+            self.stack.append(Node(tag, attrs))
+        elif self.fields is not None and tag in self.fields:
+            self.field = tag
+            self.field_depth = 0
+        elif tag == "topic":
+            self.topic_stack.append(attrs.get("name", "*"))
+
+    def end(self, tag):
+        if self.stack:
+            self._flush()
+            node = self.stack.pop()
+            if not self.stack:
+                self.fields["template"] = node
+        elif self.field is not None:
+            if self.field_depth:
+                self.field_depth -= 1
+            else:
+                self.field = None
+        elif tag == "category":
+            self._finish_category()
+        elif tag == "topic" and self.topic_stack:
+            self.topic_stack.pop()
+
+    def data(self, text):
+        if self.stack:
+            self.text.append(text)
+        elif self.field is not None:
+            self.fields[self.field].append(text)
+
+    def _flush(self):
+        if self.text:
+            text = collapse("".join(self.text))
+            self.text = []
+            if text:
+                self.stack[-1].children.append(text)
+
+    def _finish_category(self):
+        fields = self.fields
+        self.fields = None
+        topic_text = "".join(fields["topic"]) or (
+            self.topic_stack[-1] if self.topic_stack else "*")
+        template = fields.get("template") or Node("template")
+        try:
+            int(template.attrs.get("priority", 0))
+        except ValueError:
+            raise AIMLError(f"{self.filename}:{self.category_line}: priority "
+                            f"must be an integer, not "
+                            f"{template.attrs['priority']!r}") from None
+        self.categories.append(Category(
+            normalize_pattern("".join(fields["pattern"])),
+            normalize_pattern("".join(fields["that"]) or "*"),
+            normalize_pattern(topic_text),
+            template,
+            self.filename,
+            self.category_line,
+        ))
+
+
+def parse_string(data, filename="<string>"):
+    """Parse AIML source (bytes or str) into a list of categories"""
+    builder = _Builder(filename)
+    parser = expat.ParserCreate()
+    parser.buffer_text = True
+    parser.StartElementHandler = lambda tag, attrs: builder.start(
+        tag, attrs, parser.CurrentLineNumber)
+    parser.EndElementHandler = builder.end
+    parser.CharacterDataHandler = builder.data
+    try:
+        parser.Parse(data, True)
+    except expat.ExpatError as e:
+        raise AIMLError(f"{filename}: {e}") from e
+    return builder.categories
+
+
+def parse_file(path):
+    """Parse one AIML file into a list of categories"""
+    with open(path, "rb") as f:
+        data = f.read()
+    return parse_string(data, os.path.basename(path))
@@ -0,0 +1,291 @@
+"""
+PandaMania Call Graph Analysis
+Static <srai> call graph, recursion cycles, worst-case hop bounds and
+categories that can never win a match
+"""
+
+from .compiler import Srai
+from .graphmaster import SEPARATORS, ZERO_OR_MORE
+from .normalize import WILDCARDS, normalize_words
+
+# Stands in for the output of a dynamic element when probing a call target
+PLACEHOLDER = "X"
+UNBOUNDED = float("inf")
+# Runtime hops allowed per input word: this many times the worst finite
+# fan-out, and at least MIN_HOP_BUDGET
+HOP_MARGIN = 4
+MIN_HOP_BUDGET = 16
+
+_UNKNOWN = ["UNKNOWN"]
+# Order Graphmaster._match tries the children of a node in at an input word
+_RANK = {"#": 1, "_": 2, "^": 4, "*": 5}
+
+
+class CallGraph:
+    """<srai> edges between the categories of one brain
+
+    calls[c] lists the categories c's template may <srai> into: the linked
+    target of a static call, or for a call with dynamic parts the category
+    its text matches with each dynamic element replaced by PLACEHOLDER.
+    Calls with no static words at all (<srai><star/></srai>, <sr/>) can
+    reach anything the input spells out; they are listed in open instead.
+
+    depth[c] is the longest chain of hops from c and hops[c] the most
+    categories one sentence answered by c can render in total (every
+    branch of every <condition> and <random> taken), both UNBOUNDED for
+    categories that can reach a cycle. Open calls add at least one hop
+    each on top; how many is bounded only by the input, which each open
+    call consumes at least one word of.
+    """
+
+    def __init__(self, brain):
+        graphmaster = brain.graphmaster
+        self.categories = sorted(graphmaster.categories(),
+                                 key=lambda c: (c.filename, c.line))
+        self.calls = {}
+        self.open = {}
+        for category in self.categories:
+            targets, opened = [], 0
+            for node in category.template.iter():
+                if node.tag == "sr" or (isinstance(node, Srai) and _open(node)):
+                    opened += 1
+                elif isinstance(node, Srai):
+                    target = _target(graphmaster, node)
+                    if target is not None:
+                        targets.append(target)
+            self.calls[category] = targets
+            if opened:
+                self.open[category] = opened
+        self.cycles = _cycles(self.categories, self.calls)
+        cyclic = {category for cycle in self.cycles for category in cycle}
+        self.depth, self.hops = {}, {}
+        for category in self.categories:
+            self._bound(category, cyclic)
+
+    def _bound(self, root, cyclic):
+        """Fill depth and hops for root and everything it calls"""
+        depth, hops, calls = self.depth, self.hops, self.calls
+        stack = [(root, False)]
+        while stack:
+            category, expanded = stack.pop()
+            if category in depth:
+                continue
+            if category in cyclic:
+                depth[category] = hops[category] = UNBOUNDED
+                continue
+            targets = calls[category]
+            if not expanded:
+                stack.append((category, True))
+                stack.extend((t, False) for t in targets if t not in depth)
+                continue
+            depth[category] = max((1 + depth[t] for t in targets), default=0)
+            hops[category] = sum(1 + hops[t] for t in targets)
+
+    def hop_budget(self):
+        """Runtime hops to allow a sentence per input word (plus one)
+
+        Every open call consumes a word and can then take at most the
+        worst finite chain, so this scales that chain by HOP_MARGIN.
+        """
+        finite = [n for n in self.hops.values() if n != UNBOUNDED]
+        return max(MIN_HOP_BUDGET, HOP_MARGIN * (1 + max(finite, default=0)))
+
+    def deepest(self, n):
+        """The n categories with the largest finite hop counts"""
+        ranked = [c for c in self.categories if self.hops[c] != UNBOUNDED]
+        ranked.sort(key=lambda c: (-self.hops[c], -self.depth[c]))
+        return ranked[:n]
+
+    def edges(self):
+        return sum(len(targets) for targets in self.calls.values())
+
+
+def _open(call):
+    """Whether a call's text is made only of dynamic elements"""
+    return not call.words and call.tail is not None and not any(
+        isinstance(child, str) and normalize_words(child) for child in call.tail)
+
+
+def probe_words(call):
+    """A compiled call's text with each dynamic element as PLACEHOLDER"""
+    words = list(call.words)
+    if call.tail is not None:
+        for child in call.tail:
+            if isinstance(child, str):
+                words.extend(normalize_words(child))
+            else:
+                words.append(PLACEHOLDER)
+    return words
+
+
+def _target(graphmaster, call):
+    """Category a compiled call reaches for a typical input, or None"""
+    if call.target is not None:
+        return call.target.category
+    words = probe_words(call)
+    if not words:
+        return None
+    match = graphmaster.match(words, _UNKNOWN, _UNKNOWN)
+    return None if match is None else match.category
+
+
+def _cycles(categories, calls):
+    """Strongly connected groups that recurse (Tarjan, iteratively)"""
+    index, low, on_stack = {}, {}, set()
+    stack, found = [], []
+    for root in categories:
+        if root in index:
+            continue
+        work = [(root, iter(calls[root]))]
+        index[root] = low[root] = len(index)
+        stack.append(root)
+        on_stack.add(root)
+        while work:
+            category, targets = work[-1]
+            for target in targets:
+                if target not in index:
+                    index[target] = low[target] = len(index)
+                    stack.append(target)
+                    on_stack.add(target)
+                    work.append((target, iter(calls[target])))
+                    break
+                if target in on_stack:
+                    low[category] = min(low[category], index[target])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    low[parent] = min(low[parent], low[category])
+                if low[category] == index[category]:
+                    group = []
+                    while True:
+                        member = stack.pop()
+                        on_stack.discard(member)
+                        group.append(member)
+                        if member is category:
+                            break
+                    if len(group) > 1 or category in calls[category]:
+                        found.append(group)
+    return found
+
+
+def _rank(token):
+    if token in _RANK:
+        return _RANK[token]
+    return 0 if token.startswith("$") else 3
+
+
+def _rivals(token):
+    """Trie siblings of token tried before it that could accept its input
+
+    An exact word only ever accepts itself, so of the words just the
+    $-priority spelling of token itself qualifies.
+    """
+    if token in SEPARATORS:
+        # Only a zero-width # is tried ahead of the segment separator
+        return ("#",)
+    rank = _rank(token)
+    rivals = [wildcard for wildcard in _RANK if _RANK[wildcard] < rank]
+    if rank == 3:
+        rivals.insert(0, "$" + token)
+    return rivals
+
+
+def _least(token):
+    """Fewest input words a path token consumes"""
+    if token in WILDCARDS:
+        return 0 if token in ZERO_OR_MORE else 1
+    return 1
+
+
+def _same_word(token, other):
+    return (token not in WILDCARDS and other not in WILDCARDS
+            and token.lstrip("$") == other.lstrip("$")
+            and (token in SEPARATORS) == (other in SEPARATORS))
+
+
+def _cover(node, tokens, j, memo):
+    """A category under node whose path accepts every input tokens[j:] does"""
+    key = (id(node), j)
+    if key in memo:
+        return memo[key]
+    memo[key] = None
+    found = None
+    if j == len(tokens):
+        found = node.category
+        for wildcard in ZERO_OR_MORE:
+            child = node.children.get(wildcard)
+            if found is None and child is not None:
+                found = child.category
+    else:
+        for token, child in node.children.items():
+            found = _cover_child(token, child, tokens, j, memo)
+            if found is not None:
+                break
+    memo[key] = found
+    return found
+
+
+def _cover_child(token, child, tokens, j, memo):
+    """_cover for a path continuing with token and then child's subtree"""
+    if token not in WILDCARDS:
+        if _same_word(token, tokens[j]):
+            return _cover(child, tokens, j + 1, memo)
+        return None
+    # A wildcard can absorb any run of the segment that always spans at
+    # least as many words as it needs
+    need, least = _least(token), 0
+    for end in range(j, len(tokens) + 1):
+        if end > j:
+            if tokens[end - 1] in SEPARATORS:
+                break
+            least += _least(tokens[end - 1])
+        if least >= need:
+            found = _cover(child, tokens, end, memo)
+            if found is not None:
+                return found
+    return None
+
+
+def outranked_by(graphmaster, path):
+    """A category the graphmaster always picks over one at path, or None
+
+    That is a category tried first where the two paths diverge whose
+    remaining path accepts every input the rest of path does.
+    """
+    node, memo = graphmaster.root, {}
+    for k, token in enumerate(path):
+        children = node.children
+        for rival in _rivals(token):
+            child = children.get(rival)
+            if child is not None:
+                best = _cover_child(rival, child, path, k, memo)
+                if best is not None:
+                    return best
+        node = children.get(token)
+        if node is None:
+            return None
+    return None
+
+
+def unreachable(brain):
+    """(category, winner, reason) for every category that can never answer
+
+    "shadowed" categories share their whole path with the winner (see
+    Brain.shadowed). An "outranked" category diverges from the winner's
+    path at a token the graphmaster tries later (an exact word after "_",
+    say), where the winner's remaining path accepts every input the
+    category's does, so the depth-first match never backtracks to it.
+    This is a proof for the categories listed, not a search for every
+    unreachable one: each must be outranked by a single other category
+    (see outranked_by).
+    """
+    found = [(category, best, "shadowed")
+             for category, best in brain.shadowed()]
+    graphmaster = brain.graphmaster
+    for category in graphmaster.categories():
+        best = outranked_by(graphmaster, category.path)
+        if best is not None:
+            found.append((category, best, "outranked"))
+    found.sort(key=lambda item: (item[0].filename, item[0].line))
+    return found
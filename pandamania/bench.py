@@ -0,0 +1,181 @@
+"""
+PandaMania Benchmarks
+Reproducible latency and throughput measurements over the real corpus
+"""
+
+import json
+import platform
+import time
+from datetime import datetime, timezone
+
+from . import __version__, snapshot
+from .bot import Bot
+from .brain import Brain
+from .graphmaster import Graphmaster
+from .predicates import DEFAULT_PREDICATE
+
+BENCH_FILE = "bench.json"
+DEFAULT_SAMPLES = 2000
+DEFAULT_LOADS = 5
+# Templates with at least this many <set>/<get> count as predicate-heavy
+HEAVY_PREDICATES = 8
+
+_UNKNOWN = [DEFAULT_PREDICATE.upper()]
+
+
+def _literal(category):
+    return not any(word in ("*", "#", "_", "^") or word[0] == "$"
+                   for word in category.pattern)
+
+
+def workloads(brain):
+    """Deterministic benchmark inputs per case, picked from the corpus
+
+    Every literal pattern is answered once; it belongs to srai_<n>hop by
+    the number of <srai> hops it takes, and to predicate_heavy or condition
+    when its own template has those traits.
+    """
+    bot = Bot(brain, cache_size=0)
+    cases = {"direct_match": [], "srai_1hop": [], "srai_2hop": [],
+             "srai_3hop": [], "predicate_heavy": [], "condition": []}
+    for category in sorted(brain.graphmaster.categories(),
+                           key=lambda c: (c.filename, c.line)):
+        if not _literal(category) or category.that != ["*"]:
+            continue
+        text = " ".join(category.pattern)
+        trace = []
+        bot.respond(text, "bench", trace)
+        if not trace or trace[0] is not category:
+            continue
+        hops = len(trace) - 1
+        if hops == 0:
+            cases["direct_match"].append(text)
+        elif hops <= 3:
+            cases[f"srai_{hops}hop"].append(text)
+        tags = [node.tag for node in category.template.iter()]
+        if tags.count("set") + tags.count("get") >= HEAVY_PREDICATES:
+            cases["predicate_heavy"].append(text)
+        if "condition" in tags:
+            cases["condition"].append(text)
+    return cases
+
+
+def summarize(samples_ns):
+    """p50/p99/mean latency in microseconds and throughput in ops/s"""
+    ordered = sorted(samples_ns)
+    n = len(ordered)
+    total = sum(ordered)
+    return {
+        "samples": n,
+        "p50_us": round(ordered[n // 2] / 1000, 2),
+        "p99_us": round(ordered[min(n - 1, n * 99 // 100)] / 1000, 2),
+        "mean_us": round(total / n / 1000, 2),
+        "ops_per_sec": round(n / (total / 1e9)) if total else 0,
+    }
+
+
+def _measure(operation, inputs, samples):
+    """Time operation(input) over inputs round-robin, after one warm-up pass"""
+    if not inputs:
+        raise ValueError("nothing to measure: no benchmark inputs")
+    for item in inputs:
+        operation(item)
+    clock = time.perf_counter_ns
+    timings = []
+    while len(timings) < samples:
+        for item in inputs:
+            start = clock()
+            operation(item)
+            timings.append(clock() - start)
+    return timings
+
+
+def run(directory, samples=DEFAULT_SAMPLES, loads=DEFAULT_LOADS):
+    """Run every benchmark case and return the JSON-ready results"""
+    timings = []
+    for _ in range(loads):
+        start = time.perf_counter_ns()
+        brain = Brain.load(directory)
+        timings.append(time.perf_counter_ns() - start)
+    results = {"cold_load": summarize(timings)}
+
+    data = snapshot.dumps(brain, b"\0" * 32)
+    results["snapshot_load"] = summarize(
+        _measure(lambda _: snapshot.loads(data), [None], loads))
+
+    categories = [c for source in brain.sources.values() for c in source]
+
+    def build(_):
+        graphmaster = Graphmaster()
+        for category in categories:
+            graphmaster.add(category)
+    results["trie_build"] = summarize(_measure(build, [None], loads))
+
+    cases = workloads(brain)
+    words = [text.split() for text in cases["direct_match"]]
+    if words:
+        results["direct_match"] = summarize(_measure(
+            lambda w: brain.match(w, _UNKNOWN, _UNKNOWN), words, samples))
+    # End-to-end turns without the response cache, one session per case
+    for case in ("srai_1hop", "srai_2hop", "srai_3hop", "predicate_heavy",
+                 "condition"):
+        if not cases[case]:
+            continue
+        bot = Bot(brain, cache_size=0)
+        results[case] = summarize(_measure(
+            lambda text: bot.respond(text, case), cases[case], samples))
+    for case, inputs in cases.items():
+        if case in results:
+            results[case]["inputs"] = len(inputs)
+
+    return {
+        "pandamania": __version__,
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "created": datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"),
+        "corpus": {
+            "digest": snapshot.corpus_digest(directory).hex(),
+            "files": len(brain.files),
+            "categories": brain.size,
+        },
+        "results": results,
+    }
+
+
+def save(report, path):
+    """Write a report as stable, diff-friendly JSON"""
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+        f.write("\n")
+
+
+def properties(path):
+    """Bot properties (bench_<case>_p50 ...) from a saved report, if any"""
+    try:
+        with open(path, encoding="utf-8") as f:
+            report = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    values = {"bench_date": report.get("created", DEFAULT_PREDICATE),
+              "bench_categories": str(report.get("corpus", {}).get(
+                  "categories", DEFAULT_PREDICATE))}
+    for case, result in report.get("results", {}).items():
+        values[f"bench_{case}_p50"] = _duration(result["p50_us"])
+        values[f"bench_{case}_p99"] = _duration(result["p99_us"])
+        values[f"bench_{case}_ops"] = f"{result['ops_per_sec']:,}/s"
+    return values
+
+
+def _duration(us):
+    return f"{us / 1000:.1f}ms" if us >= 1000 else f"{us:.1f}us"
+
+
+def report_lines(report):
+    """Human-readable summary table"""
+    lines = [f"{'case':<16} {'p50':>10} {'p99':>10} {'ops/s':>12}"]
+    for case, result in report["results"].items():
+        lines.append(f"{case:<16} {_duration(result['p50_us']):>10} "
+                     f"{_duration(result['p99_us']):>10} "
+                     f"{result['ops_per_sec']:>12,}")
+    return lines
+
@@ -0,0 +1,768 @@
+"""
+PandaMania Bot
+AIML 2.0 template interpreter and per-session conversation state
+"""
+
+import random
+import time
+from collections import OrderedDict, deque
+
+from .analysis import CallGraph
+from .compiler import Srai
+from .generation import DEFAULT_KIND, category_xml
+from .graphmaster import Match
+from .inference import DEFAULT_INFERENCE_LIMIT, KnowledgeBase, Rule
+from .normalize import normalize_words, split_sentences
+from .predicates import DEFAULT_DYNAMIC_LIMIT, DEFAULT_PREDICATE, SlotStore
+from .telemetry import LIVE_PREFIX, Telemetry, turn_record
+from .template import Node, tidy
+
+DEFAULT_SESSION = "default"
+MAX_SRAI_DEPTH = 32
+DEFAULT_CACHE_SIZE = 4096
+# Input sentences and responses each session remembers
+DEFAULT_HISTORY = 32
+
+
+def _response(sentences):
+    """History entry for a response split into sentences"""
+    sentences = tuple(sentences)
+    return sentences, normalize_words(sentences[-1]) if sentences else []
+
+
+class Session:
+    """Predicates, knowledge base triples and history for one user
+
+    inputs and responses are ring buffers of the last history entries.
+    A response is kept split into sentences, with the normalized words of
+    its last one, so <that> costs an index and no re-splitting.
+    """
+
+    def __init__(self, session_id, predicates, kb=None, history=DEFAULT_HISTORY):
+        self.id = session_id
+        self.predicates = predicates
+        self.kb = KnowledgeBase() if kb is None else kb
+        self.inputs = deque(maxlen=history)
+        # (sentences, words of the last sentence) per response
+        self.responses = deque(maxlen=history)
+        # time.monotonic() of the last turn, for Bot.session_ttl
+        self.used = 0.0
+
+    def snapshot(self):
+        """JSON-ready predicates and history (the kb persists on its own)"""
+        return {"predicates": dict(self.predicates.items()),
+                "inputs": list(self.inputs),
+                "responses": [sentences for sentences, _ in self.responses]}
+
+    def restore(self, state):
+        """Take back the predicates and history of a snapshot"""
+        self.predicates.update(state["predicates"])
+        self.inputs.extend(state["inputs"])
+        self.responses.extend(_response(sentences)
+                              for sentences in state["responses"])
+
+    def remember(self, reply):
+        """Add a response to the history, split and normalized once"""
+        self.responses.append(_response(split_sentences(reply)))
+
+    def get(self, name):
+        """Return a predicate value, or the AIML default when unset"""
+        return self.predicates.get(name, DEFAULT_PREDICATE)
+
+    def set(self, name, value):
+        """Set a predicate value"""
+        self.predicates.set(name, value)
+
+    def that(self, index=1, sentence=1):
+        """Return a sentence of a previous response (1,1 is the latest)"""
+        if index > len(self.responses):
+            return DEFAULT_PREDICATE
+        sentences = self.responses[-index][0]
+        if sentence > len(sentences):
+            return DEFAULT_PREDICATE
+        return sentences[-sentence]
+
+    def that_words(self):
+        """Normalized words of the latest response's last sentence"""
+        return self.responses[-1][1] if self.responses else []
+
+    def input(self, index=1):
+        """Return a previous input sentence (1 is the current one)"""
+        if index > len(self.inputs):
+            return DEFAULT_PREDICATE
+        return self.inputs[-index]
+
+    def topic_words(self):
+        """Normalized words of the current topic"""
+        return normalize_words(self.get("topic")) or [DEFAULT_PREDICATE.upper()]
+
+
+class _Context:
+    """Evaluation state for one matched category"""
+
+    __slots__ = ("session", "match", "depth", "that", "vars", "presolved")
+
+    def __init__(self, session, match, depth, that, variables, presolved=None):
+        self.session = session
+        self.match = match
+        self.depth = depth
+        self.that = that
+        self.vars = variables
+        # id(Srai node) -> callable producing its result (conjunctions)
+        self.presolved = presolved
+
+
+def _index(value, default=1):
+    try:
+        return max(1, int(value))
+    except (TypeError, ValueError):
+        return default
+
+
+def _clauses(stars, word):
+    """Split a "* WORD *" match at every WORD with words on both sides"""
+    clauses = [stars[0]]
+    current = []
+    for token in stars[1].split():
+        if token == word and current:
+            clauses.append(" ".join(current))
+            current = []
+        else:
+            current.append(token)
+    if current:
+        clauses.append(" ".join(current))
+    else:
+        # A trailing WORD belongs to the last clause, as * would take it
+        clauses[-1] += f" {word}"
+    return clauses
+
+
+def _matches(actual, expected):
+    """Compare a predicate against a <condition> value"""
+    expected = expected.strip()
+    if expected == "*":
+        return actual != DEFAULT_PREDICATE
+    if expected[:1] in "<>" and len(expected) > 1:
+        try:
+            number, bound = float(actual), float(expected[1:])
+        except ValueError:
+            return False
+        return number > bound if expected[0] == ">" else number < bound
+    return normalize_words(actual) == normalize_words(expected)
+
+
+class Bot:
+    """Conversational front end over a shared, read-only Brain
+
+    store is the predicate backend class (see predicates.BACKENDS) and
+    predicate_limit caps the undeclared predicates each session may hold.
+
+    max_clauses turns on conjunction splitting: an input matched by a
+    "* AND *" category (see compiler.find_conjunctions) is split once at
+    every AND instead of being re-matched half by half. Inputs with more
+    than max_clauses clauses are re-matched half by half as usual.
+
+    cache_size bounds the LRU of responses to sentences that rendered only
+    pure categories (see compiler.PURE_TAGS); a hit replays the recorded
+    predicate writes instead of matching and rendering. 0 disables it.
+
+    telemetry keeps per-category counters (see telemetry.Telemetry) that
+    templates read as <bot name="live_..."/> properties; with a trace log
+    open, sampled sentences are also written out with per-hop timing.
+
+    inference_limit caps the facts each session's knowledge base may derive
+    (see inference.KnowledgeBase).
+
+    storage (a storage.Storage) makes knowledge bases durable: sessions
+    reload their stated facts and rules by id, writes are committed once
+    per turn, and the shared graph of imported domain knowledge is loaded
+    once as the base every session's knowledge base sits on.
+
+    max_sessions and session_ttl (seconds idle) bound the sessions held in
+    memory: the least recently used beyond either is evicted, saved to
+    storage if there is one, and rehydrated lazily on its next turn.
+    Without storage an evicted session starts over.
+
+    history_size bounds the inputs and responses each session remembers
+    for <input>, <that> and that-pattern matching.
+
+    hop_budget caps the categories one sentence may render at hop_budget
+    per input word (plus one); None derives it from the brain's static
+    call graph (see analysis.CallGraph.hop_budget). turn_budget, off by
+    default, also caps the seconds a turn may spend; being wall-clock time
+    it makes replies depend on machine load. Past either, remaining <srai>
+    hops render empty and the cut-short reply is not cached.
+
+    patterns (a generation.PatternGenerator) backs the pattern generation
+    tags, which queue and list candidates for review. No tag approves
+    one: that is left to the operator (`pandamania patterns approve`).
+    """
+
+    def __init__(self, brain, store=SlotStore,
+                 predicate_limit=DEFAULT_DYNAMIC_LIMIT, max_clauses=None,
+                 cache_size=DEFAULT_CACHE_SIZE, telemetry=True,
+                 inference_limit=DEFAULT_INFERENCE_LIMIT, storage=None,
+                 max_sessions=None, session_ttl=None,
+                 history_size=DEFAULT_HISTORY, hop_budget=None,
+                 turn_budget=None, patterns=None):
+        self.brain = brain
+        # Least recently used first
+        self.sessions = OrderedDict()
+        self.max_sessions = max_sessions
+        self.session_ttl = session_ttl
+        self.session_evictions = 0
+        self.history_size = history_size
+        self.hop_budget = hop_budget
+        self.turn_budget = turn_budget
+        self.budget_exhausted = 0
+        self._derived_budget = None
+        self._budget_generation = None
+        self._hops_left = float("inf")
+        self._deadline = float("inf")
+        self._over = False
+        self.store = store
+        self.predicate_limit = predicate_limit
+        self.max_clauses = max_clauses
+        self.inference_limit = inference_limit
+        self.storage = storage
+        self.patterns = patterns
+        self.knowledge = None if storage is None else storage.knowledge()
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.cache_hits = self.cache_misses = 0
+        self._cache_generation = None
+        self.telemetry = Telemetry() if telemetry else None
+        self._trace = None
+        self._writes = None
+        self._match_ns = 0
+        self._hops = None
+        self._handlers = {
+            "think": self._think,
+            "star": self._star,
+            "thatstar": self._star,
+            "topicstar": self._star,
+            "set": self._set,
+            "get": self._get,
+            "srai": self._srai,
+            "sr": self._sr,
+            "condition": self._condition,
+            "random": self._random,
+            "map": self._map,
+            "date": self._date,
+            "br": self._br,
+            "that": self._that,
+            "input": self._input,
+            "bot": self._bot,
+            "uppercase": self._uppercase,
+            "lowercase": self._lowercase,
+            "formal": self._formal,
+            "id": self._id,
+            "size": self._size,
+            "addtriple": self._addtriple,
+            "deletetriple": self._deletetriple,
+            "uniq": self._uniq,
+            "triplecount": self._triplecount,
+            "addrule": self._addrule,
+            "generatepattern": self._generatepattern,
+            "reviewpattern": self._reviewpattern,
+            "pendingpatterns": self._pendingpatterns,
+            "patterncount": self._patterncount,
+        }
+
+    def session(self, session_id=DEFAULT_SESSION):
+        """Return the session for an id, rehydrating or creating it if needed"""
+        sessions = self.sessions
+        session = sessions.get(session_id)
+        if session is None:
+            session = sessions[session_id] = self._open(session_id)
+        else:
+            sessions.move_to_end(session_id)
+        session.used = time.monotonic()
+        if self.max_sessions is not None or self.session_ttl is not None:
+            self._evict(session.used)
+        return session
+
+    def has_session(self, session_id):
+        """Whether an id is in use, in memory or saved"""
+        return session_id in self.sessions or (
+            self.storage is not None and self.storage.has_session(session_id))
+
+    def _open(self, session_id):
+        kb = KnowledgeBase(limit=self.inference_limit, base=self.knowledge)
+        session = Session(session_id, self.store(self.brain.schema,
+                                                 self.predicate_limit),
+                          kb, self.history_size)
+        storage = self.storage
+        if storage is not None:
+            state = storage.load_session(session_id)
+            if state is not None:
+                session.restore(state)
+            kb.load(storage.facts(session_id), storage.rules(session_id))
+        return session
+
+    def _evict(self, now):
+        """Let go of sessions beyond max_sessions or idle past session_ttl"""
+        sessions, limit, ttl = self.sessions, self.max_sessions, self.session_ttl
+        while sessions:
+            oldest = next(iter(sessions.values()))
+            if not ((limit is not None and len(sessions) > limit)
+                    or (ttl is not None and now - oldest.used > ttl)):
+                return
+            del sessions[oldest.id]
+            self.session_evictions += 1
+            if self.storage is not None:
+                self.storage.save_session(oldest.id, oldest.snapshot())
+
+    def close(self):
+        """Save every session held in memory and close the storage
+
+        Hits counted since the last close go to the coverage log, if any.
+        """
+        if self.telemetry is not None:
+            self.telemetry.write_coverage()
+        if self.storage is None:
+            return
+        for session in self.sessions.values():
+            self.storage.save_session(session.id, session.snapshot())
+        self.storage.close()
+
+    def rename_session(self, old_id, new_id):
+        """Move a session to a new id (e.g. the one SESSION INIT assigned)"""
+        session = self.sessions.pop(old_id)
+        session.id = new_id
+        self.sessions[new_id] = session
+        if self.storage is not None:
+            self.storage.rename(old_id, new_id)
+        return session
+
+    def respond(self, text, session_id=DEFAULT_SESSION, trace=None):
+        """Answer one user turn, sentence by sentence
+
+        If trace is a list, every category rendered for the turn (the
+        top-level match first, then each <srai> hop) is appended to it.
+        """
+        session = self.session(session_id)
+        replies = []
+        self._trace = trace
+        telemetry = self.telemetry
+        if telemetry is not None:
+            telemetry.turns += 1
+        budget = self.current_hop_budget()
+        if self.turn_budget is not None:
+            self._deadline = time.perf_counter_ns() + self.turn_budget * 1e9
+        try:
+            for sentence in split_sentences(text):
+                self._hops_left = budget * (1 + len(sentence.split()))
+                self._over = False
+                session.inputs.append(sentence)
+                that = session.that_words() or [DEFAULT_PREDICATE.upper()]
+                if telemetry is None:
+                    reply = self._answer(sentence, session, that)
+                else:
+                    reply = self._measured(sentence, session, that, telemetry)
+                session.remember(reply)
+                if reply:
+                    replies.append(reply)
+                if self._over:
+                    self.budget_exhausted += 1
+        finally:
+            self._trace = None
+            self._hops_left = self._deadline = float("inf")
+        if self.storage is not None:
+            self.storage.flush()
+        return " ".join(replies)
+
+    def current_hop_budget(self):
+        """hop_budget, or the one derived from the current brain"""
+        if self.hop_budget is not None:
+            return self.hop_budget
+        if self._budget_generation != self.brain.generation:
+            self._derived_budget = CallGraph(self.brain).hop_budget()
+            self._budget_generation = self.brain.generation
+        return self._derived_budget
+
+    def _measured(self, sentence, session, that, telemetry):
+        """_answer, recording the rendered chain and its timing"""
+        hops = [] if telemetry.sampled() else None
+        outer, self._trace, self._match_ns, self._hops = self._trace, [], 0, hops
+        hits = self.cache_hits
+        start = time.perf_counter_ns()
+        try:
+            reply = self._answer(sentence, session, that)
+        finally:
+            chain, self._trace, self._hops = self._trace, outer, None
+        elapsed = time.perf_counter_ns() - start
+        telemetry.record(chain, elapsed, self._match_ns)
+        if hops is not None:
+            telemetry.write_trace(turn_record(
+                session, sentence, reply, chain, hops, start, elapsed,
+                self._match_ns, self.cache_hits != hits))
+        if outer is not None:
+            outer.extend(chain)
+        return reply
+
+    def _match(self, words, that, topic, start=None):
+        """Graphmaster match, timed when telemetry is on"""
+        if self.telemetry is None:
+            return self.brain.graphmaster.match(words, that, topic, start)
+        clock = time.perf_counter_ns()
+        try:
+            return self.brain.graphmaster.match(words, that, topic, start)
+        finally:
+            self._match_ns += time.perf_counter_ns() - clock
+
+    def _answer(self, sentence, session, that):
+        """Answer one top-level sentence, through the pure response cache"""
+        if not self.cache_size:
+            return self._respond(sentence, session, 0, that)
+        brain = self.brain
+        if self._cache_generation != brain.generation:
+            self.cache.clear()
+            self._cache_generation = brain.generation
+        key = (tuple(normalize_words(sentence)), tuple(session.topic_words()),
+               tuple(that) if brain.that_patterns else None)
+        entry = self.cache.get(key)
+        if entry is not None:
+            self.cache.move_to_end(key)
+            self.cache_hits += 1
+            reply, chain, writes = entry
+            for name, value in writes:
+                session.set(name, value)
+            if self._trace is not None:
+                self._trace.extend(chain)
+            return reply
+        self.cache_misses += 1
+        outer, self._trace, self._writes = self._trace, [], []
+        try:
+            reply = self._respond(sentence, session, 0, that)
+        finally:
+            chain, writes = self._trace, self._writes
+            self._trace, self._writes = outer, None
+        if outer is not None:
+            outer.extend(chain)
+        if not self._over and all(category in brain.pure for category in chain):
+            self.cache[key] = (reply, tuple(chain), tuple(writes))
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return reply
+
+    def _respond(self, text, session, depth, that):
+        if depth > MAX_SRAI_DEPTH:
+            return ""
+        words = normalize_words(text)
+        if not words:
+            return ""
+        # Strip leading fillers whose category would only <srai> the rest;
+        # each one still counts as a hop (see compiler.fold_fillers)
+        fillers = self.brain.fillers
+        start = 0
+        while start < len(words) - 1 and words[start] in fillers:
+            if self._trace is not None and depth + start <= MAX_SRAI_DEPTH:
+                self._trace.append(fillers[words[start]])
+            start += 1
+        if start:
+            words = words[start:]
+            depth += start
+            if depth > MAX_SRAI_DEPTH:
+                return ""
+            self._hops_left -= start
+            if self._hops_left < 0:
+                self._over = True
+                return ""
+        return self._call(self._match(words, that, session.topic_words()),
+                          session, depth, that)
+
+    def _call(self, match, session, depth, that):
+        """Render the template of a matched category"""
+        if match is None or depth > MAX_SRAI_DEPTH:
+            return ""
+        self._hops_left -= 1
+        if self._hops_left < 0 or time.perf_counter_ns() > self._deadline:
+            self._over = True
+            return ""
+        if self.max_clauses and match.category in self.brain.conjunctions:
+            clauses = _clauses(match.stars,
+                               self.brain.conjunctions[match.category][0])
+            if len(clauses) <= self.max_clauses:
+                return self._conjunction(match.category, clauses, 0, session,
+                                         depth, that)
+        if self._trace is not None:
+            self._trace.append(match.category)
+        context = _Context(session, match, depth, that, {})
+        if self._hops is None:
+            return tidy(self._render(match.category.template.children, context))
+        hop = [len(self._trace) - 1, time.perf_counter_ns()]
+        self._hops.append(hop)
+        reply = tidy(self._render(match.category.template.children, context))
+        hop.append(time.perf_counter_ns())
+        return reply
+
+    def _conjunction(self, category, clauses, k, session, depth, that):
+        """Render a conjunction over pre-split clauses
+
+        Each level's rest <srai> goes straight to the next clause, so N
+        clauses cost N clause matches. Clauses run in order against the
+        evolving session state: a clause sees the predicates earlier clauses
+        wrote. Each clause is matched on its own, so a category that would
+        have matched a whole "rest" half (a longer pattern, or a <that>
+        one) never sees it.
+        """
+        if k == len(clauses) - 1:
+            return self._respond(clauses[k], session, depth, that)
+        if depth > MAX_SRAI_DEPTH:
+            return ""
+        if self._trace is not None:
+            self._trace.append(category)
+        _, first, rest = self.brain.conjunctions[category]
+        presolved = {
+            id(first): lambda: self._respond(clauses[k], session, depth + 1,
+                                             that),
+            id(rest): lambda: self._conjunction(category, clauses, k + 1,
+                                                session, depth + 1, that),
+        }
+        context = _Context(session, Match(category, [clauses[k]], [], []),
+                           depth, that, {}, presolved)
+        return tidy(self._render(category.template.children, context))
+
+    def _render(self, children, context, skip=()):
+        parts = []
+        for child in children:
+            if isinstance(child, str):
+                parts.append(child)
+            elif child.tag not in skip:
+                parts.append(self._eval(child, context))
+        return "".join(parts)
+
+    def _eval(self, node, context):
+        handler = self._handlers.get(node.tag)
+        if handler is None:
+            return self._render(node.children, context)
+        return handler(node, context)
+
+    def _attr(self, node, key, context):
+        """Read an attribute given either as XML attribute or child element"""
+        if key in node.attrs:
+            return node.attrs[key]
+        child = node.find(key)
+        if child is not None:
+            return self._render(child.children, context).strip()
+        return None
+
+    def _think(self, node, context):
+        self._render(node.children, context)
+        return ""
+
+    def _star(self, node, context):
+        stars = {
+            "star": context.match.stars,
+            "thatstar": context.match.thatstars,
+            "topicstar": context.match.topicstars,
+        }[node.tag]
+        index = _index(node.attrs.get("index"))
+        return stars[index - 1] if index <= len(stars) else ""
+
+    def _set(self, node, context):
+        value = self._render(node.children, context, ("name",)).strip()
+        var = node.attrs.get("var")
+        if var is not None:
+            context.vars[var] = value
+            return value
+        name = self._attr(node, "name", context)
+        if name:
+            context.session.set(name, value)
+            if self._writes is not None:
+                self._writes.append((name, value))
+        return value
+
+    def _get(self, node, context):
+        var = node.attrs.get("var")
+        if var is not None:
+            return context.vars.get(var, DEFAULT_PREDICATE)
+        name = self._attr(node, "name", context)
+        return context.session.get(name) if name else DEFAULT_PREDICATE
+
+    def _srai(self, node, context):
+        if context.presolved is not None and id(node) in context.presolved:
+            return context.presolved[id(node)]()
+        session, depth = context.session, context.depth + 1
+        if isinstance(node, Srai):
+            # One read: a concurrent relink replaces the whole tuple
+            start, target, guard = node.link
+            if target is not None:
+                if tuple(session.topic_words()) not in guard:
+                    return self._call(target, session, depth, context.that)
+            elif start is not None:
+                tail = normalize_words(self._render(node.tail, context))
+                match = self._match(tail, context.that, session.topic_words(),
+                                    start)
+                if match is None:
+                    match = self._match(list(node.words) + tail, context.that,
+                                        session.topic_words())
+                return self._call(match, session, depth, context.that)
+        # Uncompiled, unlinked or guarded calls match their text from the root
+        text = self._render(node.children, context)
+        return self._respond(text, session, depth, context.that)
+
+    def _sr(self, node, context):
+        stars = context.match.stars
+        return self._respond(stars[0] if stars else "", context.session,
+                             context.depth + 1, context.that)
+
+    def _condition(self, node, context):
+        name = self._attr(node, "name", context)
+        value = self._attr(node, "value", context)
+        if name is not None and value is not None:
+            if _matches(context.session.get(name), value):
+                return self._render(node.children, context, ("name", "value"))
+            return ""
+        for li in node.children:
+            if not isinstance(li, Node) or li.tag != "li":
+                continue
+            li_name = self._attr(li, "name", context) or name
+            li_value = self._attr(li, "value", context)
+            if li_value is None or (
+                    li_name and _matches(context.session.get(li_name), li_value)):
+                return self._render(li.children, context, ("name", "value"))
+        return ""
+
+    def _random(self, node, context):
+        items = [li for li in node.children
+                 if isinstance(li, Node) and li.tag == "li"]
+        if not items:
+            return ""
+        return self._render(random.choice(items).children, context)
+
+    def _map(self, node, context):
+        name = self._attr(node, "name", context)
+        key = self._render(node.children, context, ("name",)).strip()
+        table = self.brain.maps.get(name)
+        if table is None:
+            return DEFAULT_PREDICATE
+        return str(table.get(key, DEFAULT_PREDICATE))
+
+    def _date(self, node, context):
+        fmt = node.attrs.get("format", "%c")
+        now = time.time()
+        return time.strftime(fmt.replace("%s", str(int(now))),
+                             time.localtime(now))
+
+    def _br(self, node, context):
+        return "\n"
+
+    def _that(self, node, context):
+        parts = node.attrs.get("index", "1,1").split(",")
+        index = _index(parts[0])
+        sentence = _index(parts[1]) if len(parts) > 1 else 1
+        return context.session.that(index, sentence)
+
+    def _input(self, node, context):
+        return context.session.input(_index(node.attrs.get("index")))
+
+    def _bot(self, node, context):
+        name = self._attr(node, "name", context)
+        if self.telemetry is not None and name and name.startswith(LIVE_PREFIX):
+            value = self.telemetry.property(self, name)
+            if value is not None:
+                return value
+        return self.brain.properties.get(name, DEFAULT_PREDICATE)
+
+    def _uppercase(self, node, context):
+        return self._render(node.children, context).upper()
+
+    def _lowercase(self, node, context):
+        return self._render(node.children, context).lower()
+
+    def _formal(self, node, context):
+        return self._render(node.children, context).title()
+
+    def _id(self, node, context):
+        return context.session.id
+
+    def _size(self, node, context):
+        return str(self.brain.size)
+
+    def _terms(self, node, context):
+        return [self._attr(node, key, context) for key in ("subj", "pred", "obj")]
+
+    def _inferred(self, node):
+        """inferred="true"/"false" filter of <uniq> and <triplecount>"""
+        value = node.attrs.get("inferred")
+        return None if value is None else value.strip().lower() == "true"
+
+    def _addtriple(self, node, context):
+        kb, terms = context.session.kb, self._terms(node, context)
+        if kb.tell(*terms) and self.storage is not None:
+            self.storage.add(context.session.id, kb.stated(*terms))
+        return ""
+
+    def _deletetriple(self, node, context):
+        kb, terms = context.session.kb, self._terms(node, context)
+        if kb.retract(*terms) and self.storage is not None:
+            self.storage.remove(context.session.id, kb.stated(*terms))
+        return ""
+
+    def _uniq(self, node, context):
+        """Distinct values of the "?" term (else the object), comma-separated"""
+        terms = self._terms(node, context)
+        slot = next((i for i, term in enumerate(terms)
+                     if term and term.startswith("?")), 2)
+        bound = [None if not term or term.startswith("?") else term
+                 for term in terms]
+        values = context.session.kb.values(*bound, slot=slot,
+                                           inferred=self._inferred(node))
+        return ", ".join(values) if values else DEFAULT_PREDICATE
+
+    def _triplecount(self, node, context):
+        terms = [None if not term or term.startswith("?") else term
+                 for term in self._terms(node, context)]
+        return str(context.session.kb.count(*terms,
+                                            inferred=self._inferred(node)))
+
+    def _addrule(self, node, context):
+        """Declare body="p1 [p2]" head="p3" for this session's knowledge base"""
+        body = (self._attr(node, "body", context) or "").split()
+        try:
+            rule = Rule(body, self._attr(node, "head", context))
+        except ValueError:
+            return ""
+        if context.session.kb.add_rule(rule) and self.storage is not None:
+            self.storage.add_rule(context.session.id, rule)
+        return ""
+
+    def _generatepattern(self, node, context):
+        """Queue a candidate from kind="..." and its <term>s (else the text)
+
+        Renders the candidate's id, or why it was not generated.
+        """
+        if self.patterns is None:
+            return DEFAULT_PREDICATE
+        kind = (self._attr(node, "kind", context) or DEFAULT_KIND).lower()
+        terms = [self._render(child.children, context).strip()
+                 for child in node.children
+                 if isinstance(child, Node) and child.tag == "term"]
+        if not terms:
+            terms = [self._render(node.children, context, ("kind",)).strip()]
+        candidate, reason = self.patterns.generate(self.brain, kind, terms)
+        return candidate["id"] if candidate else reason
+
+    def _reviewpattern(self, node, context):
+        """A pending candidate's category as AIML source"""
+        if self.patterns is None:
+            return DEFAULT_PREDICATE
+        candidate = self.patterns.find(self._render(node.children, context))
+        if candidate is None:
+            return DEFAULT_PREDICATE
+        return category_xml(candidate).strip()
+
+    def _pendingpatterns(self, node, context):
+        """Pending candidates as "ID: PATTERN", semicolon-separated"""
+        pending = [] if self.patterns is None else self.patterns.pending()
+        return "; ".join(f"{c['id']}: {c['pattern']}" for c in pending) \
+            or "none"
+
+    def _patterncount(self, node, context):
+        """status="generated|pending|approved|rejected" candidate count"""
+        if self.patterns is None:
+            return "0"
+        counts = self.patterns.counts()
+        return str(counts.get(node.attrs.get("status", "pending"), 0))
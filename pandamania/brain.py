@@ -0,0 +1,248 @@
+"""
+PandaMania Brain
+Read-only compiled corpus: graphmaster, bot properties and maps
+"""
+
+import glob
+import os
+import threading
+
+from .aiml import AIMLError, parse_file
+from .compiler import (Srai, compile_template, compile_templates,
+                       find_conjunctions, fold_fillers, link, pure_categories)
+from .graphmaster import Graphmaster
+from .maps import BUILTIN_MAPS
+from .predicates import SCHEMA_FILE, PredicateSchema, declared_names
+from .properties import load_properties
+
+PROPERTIES_FILE = "bot.properties"
+
+# The corpus ships alongside the package in the repository root
+DEFAULT_CORPUS = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def discover_files(directory):
+    """Return every .aiml file in a directory, in deterministic load order"""
+    return sorted(glob.glob(os.path.join(directory, "*.aiml")))
+
+
+def winner(candidates):
+    """The category that owns a path: highest priority, then last loaded"""
+    best = None
+    for category in candidates:
+        if best is None or category.priority >= best.priority:
+            best = category
+    return best
+
+
+def file_stamp(path):
+    """Cheap change marker for a corpus file: (mtime_ns, size)"""
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+class Brain:
+    """Parsed AIML corpus shared by every session"""
+
+    def __init__(self, properties=None):
+        self.graphmaster = Graphmaster()
+        self.properties = dict(properties or {})
+        self.maps = dict(BUILTIN_MAPS)
+        self.directory = None
+        # Source name -> its categories in parse order, in load order; this
+        # includes categories shadowed by a later source
+        self.sources = {}
+        # Conflict index: path -> every category defining it, in load order
+        self.by_path = {}
+        self.stamps = {}
+        self.calls = []
+        # (topics, whether <that> is used) as of the last link (see link)
+        self.link_context = None
+        self.fillers = {}
+        self.conjunctions = {}
+        self.pure = set()
+        # Whether any category has a <that> pattern, so matches depend on it
+        self.that_patterns = False
+        # Bumped whenever compiled state changes; response caches key on it
+        self.generation = 0
+        self.declared = []
+        self.schema = PredicateSchema()
+        self._reload_lock = threading.Lock()
+
+    @classmethod
+    def load(cls, directory=DEFAULT_CORPUS, files=None):
+        """Parse a corpus directory (or an explicit file list) into a Brain"""
+        properties_path = os.path.join(directory, PROPERTIES_FILE)
+        properties = (load_properties(properties_path)
+                      if os.path.exists(properties_path) else {})
+        brain = cls(properties)
+        brain.directory = directory
+        for path in files if files is not None else discover_files(directory):
+            brain.load_file(path)
+        return brain.compile()
+
+    @property
+    def files(self):
+        """Names of the loaded sources, in load order"""
+        return list(self.sources)
+
+    def load_file(self, path):
+        """Parse one AIML file and add its categories"""
+        name = os.path.basename(path)
+        stamp = file_stamp(path)
+        categories = parse_file(path)
+        for category in categories:
+            self.add_category(category)
+        self.sources[name] = categories
+        self.stamps[name] = stamp
+        if name == SCHEMA_FILE:
+            self.declared = declared_names(categories)
+        return categories
+
+    def reload_file(self, path):
+        """Re-parse one AIML file and swap only its categories in"""
+        name = os.path.basename(path)
+        stamp = file_stamp(path)
+        categories = parse_file(path)
+        self.replace_source(name, categories)
+        self.stamps[name] = stamp
+        return categories
+
+    def replace_source(self, name, categories):
+        """Replace (or with None, drop) one source's categories in place
+
+        Only the paths the old and new categories occupy are touched: each
+        is re-decided from its candidates (see winner), so a path shadowed by
+        the replaced source reverts to the earlier source's category. A new
+        source loads after every existing one. The graphmaster change is
+        published atomically. Only templates of categories that newly win a
+        path are compiled, and only the <srai> calls those path changes can
+        affect are relinked (see compiler.link).
+        """
+        with self._reload_lock:
+            sources = dict(self.sources)
+            previous = sources.pop(name, ()) if categories is None else (
+                sources.get(name, ()))
+            if categories is not None:
+                sources[name] = list(categories)
+            affected = {tuple(c.path): [] for c in previous}
+            affected.update((tuple(c.path), []) for c in categories or ())
+            for source in sources.values():
+                for category in source:
+                    candidates = affected.get(tuple(category.path))
+                    if candidates is not None:
+                        candidates.append(category)
+            winners = {path: winner(candidates)
+                       for path, candidates in affected.items()}
+            graphmaster = self.graphmaster
+            fresh, dropped, changed = [], set(), []
+            for path, category in winners.items():
+                old = graphmaster.get(path)
+                if old is category:
+                    continue
+                if category is not None:
+                    compile_template(category.template, fresh)
+                    changed.append(category.pattern)
+                if old is not None:
+                    dropped.update(id(node) for node in old.template.iter()
+                                   if isinstance(node, Srai))
+                    changed.append(old.pattern)
+            graphmaster.update(winners)
+            self.sources = sources
+            for path, candidates in affected.items():
+                if candidates:
+                    self.by_path[path] = candidates
+                else:
+                    self.by_path.pop(path, None)
+            if name == SCHEMA_FILE:
+                self.declared = declared_names(categories or ())
+                self.schema = PredicateSchema(["topic"] + self.declared)
+            self.calls = [call for call in self.calls
+                          if id(call) not in dropped] + fresh
+            link(self, changed, fresh)
+            self._analyze()
+
+    def refresh(self, directory=None):
+        """Reload corpus files that changed, appeared or were deleted
+
+        Returns the names of the sources that were replaced. A file that
+        fails to parse keeps its previous categories and is retried on the
+        next refresh; the failures are raised together as one AIMLError after
+        every other file has been reloaded.
+        """
+        directory = directory or self.directory
+        paths = {os.path.basename(path): path for path in discover_files(directory)}
+        changed, errors = [], []
+        for name in list(self.stamps):
+            if name not in paths:
+                self.replace_source(name, None)
+                del self.stamps[name]
+                changed.append(name)
+        for name, path in paths.items():
+            try:
+                if self.stamps.get(name) != file_stamp(path):
+                    self.reload_file(path)
+                    changed.append(name)
+            except (OSError, AIMLError) as e:
+                errors.append(f"{name}: {e}")
+        if errors:
+            raise AIMLError("; ".join(errors))
+        return changed
+
+    def compile(self):
+        """Compile templates, link <srai> calls and fix the predicate schema"""
+        compile_templates(self)
+        self._analyze()
+        self.schema = PredicateSchema(["topic"] + self.declared)
+        return self
+
+    def relink(self):
+        """Re-resolve compiled <srai> calls after the graphmaster changed"""
+        link(self)
+        self._analyze()
+
+    def _analyze(self):
+        """Recompute the derived tables the bot's fast paths rely on"""
+        self.fillers = fold_fillers(self)
+        self.conjunctions = find_conjunctions(self)
+        self.pure = pure_categories(self)
+        self.that_patterns = any(category.that != ["*"]
+                                 for category in self.graphmaster.categories())
+        self.generation += 1
+
+    def add_category(self, category):
+        """Index a category and insert it if it wins its path (see winner)
+
+        Returns the category it displaced from the graphmaster, if any.
+        """
+        candidates = self.by_path.setdefault(tuple(category.path), [])
+        candidates.append(category)
+        if winner(candidates) is category:
+            return self.graphmaster.add(category)
+        return None
+
+    def index(self):
+        """Rebuild the conflict index from the loaded sources"""
+        self.by_path = {}
+        for source in self.sources.values():
+            for category in source:
+                self.by_path.setdefault(tuple(category.path), []).append(category)
+
+    def shadowed(self):
+        """(category, winner) for every category that loses its path"""
+        pairs = []
+        for candidates in self.by_path.values():
+            if len(candidates) > 1:
+                best = winner(candidates)
+                pairs.extend((c, best) for c in candidates if c is not best)
+        pairs.sort(key=lambda pair: (pair[0].filename, pair[0].line))
+        return pairs
+
+    @property
+    def size(self):
+        """Number of distinct categories in the graphmaster"""
+        return self.graphmaster.size
+
+    def match(self, words, that, topic):
+        """Match normalized words against the graphmaster"""
+        return self.graphmaster.match(words, that, topic)
@@ -0,0 +1,506 @@
+"""
+PandaMania Command Line
+Entry point for `python -m pandamania <command>`
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+from . import __version__, bench
+from .analysis import UNBOUNDED, CallGraph, unreachable
+from .bot import DEFAULT_CACHE_SIZE, DEFAULT_HISTORY, DEFAULT_SESSION, Bot
+from .brain import DEFAULT_CORPUS, Brain
+from .generation import (DEFAULT_QUEUE, GENERATED_SOURCE, PatternGenerator,
+                         read_requests)
+from .inference import DEFAULT_INFERENCE_LIMIT
+from .predicates import BACKENDS, DEFAULT_DYNAMIC_LIMIT
+from .replay import DEFAULT_BATCH_SIZE, replay
+from .server import (DEFAULT_HOST, DEFAULT_MAX_CONNECTIONS, DEFAULT_PORT,
+                     ChatServer, serve)
+from .snapshot import compile_brain, load_brain as load_snapshot
+from .storage import READERS, SHARED_GRAPH, Storage, read_triples
+from .telemetry import DEFAULT_COVERAGE_INTERVAL, read_coverage
+from .validate import DEFAULT_CACHE, validate
+from .workers import PooledChatServer, WorkerPool
+
+
+def load_brain(args):
+    """Build the Brain selected by the common command line options
+
+    Results of the last `pandamania bench` run become bench_* bot properties.
+    """
+    if args.no_snapshot:
+        brain = Brain.load(args.corpus)
+    else:
+        brain = load_snapshot(args.corpus, args.snapshot)
+    brain.properties.update(
+        bench.properties(os.path.join(args.corpus, bench.BENCH_FILE)))
+    return brain
+
+
+def make_bot(args):
+    """Build a Bot with the predicate store selected on the command line"""
+    storage = Storage(args.kb) if args.kb else None
+    patterns = PatternGenerator(args.corpus) if args.pattern_gen else None
+    bot = Bot(load_brain(args),
+              store=BACKENDS[args.predicate_store],
+              predicate_limit=args.predicate_limit,
+              max_clauses=args.max_clauses,
+              cache_size=args.response_cache,
+              telemetry=not args.no_telemetry,
+              inference_limit=args.inference_limit,
+              storage=storage,
+              max_sessions=args.max_sessions,
+              session_ttl=args.session_ttl,
+              history_size=args.history,
+              hop_budget=args.hop_budget,
+              turn_budget=args.turn_budget or None,
+              patterns=patterns)
+    if args.trace_log:
+        bot.telemetry.open_trace(args.trace_log, args.trace_sample)
+    if args.coverage:
+        bot.telemetry.open_coverage(args.coverage, args.coverage_interval)
+    return bot
+
+
+def cmd_compile(args):
+    """Parse the corpus and write the binary brain snapshot"""
+    brain = compile_brain(args.corpus, args.snapshot)
+    print(f"Compiled {brain.size} categories from {len(brain.files)} files"
+          f" ({len(brain.shadowed())} shadowed; see `pandamania conflicts`)")
+    return 0
+
+
+def cmd_bench(args):
+    """Benchmark the corpus and write the JSON report"""
+    report = bench.run(args.corpus, args.samples, args.loads)
+    path = args.output or os.path.join(args.corpus, bench.BENCH_FILE)
+    bench.save(report, path)
+    for line in bench.report_lines(report):
+        print(line)
+    print(f"Wrote {path}")
+    return 0
+
+
+def _describe(category):
+    text = " ".join(category.pattern)
+    if category.that != ["*"]:
+        text += f" <that> {' '.join(category.that)}"
+    if category.topic != ["*"]:
+        text += f" <topic> {' '.join(category.topic)}"
+    return text
+
+
+def cmd_conflicts(args):
+    """Report every category shadowed by another with the same path"""
+    shadowed = load_brain(args).shadowed()
+    for category, winner in shadowed:
+        reason = (f"priority {winner.priority} > {category.priority}"
+                  if winner.priority != category.priority else "load order")
+        print(f"{category.id}: {_describe(category)} - shadowed by "
+              f"{winner.id} ({reason})")
+    print(f"{len(shadowed)} shadowed categories")
+    return 0
+
+
+def _bound(value):
+    return "unbounded" if value == UNBOUNDED else str(value)
+
+
+def cmd_analyze(args):
+    """Report the static <srai> call graph, its cycles and hop bounds"""
+    graph = CallGraph(load_brain(args))
+    print(f"{len(graph.categories)} categories, {graph.edges()} <srai> edges, "
+          f"{sum(graph.open.values())} open calls in {len(graph.open)} "
+          f"categories")
+    for cycle in graph.cycles:
+        print("cycle: " + " -> ".join(f"{c.id} ({_describe(c)})"
+                                      for c in reversed(cycle)))
+    print(f"{len(graph.cycles)} cycles")
+    print("Deepest categories (worst-case hops, depth):")
+    for category in graph.deepest(args.top):
+        print(f"  {category.id}: {_describe(category)} - "
+              f"{_bound(graph.hops[category])}, {_bound(graph.depth[category])}")
+    print("Open calls (<srai> of input text; bounded by its length):")
+    for category, count in graph.open.items():
+        print(f"  {category.id}: {_describe(category)} x{count}")
+    print(f"Runtime hop budget: {graph.hop_budget()} per input word "
+          f"(override with --hop-budget)")
+    return 1 if graph.cycles else 0
+
+
+def cmd_coverage(args):
+    """Report recorded category hits against the categories that can win"""
+    brain = load_brain(args)
+    logs = args.logs or [args.coverage]
+    missing = [path for path in logs if not os.path.exists(path)]
+    if missing:
+        print(f"no coverage log: {', '.join(missing)}", file=sys.stderr)
+        return 1
+    hits = read_coverage(logs)
+    dead = unreachable(brain)
+    print(f"Unreachable categories (can never win a match): {len(dead)}")
+    for category, best, reason in dead:
+        print(f"  {category.id}: {_describe(category)} - {reason} by "
+              f"{best.id} ({_describe(best)})")
+    categories = sorted(brain.graphmaster.categories(),
+                        key=lambda c: (c.filename, c.line))
+    unhit = [c for c in categories if not hits[c.id]]
+    print(f"Categories hit: {len(categories) - len(unhit)} of "
+          f"{len(categories)} ({sum(hits.values())} hits)")
+    for filename in brain.files:
+        total = sum(1 for c in categories if c.filename == filename)
+        missed = sum(1 for c in unhit if c.filename == filename)
+        if total:
+            print(f"  {filename:<30} {total - missed:>4} of {total:>4}")
+    print("Most hit:")
+    by_id = {c.id: c for c in categories}
+    for cid, count in hits.most_common(args.top):
+        known = by_id.get(cid)
+        print(f"  {cid}: {_describe(known) if known else '(not in corpus)'}"
+              f" x{count}")
+    if args.unhit:
+        print("Reachable but never hit:")
+        for category in unhit:
+            print(f"  {category.id}: {_describe(category)}")
+    stale = [cid for cid in hits if cid not in by_id]
+    if stale:
+        print(f"{len(stale)} logged category ids are not in the corpus "
+              f"(edited since they were recorded)")
+    return 0
+
+
+def cmd_patterns(args):
+    """List, bulk-generate, approve or reject generated pattern candidates"""
+    generator = PatternGenerator(args.corpus)
+    if args.action == "list":
+        for candidate in generator.pending():
+            print(f"{candidate['id']}: {candidate['pattern']} "
+                  f"({candidate['kind']})")
+        counts = generator.counts()
+        print(", ".join(f"{count} {status}" for status, count in counts.items()))
+        return 0
+    brain = load_brain(args)
+    if args.action == "generate":
+        start = time.perf_counter()
+        added, rejected = generator.generate_many(
+            brain, (request for path in args.items
+                    for request in read_requests(path)))
+        for (kind, terms), reason in rejected:
+            print(f"rejected {kind} {', '.join(terms)}: {reason}")
+        print(f"{len(added)} candidates queued, {len(rejected)} rejected in "
+              f"{time.perf_counter() - start:.2f}s")
+        return 0
+    if args.action == "approve":
+        approved, refused = generator.approve(
+            brain, None if args.items == ["all"] else args.items)
+        for candidate_id, reason in refused:
+            print(f"refused {candidate_id}: {reason}")
+        print(f"{len(approved)} approved into {GENERATED_SOURCE}")
+        return 1 if refused else 0
+    dropped = generator.reject(args.items)
+    print(f"{len(dropped)} rejected")
+    return 0 if len(dropped) == len(args.items) else 1
+
+
+def cmd_validate(args):
+    """Check every corpus file; parses only files changed since the last run"""
+    report = validate(args.corpus, None if args.no_cache else DEFAULT_CACHE,
+                      args.workers)
+    print(f"{len(report.scans)} files ({report.parsed} parsed), "
+          f"{report.categories} categories")
+    for error in report.errors:
+        print(f"error: {error}")
+    for title, found in (("<srai> reaching only the catch-all",
+                          report.dead_srai),
+                         ("<get> of a predicate never <set>",
+                          report.unset_gets),
+                         ("undefined <map>", report.undefined_maps)):
+        for location, detail in found:
+            print(f"warning: {location}: {title}: {detail}")
+    print(f"{len(report.errors)} errors, {len(report.warnings)} warnings")
+    return 1 if report.errors or (args.strict and report.warnings) else 0
+
+
+def cmd_chat(args):
+    """Interactive console conversation"""
+    bot = make_bot(args)
+    print(f"PandaMania {__version__} - {bot.brain.size} categories loaded. "
+          "Ctrl-D to exit.")
+    try:
+        while True:
+            try:
+                text = input("You: ")
+            except (EOFError, KeyboardInterrupt):
+                print()
+                return 0
+            print(f"Bot: {bot.respond(text, args.session)}")
+    finally:
+        bot.close()
+
+
+def cmd_ask(args):
+    """Answer one or more inputs given on the command line"""
+    bot = make_bot(args)
+    try:
+        for text in args.text:
+            print(bot.respond(text, args.session))
+    finally:
+        bot.close()
+    return 0
+
+
+def cmd_serve(args):
+    """Serve conversations over HTTP and WebSocket"""
+    bot = make_bot(args)
+    options = {"host": args.host, "port": args.port,
+               "max_connections": args.max_connections}
+    if args.workers <= 1:
+        try:
+            serve(ChatServer(bot, reload_interval=args.reload, **options))
+        finally:
+            bot.close()
+        return 0
+    pool = WorkerPool(bot, args.workers, args.reload)
+    pool.start()
+    try:
+        serve(PooledChatServer(pool, **options))
+    finally:
+        pool.stop()
+    return 0
+
+
+def cmd_replay(args):
+    """Replay a JSONL conversation log and write JSONL results"""
+    bot = make_bot(args)
+    source = sys.stdin if args.input == "-" else open(args.input, encoding="utf-8")
+    target = (sys.stdout if args.output == "-"
+              else open(args.output, "w", encoding="utf-8"))
+    turns = errors = 0
+    try:
+        for record in replay(bot, source, args.workers, args.batch_size):
+            target.write(json.dumps(record) + "\n")
+            turns += 1
+            errors += "error" in record
+    finally:
+        bot.close()
+        if source is not sys.stdin:
+            source.close()
+        if target is not sys.stdout:
+            target.close()
+    print(f"Replayed {turns - errors} turns ({errors} invalid records)",
+          file=sys.stderr)
+    return 1 if errors else 0
+
+
+def cmd_kb_import(args):
+    """Bulk-load CSV/JSONL triples into the knowledge base database"""
+    storage = Storage(args.kb)
+    try:
+        for path in args.files:
+            start = time.perf_counter()
+            try:
+                rows, added = storage.import_rows(
+                    read_triples(path, args.format), args.graph)
+            except (OSError, ValueError) as exc:
+                print(f"{exc} (nothing imported from {path})", file=sys.stderr)
+                return 1
+            seconds = time.perf_counter() - start
+            rate = rows / seconds if seconds else 0
+            print(f"{path}: {added} new facts from {rows} rows in "
+                  f"{seconds:.2f}s ({rate:,.0f} rows/s)")
+    finally:
+        storage.close()
+    return 0
+
+
+def build_parser():
+    """Create the argument parser with all subcommands"""
+    parser = argparse.ArgumentParser(prog="pandamania",
+                                     description="PandaMania AIML interpreter")
+    parser.add_argument("--version", action="version",
+                        version=f"%(prog)s {__version__}")
+    parser.add_argument("--corpus", default=DEFAULT_CORPUS,
+                        help="directory holding *.aiml and bot.properties")
+    parser.add_argument("--snapshot", default=None,
+                        help="brain snapshot path (default: <corpus>/brain.snapshot)")
+    parser.add_argument("--no-snapshot", action="store_true",
+                        help="always parse the AIML files, ignoring snapshots")
+    parser.add_argument("--predicate-store", choices=sorted(BACKENDS),
+                        default="slots", help="per-session predicate backend")
+    parser.add_argument("--predicate-limit", type=int,
+                        default=DEFAULT_DYNAMIC_LIMIT,
+                        help="max undeclared predicates kept per session")
+    parser.add_argument("--max-clauses", type=int, default=None,
+                        help="split '* AND *' inputs of at most this many "
+                             "clauses once (default: re-match each half)")
+    parser.add_argument("--response-cache", type=int, default=DEFAULT_CACHE_SIZE,
+                        help="entries in the pure-response LRU (0 disables)")
+    parser.add_argument("--inference-limit", type=int,
+                        default=DEFAULT_INFERENCE_LIMIT,
+                        help="max facts each session's knowledge base derives")
+    parser.add_argument("--kb", metavar="PATH",
+                        help="SQLite database keeping knowledge base facts "
+                             "across runs, with imported domain knowledge")
+    parser.add_argument("--max-sessions", type=int, default=None,
+                        help="sessions held in memory; the least recently "
+                             "used are evicted (saved first with --kb)")
+    parser.add_argument("--session-ttl", type=float, default=None,
+                        metavar="SECONDS",
+                        help="evict sessions idle this long")
+    parser.add_argument("--history", type=int, default=DEFAULT_HISTORY,
+                        help="input sentences and responses each session "
+                             "remembers for <input> and <that>")
+    parser.add_argument("--hop-budget", type=int, default=None,
+                        help="categories a sentence may render per input "
+                             "word (default: derived by `pandamania analyze`)")
+    parser.add_argument("--turn-budget", type=float, default=None,
+                        metavar="SECONDS",
+                        help="time a turn may spend rendering (default: no "
+                             "limit; replies then depend on machine speed)")
+    parser.add_argument("--no-telemetry", action="store_true",
+                        help="keep no live_* hot-path counters")
+    parser.add_argument("--trace-log", metavar="PATH",
+                        help="append a JSONL record per sampled sentence")
+    parser.add_argument("--trace-sample", type=float, default=1.0,
+                        metavar="FRACTION",
+                        help="fraction of sentences traced (default 1: all)")
+    parser.add_argument("--pattern-gen", action="store_true",
+                        help=f"let templates queue generated patterns in "
+                             f"<corpus>/{DEFAULT_QUEUE} and approve them into "
+                             f"<corpus>/{GENERATED_SOURCE}")
+    parser.add_argument("--coverage", metavar="PATH",
+                        help="append per-category hit counts to PATH "
+                             "periodically and when the bot shuts down")
+    parser.add_argument("--coverage-interval", type=float,
+                        default=DEFAULT_COVERAGE_INTERVAL, metavar="SECONDS",
+                        help="seconds between --coverage writes (default "
+                             f"{DEFAULT_COVERAGE_INTERVAL}; 0: every sentence)")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    compile_ = commands.add_parser("compile", help="write the brain snapshot")
+    compile_.set_defaults(func=cmd_compile)
+
+    chat = commands.add_parser("chat", help="interactive conversation")
+    chat.add_argument("--session", default=DEFAULT_SESSION)
+    chat.set_defaults(func=cmd_chat)
+
+    ask = commands.add_parser("ask", help="answer inputs and exit")
+    ask.add_argument("text", nargs="+")
+    ask.add_argument("--session", default=DEFAULT_SESSION)
+    ask.set_defaults(func=cmd_ask)
+
+    conflicts = commands.add_parser(
+        "conflicts", help="list categories shadowed by identical patterns")
+    conflicts.set_defaults(func=cmd_conflicts)
+
+    analyze = commands.add_parser(
+        "analyze", help="static <srai> call graph, cycles and hop bounds")
+    analyze.add_argument("--top", type=int, default=10,
+                         help="deepest categories to list")
+    analyze.set_defaults(func=cmd_analyze)
+
+    coverage = commands.add_parser(
+        "coverage", help="category hits and unreachable categories")
+    coverage.add_argument("logs", nargs="*",
+                          help="coverage logs to sum (default: --coverage)")
+    coverage.add_argument("--top", type=int, default=10,
+                          help="most hit categories to list")
+    coverage.add_argument("--unhit", action="store_true",
+                          help="list every reachable category never hit")
+    coverage.set_defaults(func=cmd_coverage)
+
+    patterns = commands.add_parser(
+        "patterns", help="review generated pattern candidates")
+    patterns.add_argument("action",
+                          choices=("list", "generate", "approve", "reject"))
+    patterns.add_argument("items", nargs="*",
+                          help="generate: CSV files of kind,term[,term] rows; "
+                               "approve/reject: candidate ids (approve all: "
+                               "all)")
+    patterns.set_defaults(func=cmd_patterns)
+
+    validate_ = commands.add_parser(
+        "validate", help="check the corpus XML, <srai>, <get> and <map> uses")
+    validate_.add_argument("--workers", type=int, default=None,
+                           help="parser processes (default: one per CPU)")
+    validate_.add_argument("--no-cache", action="store_true",
+                           help=f"parse every file, ignoring <corpus>/"
+                                f"{DEFAULT_CACHE}")
+    validate_.add_argument("--strict", action="store_true",
+                           help="exit 1 on warnings as well as errors")
+    validate_.set_defaults(func=cmd_validate)
+
+    bench_ = commands.add_parser("bench", help="measure latency and throughput")
+    bench_.add_argument("-o", "--output", default=None,
+                        help=f"JSON report path (default: <corpus>/"
+                             f"{bench.BENCH_FILE}, which BENCHMARK reports)")
+    bench_.add_argument("--samples", type=int, default=bench.DEFAULT_SAMPLES,
+                        help="timed operations per case")
+    bench_.add_argument("--loads", type=int, default=bench.DEFAULT_LOADS,
+                        help="repetitions of the load and build cases")
+    bench_.set_defaults(func=cmd_bench)
+
+    serve_ = commands.add_parser("serve", help="asyncio HTTP/WebSocket server")
+    serve_.add_argument("--host", default=DEFAULT_HOST)
+    serve_.add_argument("--port", type=int, default=DEFAULT_PORT)
+    serve_.add_argument("--max-connections", type=int,
+                        default=DEFAULT_MAX_CONNECTIONS)
+    serve_.add_argument("--workers", type=int, default=1,
+                        help="pre-forked interpreter processes (default 1: "
+                             "evaluate turns in the server process)")
+    serve_.add_argument("--reload", type=float, metavar="SECONDS",
+                        help="poll the corpus and hot-reload changed files")
+    serve_.set_defaults(func=cmd_serve)
+
+    replay_ = commands.add_parser(
+        "replay", help="score a JSONL log of {session, input} turns")
+    replay_.add_argument("input", help="JSONL file, or - for stdin")
+    replay_.add_argument("-o", "--output", default="-",
+                         help="JSONL results file (default: stdout)")
+    replay_.add_argument("--workers", type=int, default=1,
+                         help="processes; sessions are partitioned between them")
+    replay_.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE,
+                         help="turns sent to a worker at a time")
+    replay_.set_defaults(func=cmd_replay)
+
+    kb_import = commands.add_parser(
+        "kb-import", help="bulk-load triples into the --kb database")
+    kb_import.add_argument("files", nargs="+",
+                           help="CSV (subject,predicate,object) or JSONL files")
+    kb_import.add_argument("--format", choices=sorted(READERS),
+                           help="file format (default: by extension)")
+    kb_import.add_argument("--graph", default=SHARED_GRAPH,
+                           help="session id to load into (default: the shared "
+                                "domain knowledge every session sees)")
+    kb_import.set_defaults(func=cmd_kb_import)
+
+    return parser
+
+
+def main(argv=None):
+    """Parse arguments and run the selected command"""
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.trace_log and args.no_telemetry:
+        parser.error("--trace-log needs telemetry")
+    if args.coverage and args.no_telemetry and args.command != "coverage":
+        parser.error("--coverage needs telemetry")
+    if args.command == "coverage" and not (args.logs or args.coverage):
+        parser.error("coverage needs log files or --coverage")
+    if args.history < 1:
+        parser.error("--history must be at least 1")
+    if args.max_sessions is not None and args.max_sessions < 1:
+        parser.error("--max-sessions must be at least 1")
+    if args.command == "patterns" and args.action != "list" and not args.items:
+        parser.error(f"patterns {args.action} needs files or ids")
+    if args.command == "kb-import" and not args.kb:
+        parser.error("kb-import needs --kb")
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,292 @@
+"""
+PandaMania Template Compiler
+Links <srai> elements to graphmaster targets at load time
+"""
+
+from .graphmaster import THAT, TOPIC, Match
+from .normalize import WILDCARDS, normalize_words
+from .telemetry import LIVE_PREFIX
+from .template import Node
+
+# Context used while resolving static targets. Topic-specific categories are
+# handled by per-call guards; corpora with <that> patterns skip static targets
+_UNKNOWN = ["UNKNOWN"]
+
+# Children that outrank an exact word at a trie node (see Graphmaster._match)
+_OUTRANK_EXACT = ("#", "_")
+# (start, target, guard) of a call with no static resolution
+UNLINKED = (None, None, frozenset())
+
+# Template elements whose output depends only on the input words, the topic
+# and the brain. Anything else (predicate reads, history, time, randomness,
+# the session id, <that> stars, unknown extensions) makes a category impure.
+# <set> only writes, so a pure turn's writes can be recorded and replayed.
+# <bot> is pure unless it reads a live_* telemetry counter
+PURE_TAGS = frozenset((
+    "template", "think", "set", "star", "topicstar", "srai", "sr", "map",
+    "name", "br", "bot", "uppercase", "lowercase", "formal", "size",
+))
+
+
+class Srai(Node):
+    """Compiled <srai>: a static target or a pre-walked trie prefix
+
+    link is (start, target, guard), replaced as a whole by link():
+    target: Match used directly when the text is fully static, unless the
+        session topic is in guard (a topic whose categories change the winner).
+    start/tail: trie node reached by the static leading words, and the
+        children whose rendering is matched from that node onwards.
+    """
+
+    __slots__ = ("words", "tail", "link")
+
+    def __init__(self, node):
+        super().__init__(node.tag, node.attrs, node.children)
+        self.words, self.tail = _split_static(node.children)
+        self.link = UNLINKED
+
+    @classmethod
+    def restore(cls, attrs, children, words, tail, link):
+        """A call compiled and linked earlier (see snapshot.loads)"""
+        call = cls.__new__(cls)
+        Node.__init__(call, "srai", attrs, children)
+        call.words, call.tail, call.link = words, tail, link
+        return call
+
+    @property
+    def start(self):
+        return self.link[0]
+
+    @property
+    def target(self):
+        return self.link[1]
+
+    @property
+    def guard(self):
+        return self.link[2]
+
+
+def _split_static(children):
+    """Split children into complete leading static words and a dynamic tail"""
+    static = []
+    for i, child in enumerate(children):
+        if not isinstance(child, str):
+            break
+        static.append(child)
+    else:
+        return tuple(normalize_words("".join(static))), None
+    text = "".join(static)
+    # A trailing partial word may be glued to the following element's output;
+    # template text is whitespace-collapsed, so the last space ends the prefix
+    cut = len(text) if text.endswith(" ") else text.rfind(" ") + 1
+    remainder = [text[cut:]] if text[cut:] else []
+    return tuple(normalize_words(text[:cut])), remainder + children[i:]
+
+
+def compile_template(template, calls):
+    """Replace <srai> nodes in a template with Srai nodes, collecting them
+
+    Already compiled nodes are collected as they are, so recompiling a
+    brain after a reload gathers every live call again.
+    """
+    for node in template.iter():
+        for i, child in enumerate(node.children):
+            if isinstance(child, Srai):
+                calls.append(child)
+            elif isinstance(child, Node) and child.tag == "srai":
+                node.children[i] = call = Srai(child)
+                calls.append(call)
+
+
+def _contextual(brain):
+    """Topics that have their own categories, and whether <that> is used"""
+    topics = set()
+    that_patterns = False
+    for category in brain.graphmaster.categories():
+        if category.topic != ["*"]:
+            topics.add(tuple(category.topic))
+        if category.that != ["*"]:
+            that_patterns = True
+    return topics, that_patterns
+
+
+def _walk(root, words):
+    """Walk exact words from the root while no wildcard outranks them"""
+    node = root
+    for word in words:
+        children = node.children
+        if any(key in children for key in _OUTRANK_EXACT) or any(
+                key[0] == "$" for key in children):
+            return None
+        node = children.get(word)
+        if node is None:
+            return None
+    return node
+
+
+def _overlaps(call, pattern):
+    """Whether a category with this pattern can change how a call links
+
+    True unless the pattern's exact words part ways with the call's static
+    words (or, for a fully static call, is shorter than them).
+    """
+    words = call.words
+    for i, token in enumerate(pattern):
+        if i == len(words):
+            return call.tail is not None
+        if token != words[i]:
+            return token in WILDCARDS or token[0] == "$"
+    return len(pattern) == len(words) or call.tail is not None
+
+
+def _resolve(graphmaster, call, topics, static):
+    """A call's (start, target, guard) against the current graphmaster"""
+    if call.tail is not None:
+        if call.words:
+            return _walk(graphmaster.root, call.words), None, frozenset()
+        return UNLINKED
+    if not call.words or not static:
+        return UNLINKED
+    match = graphmaster.match(call.words, _UNKNOWN, _UNKNOWN)
+    if match is None or any(
+            n.tag in ("thatstar", "topicstar")
+            for n in match.category.template.iter()):
+        return UNLINKED
+    guard = set()
+    for topic in topics:
+        other = graphmaster.match(call.words, _UNKNOWN, list(topic))
+        if other is None or other.category is not match.category:
+            guard.add(topic)
+    return None, Match(match.category, match.stars, [], []), frozenset(guard)
+
+
+def link(brain, patterns=None, fresh=()):
+    """Resolve compiled <srai> calls against the brain's current graphmaster
+
+    With patterns (of the categories that won or lost a path since the last
+    link), only the fresh calls and those the patterns overlap are
+    re-resolved, unless the set of topics or the use of <that> changed.
+    Every new link is computed before any is published, and each call
+    takes its new (start, target, guard) in one assignment, so a turn
+    running alongside sees a call's old link or its new one, never a mix.
+    """
+    graphmaster = brain.graphmaster
+    context = _contextual(brain)
+    topics, that_patterns = context
+    calls = brain.calls
+    if patterns is not None and context == brain.link_context:
+        fresh = set(map(id, fresh))
+        calls = [call for call in calls if id(call) in fresh
+                 or any(_overlaps(call, pattern) for pattern in patterns)]
+    static = not that_patterns and all(
+        "*" not in t and "_" not in t and "#" not in t and "^" not in t
+        for t in topics)
+    links = [(call, _resolve(graphmaster, call, topics, static))
+             for call in calls]
+    for call, resolved in links:
+        call.link = resolved
+    brain.link_context = context
+    return len(links)
+
+
+def _identity(template):
+    """True for a template that is exactly <srai><star/></srai>"""
+    if len(template.children) != 1:
+        return False
+    srai = template.children[0]
+    if not isinstance(srai, Node) or srai.tag != "srai" or len(srai.children) != 1:
+        return False
+    star = srai.children[0]
+    return (isinstance(star, Node) and star.tag == "star" and not star.children
+            and star.attrs.get("index", "1") == "1")
+
+
+def fold_fillers(brain):
+    """Words whose "WORD *" category only re-submits the rest of the input
+
+    Such a word can be stripped off the front of any input with at least one
+    more word, with no match at all: nothing at the root outranks the exact
+    word, and the trie below it is the single chain WORD * <THAT> * <TOPIC> *,
+    which always matches. Returns {word: category}.
+    """
+    root = brain.graphmaster.root.children
+    if "#" in root or "_" in root:
+        return {}
+    fillers = {}
+    for word, node in root.items():
+        if word in ("^", "*") or word[0] == "$" or "$" + word in root:
+            continue
+        for key in ("*", THAT, "*", TOPIC, "*"):
+            if list(node.children) != [key] or node.category is not None:
+                break
+            node = node.children[key]
+        else:
+            if (not node.children and node.category is not None
+                    and _identity(node.category.template)):
+                fillers[word] = node.category
+    return fillers
+
+
+def _resubmits(node):
+    """Star index a node re-submits if it is <srai><star index="n"/></srai>"""
+    if not isinstance(node, Srai) or len(node.children) != 1:
+        return None
+    star = node.children[0]
+    if not isinstance(star, Node) or star.tag != "star" or star.children:
+        return None
+    return star.attrs.get("index", "1")
+
+
+def find_conjunctions(brain):
+    """Categories "* WORD *" whose template re-submits each half by <srai>
+
+    Returns {category: (word, first, rest)}: first and rest are the Srai
+    nodes for star 1 and star 2, and no other node reads the stars, so the
+    bot can split such an input once (see Bot.max_clauses).
+    """
+    found = {}
+    for category in brain.graphmaster.categories():
+        pattern = category.pattern
+        if (len(pattern) != 3 or pattern[0] != "*" or pattern[2] != "*"
+                or pattern[1] in WILDCARDS or pattern[1][0] == "$"
+                or category.that != ["*"] or category.topic != ["*"]):
+            continue
+        calls, stars = {}, 0
+        for node in category.template.iter():
+            if node.tag in ("star", "sr"):
+                stars += 1
+            index = _resubmits(node)
+            if index is not None:
+                calls.setdefault(index, []).append(node)
+        if (stars == 2 and len(calls.get("1", ())) == 1
+                and len(calls.get("2", ())) == 1):
+            found[category] = (pattern[1], calls["1"][0], calls["2"][0])
+    return found
+
+
+def pure_categories(brain):
+    """Categories whose template uses only PURE_TAGS
+
+    A turn that renders only pure categories (through any <srai> chain)
+    gives the same response and predicate writes for the same input and
+    topic every time.
+    """
+    return {category for category in brain.graphmaster.categories()
+            if all(_pure(node) for node in category.template.iter())}
+
+
+def _pure(node):
+    if node.tag != "bot":
+        return node.tag in PURE_TAGS
+    name = node.attrs.get("name")
+    return name is not None and not name.startswith(LIVE_PREFIX)
+
+
+def compile_templates(brain):
+    """Compile every template in the brain and link its <srai> calls"""
+    calls = []
+    for category in brain.graphmaster.categories():
+        compile_template(category.template, calls)
+    brain.calls = calls
+    link(brain)
+    return brain
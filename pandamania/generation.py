@@ -0,0 +1,244 @@
+"""
+PandaMania Pattern Generation
+Template-filled candidate categories, a pending review queue on disk and
+live insertion of approved categories into the brain
+"""
+
+import csv
+import fcntl
+import json
+import os
+import time
+from contextlib import contextmanager
+from xml.sax.saxutils import escape
+
+from .aiml import parse_string
+from .analysis import outranked_by
+from .graphmaster import THAT, TOPIC
+from .normalize import normalize_words
+
+# Approved categories are appended to this corpus file, so they load on
+# every later start like any other source; it is deployment state, kept
+# out of version control
+GENERATED_SOURCE = "generated.aiml"
+DEFAULT_QUEUE = "pending_patterns.json"
+DEFAULT_KIND = "definition"
+ID_PREFIX = "PG"
+
+# kind -> (pattern, template); {0}, {1} are the terms of one candidate
+TEMPLATES = {
+    "definition": (
+        "WHAT IS {0}",
+        "{0} is [definition pending human input]."
+        " <srai>METACOGNITIVE PROCESS {0}</srai>"),
+    "reflection": (
+        "WHAT DO YOU THINK ABOUT {0}",
+        "Reflecting on {0}: [reflection pending human input]."
+        " <srai>METACOGNITIVE PROCESS {0}</srai>"),
+    "capability": (
+        "CAN {0} {1}",
+        "Yes, {0} can {1}: [capability pending human input]."),
+    "relationship": (
+        "HOW DOES {0} RELATE TO {1}",
+        "{0} relates to {1} through [relationship pending human input]."),
+    "process": (
+        "HOW TO {0}",
+        "To {0}: [process steps pending human input]."),
+    "comparison": (
+        "COMPARE {0} AND {1}",
+        "Comparing {0} and {1}: [analysis pending human input]."),
+}
+
+_HEADER = ('<?xml version="1.0" encoding="UTF-8"?>\n<aiml version="2.0">\n'
+           "<!-- Approved by pattern generation review -->\n")
+_FOOTER = "</aiml>\n"
+
+
+def _arity(kind):
+    return TEMPLATES[kind][0].count("{")
+
+
+def category_xml(candidate):
+    """AIML source of a candidate's category"""
+    return (f"<category>\n    <pattern>{candidate['pattern']}</pattern>\n"
+            f"    <template>{candidate['template']}</template>\n</category>\n")
+
+
+def read_requests(path):
+    """(kind, terms) rows of a CSV file: kind, then one term per slot"""
+    with open(path, newline="", encoding="utf-8") as f:
+        for row in csv.reader(f):
+            if row and row[0].strip():
+                yield row[0].strip().lower(), [term.strip() for term in row[1:]]
+
+
+class PatternGenerator:
+    """Candidate categories awaiting review, kept in <directory>/DEFAULT_QUEUE
+
+    generate() fills a TEMPLATES entry and queues the category unless its
+    path collides: with a category already in the brain, with a pending
+    candidate, or with a category that would always win over it (see
+    analysis.outranked_by). approve() appends categories to
+    GENERATED_SOURCE and swaps that source into the live brain.
+    Every operation holds a lock on the queue, so worker processes can
+    share one; other workers see approved categories when they reload.
+    """
+
+    def __init__(self, directory, queue=DEFAULT_QUEUE):
+        self.directory = directory
+        self.path = os.path.join(directory, queue)
+        self.source = os.path.join(directory, GENERATED_SOURCE)
+
+    @contextmanager
+    def _state(self, write=True):
+        """The queue, locked for the duration and saved afterwards"""
+        with open(self.path + ".lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if os.path.exists(self.path):
+                with open(self.path, encoding="utf-8") as f:
+                    state = json.load(f)
+            else:
+                state = {"next": 1, "pending": [], "approved": 0,
+                         "rejected": 0}
+            yield state
+            if write:
+                temporary = self.path + ".tmp"
+                with open(temporary, "w", encoding="utf-8") as f:
+                    f.write(json.dumps(state))
+                os.replace(temporary, self.path)
+
+    def pending(self):
+        """Candidates awaiting review, oldest first"""
+        with self._state(write=False) as state:
+            return state["pending"]
+
+    def counts(self):
+        """Candidates generated, pending, approved and rejected so far"""
+        with self._state(write=False) as state:
+            return {"generated": state["next"] - 1,
+                    "pending": len(state["pending"]),
+                    "approved": state["approved"],
+                    "rejected": state["rejected"]}
+
+    def find(self, candidate_id):
+        """A pending candidate by id (any case or spacing), or None"""
+        wanted = "".join(candidate_id.split()).upper()
+        return next((c for c in self.pending() if c["id"] == wanted), None)
+
+    def generate(self, brain, kind, terms):
+        """Queue one candidate; (candidate, None) or (None, reason)"""
+        added, rejected = self.generate_many(brain, [(kind, terms)])
+        return (added[0], None) if added else (None, rejected[0][1])
+
+    def generate_many(self, brain, requests):
+        """Queue a candidate per (kind, terms) request, in one pass
+
+        Returns (candidates queued, [(request, reason) rejected]). The queue
+        is read and written once however many requests there are.
+        """
+        graphmaster = brain.graphmaster
+        added, rejected = [], []
+        with self._state() as state:
+            queued = {c["pattern"]: c["id"] for c in state["pending"]}
+            for kind, terms in requests:
+                candidate, reason = None, None
+                if kind not in TEMPLATES:
+                    reason = f"no {kind} template"
+                elif len(terms) != _arity(kind) or not all(
+                        normalize_words(term) for term in terms):
+                    reason = f"the {kind} template takes {_arity(kind)} terms"
+                else:
+                    pattern_text, template_text = TEMPLATES[kind]
+                    pattern = pattern_text.format(
+                        *(" ".join(normalize_words(term)) for term in terms))
+                    reason = (f"{pattern} is already pending as {queued[pattern]}"
+                              if pattern in queued else
+                              _collision(graphmaster, pattern))
+                    if reason is None:
+                        candidate = {
+                            "id": f"{ID_PREFIX}{state['next']}",
+                            "kind": kind, "terms": list(terms),
+                            "pattern": pattern,
+                            "template": template_text.format(
+                                *(escape(" ".join(term.split()))
+                                  for term in terms)),
+                            "created": round(time.time(), 3),
+                        }
+                if candidate is None:
+                    rejected.append(((kind, terms), reason))
+                    continue
+                state["next"] += 1
+                state["pending"].append(candidate)
+                queued[pattern] = candidate["id"]
+                added.append(candidate)
+        return added, rejected
+
+    def approve(self, brain, ids=None):
+        """Add pending candidates (all of them for None) to the live brain
+
+        Returns (candidates approved, [(id, reason) refused]). A candidate
+        whose path the brain has come to answer since it was generated is
+        refused and stays pending.
+        """
+        approved, refused = [], []
+        with self._state() as state:
+            wanted = None if ids is None else {
+                "".join(i.split()).upper(): i for i in ids}
+            keep = []
+            for candidate in state["pending"]:
+                if wanted is not None and candidate["id"] not in wanted:
+                    keep.append(candidate)
+                    continue
+                reason = _collision(brain.graphmaster, candidate["pattern"])
+                if reason is None:
+                    approved.append(candidate)
+                else:
+                    refused.append((candidate["id"], reason))
+                    keep.append(candidate)
+            if wanted is not None:
+                found = {c["id"] for c in state["pending"]}
+                refused.extend((i, f"no pending pattern {i}")
+                               for key, i in wanted.items() if key not in found)
+            if approved:
+                self._append(approved)
+                state["pending"] = keep
+                state["approved"] += len(approved)
+        if approved:
+            brain.reload_file(self.source)
+        return approved, refused
+
+    def reject(self, ids):
+        """Drop pending candidates; the ids that were pending"""
+        wanted = {"".join(i.split()).upper() for i in ids}
+        with self._state() as state:
+            dropped = [c["id"] for c in state["pending"] if c["id"] in wanted]
+            state["pending"] = [c for c in state["pending"]
+                                if c["id"] not in wanted]
+            state["rejected"] += len(dropped)
+        return dropped
+
+    def _append(self, candidates):
+        """Add categories to GENERATED_SOURCE, checking they parse first"""
+        body = "".join(category_xml(c) for c in candidates)
+        parse_string(f"<aiml>{body}</aiml>", GENERATED_SOURCE)
+        text = _HEADER + _FOOTER
+        if os.path.exists(self.source):
+            with open(self.source, encoding="utf-8") as f:
+                text = f.read()
+        end = text.rindex("</aiml>")
+        temporary = self.source + ".tmp"
+        with open(temporary, "w", encoding="utf-8") as f:
+            f.write(text[:end] + body + text[end:])
+        os.replace(temporary, self.source)
+
+
+def _collision(graphmaster, pattern):
+    """Why a generated pattern cannot be added, or None"""
+    path = pattern.split() + [THAT, "*", TOPIC, "*"]
+    existing = graphmaster.get(path)
+    if existing is not None:
+        return f"{pattern} is already answered by {existing.id}"
+    winner = outranked_by(graphmaster, path)
+    if winner is not None:
+        return f"{pattern} would always lose to {winner.id}"
+    return None
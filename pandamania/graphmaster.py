@@ -0,0 +1,257 @@
+"""
+PandaMania Graphmaster
+Word-level pattern trie implementing AIML 2.0 match priority
+"""
+
+THAT = "<THAT>"
+TOPIC = "<TOPIC>"
+SEPARATORS = (THAT, TOPIC)
+
+# Wildcards matching zero or more words, and the order wildcards and exact
+# words are tried in at each node: $word, #, _, word, ^, *
+ZERO_OR_MORE = ("#", "^")
+
+
+class Match:
+    """Result of a graphmaster lookup"""
+
+    __slots__ = ("category", "stars", "thatstars", "topicstars")
+
+    def __init__(self, category, stars, thatstars, topicstars):
+        self.category = category
+        self.stars = stars
+        self.thatstars = thatstars
+        self.topicstars = topicstars
+
+
+class _Node:
+    __slots__ = ("children", "category")
+
+    def __init__(self):
+        self.children = {}
+        self.category = None
+
+
+def _copy(node):
+    copy = _Node()
+    copy.children = dict(node.children)
+    copy.category = node.category
+    return copy
+
+
+def _prune(path, trail):
+    """Drop the empty nodes at the end of a path walked from the root"""
+    for word, parent, node in zip(reversed(path), reversed(trail[:-1]),
+                                  reversed(trail)):
+        if node.children or node.category is not None:
+            break
+        del parent.children[word]
+
+
+class Graphmaster:
+    """Trie over pattern/that/topic word paths; matching is input-bound"""
+
+    def __init__(self):
+        self.root = _Node()
+        self.size = 0
+
+    def add(self, category):
+        """Insert a category, returning the one it replaced (if any)"""
+        node = self.root
+        for word in category.path:
+            child = node.children.get(word)
+            if child is None:
+                child = node.children[word] = _Node()
+            node = child
+        previous = node.category
+        node.category = category
+        if previous is None:
+            self.size += 1
+        return previous
+
+    def get(self, path):
+        """Return the category stored at an exact pattern path"""
+        node = self.root
+        for word in path:
+            node = node.children.get(word)
+            if node is None:
+                return None
+        return node.category
+
+    def remove(self, path):
+        """Remove and return the category at an exact path, pruning empty nodes"""
+        trail = [self.root]
+        for word in path:
+            node = trail[-1].children.get(word)
+            if node is None:
+                return None
+            trail.append(node)
+        category = trail[-1].category
+        if category is None:
+            return None
+        trail[-1].category = None
+        self.size -= 1
+        _prune(path, trail)
+        return category
+
+    def update(self, changes):
+        """Apply {path: category or None} changes and publish them atomically
+
+        Nodes along changed paths are copied instead of modified and the new
+        root is swapped in with one assignment, so a match already running
+        (in another thread, or a compiled <srai> start node) keeps walking a
+        consistent trie.
+        """
+        root = _copy(self.root)
+        fresh = {id(root)}
+        size = self.size
+        for path, category in changes.items():
+            trail = [root]
+            for word in path:
+                parent = trail[-1]
+                child = parent.children.get(word)
+                if child is None:
+                    if category is None:
+                        break
+                    child = _Node()
+                elif id(child) in fresh:
+                    trail.append(child)
+                    continue
+                else:
+                    child = _copy(child)
+                parent.children[word] = child
+                fresh.add(id(child))
+                trail.append(child)
+            else:
+                previous = trail[-1].category
+                trail[-1].category = category
+                size += (category is not None) - (previous is not None)
+                if category is None:
+                    _prune(path, trail)
+        self.root = root
+        self.size = size
+
+    def categories(self):
+        """Yield every stored category"""
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            if node.category is not None:
+                yield node.category
+            stack.extend(node.children.values())
+
+    def to_tree(self, index):
+        """Export the trie as nested [category index, {word: subtree}] lists"""
+        def export(node):
+            category = -1 if node.category is None else index[id(node.category)]
+            return [category, {word: export(child)
+                               for word, child in node.children.items()}]
+        return export(self.root)
+
+    @classmethod
+    def from_tree(cls, tree, categories):
+        """Rebuild a graphmaster from to_tree() output and its category table"""
+        graphmaster = cls()
+
+        def restore(subtree):
+            node = _Node()
+            category, children = subtree
+            if category >= 0:
+                node.category = categories[category]
+                graphmaster.size += 1
+            node.children = {word: restore(child)
+                             for word, child in children.items()}
+            return node
+
+        graphmaster.root = restore(tree)
+        return graphmaster
+
+    def match(self, words, that, topic, start=None):
+        """Match normalized input, that and topic words; return a Match or None
+
+        start resumes matching at a node already reached by exact words
+        (see compiler.Srai); words then holds only the remaining input.
+        """
+        path = list(words) + [THAT] + list(that) + [TOPIC] + list(topic)
+        # Index of the segment boundary each position may extend a wildcard to
+        bounds = [0] * (len(path) + 1)
+        end = len(path)
+        for i in range(len(path) - 1, -1, -1):
+            if path[i] in SEPARATORS:
+                end = i
+            bounds[i] = end
+        bounds[len(path)] = len(path)
+        spans = []
+        category = self._match(start or self.root, path, 0, bounds, spans, 0)
+        if category is None:
+            return None
+        stars = ([], [], [])
+        for segment, start, stop in spans:
+            stars[segment].append(" ".join(path[start:stop]))
+        return Match(category, *stars)
+
+    def _match(self, node, path, i, bounds, spans, segment):
+        if i == len(path):
+            if node.category is not None:
+                return node.category
+            for key in ZERO_OR_MORE:
+                child = node.children.get(key)
+                if child is not None and child.category is not None:
+                    spans.append((segment, i, i))
+                    return child.category
+            return None
+        word = path[i]
+        children = node.children
+        if word in SEPARATORS:
+            found = self._zero_width(children, "#", path, i, bounds, spans, segment)
+            if found is None:
+                child = children.get(word)
+                if child is not None:
+                    found = self._match(child, path, i + 1, bounds, spans,
+                                        segment + 1)
+            if found is None:
+                found = self._zero_width(children, "^", path, i, bounds, spans,
+                                         segment)
+            return found
+        child = children.get("$" + word)
+        if child is not None:
+            found = self._match(child, path, i + 1, bounds, spans, segment)
+            if found is not None:
+                return found
+        found = self._wildcard(children, "#", 0, path, i, bounds, spans, segment)
+        if found is None:
+            found = self._wildcard(children, "_", 1, path, i, bounds, spans,
+                                   segment)
+        if found is None:
+            child = children.get(word)
+            if child is not None:
+                found = self._match(child, path, i + 1, bounds, spans, segment)
+        if found is None:
+            found = self._wildcard(children, "^", 0, path, i, bounds, spans,
+                                   segment)
+        if found is None:
+            found = self._wildcard(children, "*", 1, path, i, bounds, spans,
+                                   segment)
+        return found
+
+    def _wildcard(self, children, key, minimum, path, i, bounds, spans, segment):
+        child = children.get(key)
+        if child is None:
+            return None
+        for j in range(i + minimum, bounds[i] + 1):
+            spans.append((segment, i, j))
+            found = self._match(child, path, j, bounds, spans, segment)
+            if found is not None:
+                return found
+            spans.pop()
+        return None
+
+    def _zero_width(self, children, key, path, i, bounds, spans, segment):
+        child = children.get(key)
+        if child is None:
+            return None
+        spans.append((segment, i, i))
+        found = self._match(child, path, i, bounds, spans, segment)
+        if found is None:
+            spans.pop()
+        return found
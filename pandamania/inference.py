@@ -0,0 +1,208 @@
+"""
+PandaMania Inference
+Incremental forward chaining over a session's knowledge base triples
+"""
+
+from .triples import TripleStore, term_key
+
+# Derived facts kept per session; inference stops adding beyond this
+DEFAULT_INFERENCE_LIMIT = 10000
+
+
+class Rule:
+    """Horn rule over predicates, joined on the shared middle term
+
+    body (first,): x first y => x head y
+    body (first, second): x first y and y second z => x head z
+    """
+
+    __slots__ = ("first", "second", "head")
+
+    def __init__(self, body, head):
+        keys = [term_key(predicate) for predicate in body]
+        if not 1 <= len(keys) <= 2 or not all(keys) or not term_key(head):
+            raise ValueError(f"bad rule {body!r} => {head!r}")
+        self.first = keys[0]
+        self.second = keys[1] if len(keys) == 2 else None
+        self.head = term_key(head)
+
+    def __eq__(self, other):
+        return isinstance(other, Rule) and (
+            self.first, self.second, self.head) == (
+            other.first, other.second, other.head)
+
+    def __repr__(self):
+        body = self.first if self.second is None else f"{self.first} {self.second}"
+        return f"<Rule {body} => {self.head}>"
+
+    def consequences(self, store, triple):
+        """Facts this rule derives from one new triple and the store"""
+        s, p, o = triple
+        if self.second is None:
+            if p == self.first:
+                yield s, self.head, o
+            return
+        # The new triple as the first premise, then as the second
+        if p == self.first:
+            for z in store.objects(o, self.second):
+                yield s, self.head, z
+        if p == self.second:
+            for x in store.subjects(self.first, s):
+                yield x, self.head, o
+
+
+# Transitive is-a, and has inherited through is-a
+DEFAULT_RULES = (Rule(("isa", "isa"), "isa"), Rule(("isa", "has"), "has"))
+
+
+class KnowledgeBase(TripleStore):
+    """Triple store that keeps the consequences of its rules materialized
+
+    Evaluation is semi-naive: each fact, stated or derived, is joined once
+    against the store when it arrives, so a new fact costs work in
+    proportion to what it derives rather than to the size of the store.
+    Derived facts are capped at limit; saturated records that the cap cut
+    inference short. Retracting a stated fact re-derives from scratch.
+
+    base is an optional read-only KnowledgeBase (shared domain knowledge)
+    layered underneath: queries see both, rules join across both, and
+    facts the base already holds are never copied into this one.
+    """
+
+    __slots__ = ("rules", "derived", "limit", "saturated", "base")
+
+    def __init__(self, rules=DEFAULT_RULES, limit=DEFAULT_INFERENCE_LIMIT,
+                 base=None):
+        super().__init__()
+        self.rules = list(rules)
+        self.derived = {}
+        self.limit = limit
+        self.saturated = False
+        self.base = base
+
+    def __contains__(self, triple):
+        return super().__contains__(triple) or (
+            self.base is not None and triple in self.base)
+
+    def name(self, key):
+        if key in self.names or self.base is None:
+            return self.names.get(key, key)
+        return self.base.name(key)
+
+    def stated(self, subject, predicate, obj):
+        """Display spelling of a fact, as persisted"""
+        return tuple(self.name(term_key(term))
+                     for term in (subject, predicate, obj))
+
+    def is_inferred(self, triple):
+        """Whether a fact (as term keys) was derived rather than stated"""
+        return triple in self.derived or (
+            self.base is not None and self.base.is_inferred(triple))
+
+    def load(self, facts, rules=()):
+        """Add stored facts and rules, deriving their consequences once"""
+        self.rules.extend(rule for rule in rules if rule not in self.rules)
+        self.extend(facts)
+        self._propagate(self._known())
+
+    def tell(self, subject, predicate, obj):
+        """State a fact and derive its consequences; False if already stated"""
+        key = tuple(term_key(term) for term in (subject, predicate, obj))
+        if not self.add(subject, predicate, obj):
+            if key not in self.derived:
+                return False
+            # Already derived, so its consequences are in place
+            del self.derived[key]
+            return True
+        self._propagate([key])
+        return True
+
+    def retract(self, subject, predicate, obj):
+        """Withdraw a stated fact and whatever no longer follows"""
+        key = tuple(term_key(term) for term in (subject, predicate, obj))
+        if key in self.derived or not self._delete(*key):
+            return False
+        self._rederive()
+        return True
+
+    def _insert(self, s, p, o):
+        base = self.base
+        if base is not None and o in base.spo.get(s, {}).get(p, ()):
+            return False
+        return super()._insert(s, p, o)
+
+    def objects(self, s, p):
+        found = super().objects(s, p)
+        return found if self.base is None else found + self.base.objects(s, p)
+
+    def subjects(self, p, o):
+        found = super().subjects(p, o)
+        return found if self.base is None else found + self.base.subjects(p, o)
+
+    def match(self, subject=None, predicate=None, obj=None):
+        """TripleStore.match over this store and then the base"""
+        yield from super().match(subject, predicate, obj)
+        if self.base is not None:
+            yield from self.base.match(subject, predicate, obj)
+
+    def add_rule(self, rule):
+        """Add a rule and apply it to the facts already known"""
+        if rule in self.rules:
+            return False
+        self.rules.append(rule)
+        self._propagate(self._known())
+        return True
+
+    def _known(self):
+        """Facts to join from scratch: the base's only under rules it lacks"""
+        facts = list(TripleStore.match(self))
+        base = self.base
+        if base is not None and any(r not in base.rules for r in self.rules):
+            facts += base.match()
+        return facts
+
+    def _propagate(self, queue):
+        derived, rules = self.derived, self.rules
+        while queue:
+            triple = queue.pop()
+            for rule in rules:
+                for fact in rule.consequences(self, triple):
+                    if len(derived) >= self.limit:
+                        # Facts already held do not count against the cap
+                        if fact in self:
+                            continue
+                        self.saturated = True
+                        return
+                    if self._insert(*fact):
+                        derived[fact] = None
+                        queue.append(fact)
+
+    def _rederive(self):
+        for fact in self.derived:
+            self._delete(*fact)
+        self.derived.clear()
+        self.saturated = False
+        self._propagate(self._known())
+
+    def _filtered(self, subject, predicate, obj, inferred):
+        triples = self.match(subject, predicate, obj)
+        if inferred is None:
+            return triples
+        return (t for t in triples if self.is_inferred(t) == inferred)
+
+    def values(self, subject=None, predicate=None, obj=None, slot=2,
+               inferred=None):
+        """TripleStore.values, optionally only inferred (or stated) facts"""
+        seen = dict.fromkeys(triple[slot] for triple in
+                             self._filtered(subject, predicate, obj, inferred))
+        return [self.name(key) for key in seen]
+
+    def count(self, subject=None, predicate=None, obj=None, inferred=None):
+        """TripleStore.count, optionally only inferred (or stated) facts"""
+        base = self.base
+        if inferred is None:
+            return super().count(subject, predicate, obj) + (
+                0 if base is None else base.count(subject, predicate, obj))
+        if inferred and not (subject or predicate or obj):
+            return len(self.derived) + (0 if base is None else len(base.derived))
+        return sum(1 for _ in self._filtered(subject, predicate, obj, inferred))
@@ -0,0 +1,105 @@
+"""
+PandaMania Built-in Maps
+Computed <map> functions replacing successor/increment lookup tables
+"""
+
+from decimal import Decimal, InvalidOperation
+
+from .predicates import DEFAULT_PREDICATE
+
+# increment_grip moves a grip score by one step and never past 1.00
+GRIP_STEP = Decimal("0.05")
+GRIP_MAX = Decimal("1.00")
+# Decimal operands are refused past this many digits or this exponent, since
+# results are rendered without exponent notation (1E999999 would be a
+# million characters)
+MAX_DECIMAL_DIGITS = 64
+
+
+class ComputedMap:
+    """Read-only map whose values are computed from the key on demand"""
+
+    def __init__(self, function):
+        self.function = function
+
+    def get(self, key, default=None):
+        """Compute the value for a key, or return default if it is invalid"""
+        try:
+            return self.function(key.strip())
+        except (ArithmeticError, InvalidOperation, ValueError):
+            return default
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+
+def _number(text):
+    """Parse a counter value; unset predicates count as zero
+
+    Whole numbers stay Python ints, so counters are exact at any size.
+    """
+    if text in ("", DEFAULT_PREDICATE):
+        return 0
+    try:
+        return int(text)
+    except ValueError:
+        pass
+    value = Decimal(text)
+    if (not value.is_finite() or abs(value.adjusted()) > MAX_DECIMAL_DIGITS
+            or len(value.as_tuple().digits) > MAX_DECIMAL_DIGITS):
+        raise ValueError(text)
+    return value
+
+
+def _format(value):
+    """Render a number without exponent notation"""
+    return str(value) if isinstance(value, int) else format(value, "f")
+
+
+def _operands(text):
+    left, right = text.split(":", 1)
+    return _number(left.strip()), _number(right.strip())
+
+
+def successor(text):
+    """n + 1"""
+    return _format(_number(text) + 1)
+
+
+def predecessor(text):
+    """n - 1"""
+    return _format(_number(text) - 1)
+
+
+def decrement(text):
+    """n - 1, floored at zero for counters"""
+    return _format(max(_number(text) - 1, 0))
+
+
+def add(text):
+    """a:b -> a + b"""
+    left, right = _operands(text)
+    return _format(left + right)
+
+
+def subtract(text):
+    """a:b -> a - b"""
+    left, right = _operands(text)
+    return _format(left - right)
+
+
+def increment_grip(text):
+    """Raise a grip score by GRIP_STEP, capped at GRIP_MAX"""
+    value = min(_number(text) + GRIP_STEP, GRIP_MAX)
+    return format(value.quantize(GRIP_STEP), "f")
+
+
+BUILTIN_MAPS = {
+    "successor": ComputedMap(successor),
+    "increment": ComputedMap(successor),
+    "predecessor": ComputedMap(predecessor),
+    "decrement": ComputedMap(decrement),
+    "add": ComputedMap(add),
+    "subtract": ComputedMap(subtract),
+    "increment_grip": ComputedMap(increment_grip),
+}
@@ -0,0 +1,37 @@
+"""
+PandaMania Normalization
+Shared word-level normalization for inputs, patterns and responses
+"""
+
+import re
+
+# Tokens with wildcard meaning in AIML 2.0 patterns
+WILDCARDS = ("#", "_", "^", "*")
+
+_SENTENCE_SPLIT = re.compile(r"[.!?;]+")
+_APOSTROPHES = re.compile(r"['’]")
+_NON_WORD = re.compile(r"[^0-9A-Z]+")
+
+
+def normalize_words(text):
+    """Uppercase text and split it into punctuation-free words"""
+    text = _APOSTROPHES.sub("", text.upper())
+    return _NON_WORD.sub(" ", text).split()
+
+
+def split_sentences(text):
+    """Split text into non-empty sentences"""
+    return [s.strip() for s in _SENTENCE_SPLIT.split(text) if s.strip()]
+
+
+def normalize_pattern(text):
+    """Tokenize pattern text, keeping wildcards and $-priority words intact"""
+    words = []
+    for token in text.split():
+        if token in WILDCARDS:
+            words.append(token)
+        elif token.startswith("$") and len(token) > 1:
+            words.extend("$" + w for w in normalize_words(token[1:]))
+        else:
+            words.extend(normalize_words(token))
+    return words
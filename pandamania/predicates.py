@@ -0,0 +1,136 @@
+"""
+PandaMania Predicate Stores
+Per-session predicate backends with bounded memory
+"""
+
+import sys
+
+# Value of a predicate (or property, or map entry) that was never set
+DEFAULT_PREDICATE = "unknown"
+# Predicates whose names are declared up front get fixed slots
+SCHEMA_FILE = "config.aiml"
+DEFAULT_DYNAMIC_LIMIT = 256
+
+
+def declared_names(categories):
+    """Static <set>/<get>/<condition> predicate names used by categories"""
+    names = {}
+    for category in categories:
+        for node in category.template.iter():
+            name = node.attrs.get("name")
+            if name and node.tag in ("set", "get", "condition"):
+                names[name] = None
+    return list(names)
+
+
+class PredicateSchema:
+    """Fixed, shared mapping from declared predicate names to slot numbers"""
+
+    __slots__ = ("names", "index")
+
+    def __init__(self, names=()):
+        self.names = tuple(dict.fromkeys(sys.intern(n) for n in names))
+        self.index = {name: i for i, name in enumerate(self.names)}
+
+    def __len__(self):
+        return len(self.names)
+
+
+class DictStore:
+    """Plain unbounded dict backend, for tests and single-user tools"""
+
+    __slots__ = ("values",)
+
+    def __init__(self, schema=None, limit=None):
+        self.values = {}
+
+    def get(self, name, default=None):
+        return self.values.get(name, default)
+
+    def set(self, name, value):
+        self.values[name] = value
+
+    def delete(self, name):
+        self.values.pop(name, None)
+
+    def items(self):
+        return list(self.values.items())
+
+    def update(self, values):
+        for name, value in values.items():
+            self.set(name, value)
+
+    @property
+    def evictions(self):
+        return 0
+
+    def __len__(self):
+        return len(self.values)
+
+    def __contains__(self, name):
+        return name in self.values
+
+
+class SlotStore:
+    """Declared predicates in fixed slots, other names in a capped overflow
+
+    Overflow names are interned so every session shares one key object, and
+    the least recently written overflow entry is evicted beyond the limit.
+    """
+
+    __slots__ = ("schema", "slots", "overflow", "limit", "evictions")
+
+    def __init__(self, schema, limit=DEFAULT_DYNAMIC_LIMIT):
+        self.schema = schema
+        self.slots = [None] * len(schema)
+        self.overflow = {}
+        self.limit = limit
+        self.evictions = 0
+
+    def get(self, name, default=None):
+        slot = self.schema.index.get(name)
+        if slot is not None:
+            value = self.slots[slot]
+            return default if value is None else value
+        return self.overflow.get(name, default)
+
+    def set(self, name, value):
+        slot = self.schema.index.get(name)
+        if slot is not None:
+            self.slots[slot] = value
+            return
+        overflow = self.overflow
+        if overflow.pop(name, None) is None:
+            name = sys.intern(name)
+            if self.limit is not None and len(overflow) >= self.limit:
+                del overflow[next(iter(overflow))]
+                self.evictions += 1
+        overflow[name] = value
+
+    def delete(self, name):
+        slot = self.schema.index.get(name)
+        if slot is not None:
+            self.slots[slot] = None
+        else:
+            self.overflow.pop(name, None)
+
+    def items(self):
+        fixed = [(name, value) for name, value in zip(self.schema.names, self.slots)
+                 if value is not None]
+        return fixed + list(self.overflow.items())
+
+    def update(self, values):
+        for name, value in values.items():
+            self.set(name, value)
+
+    def __len__(self):
+        return len(self.overflow) + sum(v is not None for v in self.slots)
+
+    def __contains__(self, name):
+        return self.get(name) is not None
+
+
+BACKENDS = {
+    "slots": SlotStore,
+    "dict": DictStore,
+}
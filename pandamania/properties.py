@@ -0,0 +1,22 @@
+"""
+PandaMania Properties
+Reader for the key:value bot.properties format
+"""
+
+
+def parse_properties(text):
+    """Parse key:value lines, skipping blanks and # comments"""
+    properties = {}
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or line.startswith("#") or ":" not in line:
+            continue
+        key, value = line.split(":", 1)
+        properties[key.strip()] = value.strip()
+    return properties
+
+
+def load_properties(path):
+    """Load a bot.properties file into a dict"""
+    with open(path, encoding="utf-8") as f:
+        return parse_properties(f.read())
@@ -0,0 +1,164 @@
+"""
+PandaMania Replay
+Batch replay of logged (session, input) turns for offline scoring
+"""
+
+import json
+import multiprocessing
+import pickle
+import queue
+import traceback
+
+from .workers import affinity
+
+DEFAULT_BATCH_SIZE = 256
+# Batches buffered per worker before the reader blocks (bounds memory)
+QUEUE_DEPTH = 8
+
+
+def read_turns(lines):
+    """Yield (line number, session, input) from JSONL; bad lines yield errors"""
+    for number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+            session, text = str(record["session"]), record["input"]
+            if not isinstance(text, str):
+                raise TypeError("input must be a string")
+        except (ValueError, KeyError, TypeError) as e:
+            yield number, None, f"invalid record: {e}"
+            continue
+        yield number, session, text
+
+
+def replay_turn(bot, number, session, text):
+    """Run one logged turn and build its output record"""
+    if session is None:
+        return {"line": number, "error": text}
+    trace = []
+    response = bot.respond(text, session, trace)
+    chain = [category.id for category in trace]
+    return {"line": number, "session": session, "input": text,
+            "response": response, "category": chain[0] if chain else None,
+            "chain": chain}
+
+
+class WorkerError:
+    """What a replay worker sends back instead of results when it fails"""
+
+    def __init__(self, error):
+        self.text = "".join(traceback.format_exception(error))
+        try:
+            pickle.dumps(error)
+        except Exception:
+            error = RuntimeError(str(error))
+        self.error = error
+
+
+def _replay_worker(bot, inbox, outbox):
+    """Process batches for the sessions this worker owns, in arrival order
+
+    Sends None once its inbox ends, or a WorkerError if anything raised.
+    """
+    try:
+        while True:
+            batch = inbox.get()
+            if batch is None:
+                break
+            outbox.put([replay_turn(bot, *turn) for turn in batch])
+        bot.close()
+    except Exception as e:
+        outbox.put(WorkerError(e))
+        return
+    outbox.put(None)
+
+
+def replay(bot, lines, workers=1, batch_size=DEFAULT_BATCH_SIZE):
+    """Replay turns, yielding output records
+
+    Every turn of a session goes to the same worker in input order, so
+    predicates carry over exactly as in a live conversation. With several
+    workers, records of different sessions may come back out of input order;
+    each record carries its input line number. An exception in a worker
+    is raised here, chained to a RuntimeError carrying its traceback.
+    """
+    if workers <= 1:
+        for turn in read_turns(lines):
+            yield replay_turn(bot, *turn)
+        return
+    context = multiprocessing.get_context("fork")
+    outbox = context.Queue()
+    inboxes = [context.Queue(QUEUE_DEPTH) for _ in range(workers)]
+    processes = [context.Process(target=_replay_worker,
+                                 args=(bot, inbox, outbox), daemon=True)
+                 for inbox in inboxes]
+    for process in processes:
+        process.start()
+    batches = [[] for _ in range(workers)]
+    finished = 0
+    try:
+        for turn in read_turns(lines):
+            index = affinity(turn[1] or "", workers)
+            batches[index].append(turn)
+            if len(batches[index]) >= batch_size:
+                finished += yield from _put(inboxes[index], batches[index],
+                                            outbox, processes)
+                batches[index] = []
+        # Every batch is queued before any worker is told to stop
+        for inbox, batch in zip(inboxes, batches):
+            if batch:
+                finished += yield from _put(inbox, batch, outbox, processes)
+        for inbox in inboxes:
+            inbox.put(None)
+        while finished < workers:
+            finished += yield from _drain(outbox, processes, block=True)
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+            process.join()
+
+
+def _put(inbox, batch, outbox, processes):
+    """Queue a batch, draining results while the inbox is full
+
+    Returns the number of workers that finished meanwhile.
+    """
+    finished = 0
+    while True:
+        try:
+            inbox.put(batch, timeout=0.05)
+            break
+        except queue.Full:
+            pass
+        finished += yield from _drain(outbox, processes)
+    finished += yield from _drain(outbox, processes)
+    return finished
+
+
+def _drain(outbox, processes, block=False):
+    """Yield results ready on outbox; the number of workers that finished
+
+    With block, waits for at least one message. A worker error is raised,
+    as is a worker process that died without reporting one.
+    """
+    finished = 0
+    while True:
+        try:
+            results = outbox.get(timeout=0.05) if block else outbox.get_nowait()
+        except queue.Empty:
+            if not block:
+                return finished
+            if any(p.exitcode not in (None, 0) for p in processes):
+                raise RuntimeError("replay worker exited early")
+            continue
+        block = False
+        if results is None:
+            finished += 1
+        elif isinstance(results, WorkerError):
+            raise results.error from RuntimeError(
+                f"replay worker failed:\n{results.text}")
+        else:
+            yield from results
@@ -0,0 +1,363 @@
+"""
+PandaMania Chat Server
+Single-process asyncio HTTP/1.1 and WebSocket front end over a shared Brain
+"""
+
+import asyncio
+import base64
+import hashlib
+import json
+import struct
+import sys
+import traceback
+import uuid
+
+from .aiml import AIMLError
+from .predicates import DEFAULT_PREDICATE
+from .telemetry import metrics_text, snapshot
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+DEFAULT_MAX_CONNECTIONS = 10000
+MAX_BODY = 64 * 1024
+MAX_HEADERS = 100
+_METRICS_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+_WS_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+_WS_TEXT, _WS_CLOSE, _WS_PING, _WS_PONG = 0x1, 0x8, 0x9, 0xA
+
+_REASONS = {
+    200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+    411: "Length Required", 413: "Payload Too Large",
+    500: "Internal Server Error", 503: "Service Unavailable",
+}
+# Body of a 500: the details go to stderr, not to the client
+_INTERNAL_ERROR = {"error": "internal server error"}
+
+
+class HTTPError(Exception):
+    """A request error reported to the client with a status code"""
+
+    def __init__(self, status, message=None):
+        super().__init__(message or _REASONS.get(status, "Error"))
+        self.status = status
+
+
+def _unmask(data, mask):
+    """XOR a client WebSocket payload with its 4-byte mask"""
+    n = len(data)
+    key = (mask * (n // 4 + 1))[:n]
+    return (int.from_bytes(data, "big") ^ int.from_bytes(key, "big")).to_bytes(
+        n, "big")
+
+
+def _frame(opcode, payload):
+    """Encode an unmasked server-to-client WebSocket frame"""
+    n = len(payload)
+    if n < 126:
+        header = struct.pack("!BB", 0x80 | opcode, n)
+    elif n < 1 << 16:
+        header = struct.pack("!BBH", 0x80 | opcode, 126, n)
+    else:
+        header = struct.pack("!BBQ", 0x80 | opcode, 127, n)
+    return header + payload
+
+
+def _log_failure(what):
+    """Report the exception being handled on stderr"""
+    print(f"{what} failed:", file=sys.stderr)
+    traceback.print_exc()
+
+
+def run_turn(bot, text, session_id=None, fresh_id=None, adopt=None):
+    """Run one turn on a bot and return the JSON-ready reply
+
+    Clients that send no session get one back: the session_id predicate if
+    the turn ran SESSION INIT (that id is free and adopt(id) allows it), else
+    fresh_id or a random id.
+    """
+    if session_id:
+        return {"session": session_id, "response": bot.respond(text, session_id)}
+    session_id = fresh_id or uuid.uuid4().hex
+    response = bot.respond(text, session_id)
+    wanted = bot.session(session_id).get("session_id")
+    if (wanted != DEFAULT_PREDICATE and not bot.has_session(wanted)
+            and (adopt is None or adopt(wanted))):
+        bot.rename_session(session_id, wanted)
+        session_id = wanted
+    return {"session": session_id, "response": response}
+
+
+class ChatServer:
+    """Serve conversations for many sessions from one event loop
+
+    Turns are evaluated inline on the loop: a turn is CPU-bound and short, so
+    there is no thread per user. Each connection handles pipelined requests
+    in order and stops reading until its responses drain (TCP backpressure),
+    and connections beyond max_connections are refused with 503.
+    """
+
+    def __init__(self, bot, host=DEFAULT_HOST, port=DEFAULT_PORT,
+                 max_connections=DEFAULT_MAX_CONNECTIONS, max_body=MAX_BODY,
+                 reload_interval=None):
+        self.bot = bot
+        self.host = host
+        self.port = port
+        self.max_connections = max_connections
+        self.max_body = max_body
+        self.reload_interval = reload_interval
+        self.connections = 0
+        self.server = None
+        self._reloader = None
+
+    async def start(self):
+        """Start listening; returns the asyncio server"""
+        self.server = await asyncio.start_server(
+            self._handle, self.host, self.port, limit=self.max_body)
+        self.port = self.server.sockets[0].getsockname()[1]
+        if self.reload_interval:
+            self._reloader = asyncio.ensure_future(self._reload_loop())
+        return self.server
+
+    async def _reload_loop(self):
+        """Poll the corpus and hot-reload changed files off the event loop
+
+        Parsing runs in a thread; the graphmaster swap is atomic, so turns
+        keep being answered (from the old trie) while a file reloads.
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.reload_interval)
+            try:
+                changed = await loop.run_in_executor(None, self.bot.brain.refresh)
+            except (AIMLError, OSError) as e:
+                # A file deleted or renamed mid-poll is retried next time
+                print(f"Reload failed: {e}", file=sys.stderr)
+                continue
+            if changed:
+                print(f"Reloaded {', '.join(changed)} "
+                      f"({self.bot.brain.size} categories)", file=sys.stderr)
+
+    async def serve_forever(self):
+        """Start (if needed) and serve until cancelled"""
+        if self.server is None:
+            await self.start()
+        async with self.server:
+            await self.server.serve_forever()
+
+    async def turn(self, text, session_id=None):
+        """Run one turn and return the JSON-ready reply"""
+        return run_turn(self.bot, text, session_id)
+
+    def health(self):
+        """Status reported by GET /health"""
+        return {"status": "ok", "sessions": len(self.bot.sessions),
+                "categories": self.bot.brain.size,
+                "connections": self.connections}
+
+    async def metrics(self):
+        """Text-format metrics reported by GET /metrics"""
+        return metrics_text([({}, snapshot(self.bot))])
+
+    async def _handle(self, reader, writer):
+        self.connections += 1
+        try:
+            if self.connections > self.max_connections:
+                writer.write(self._response(503, {"error": "server busy"}, False))
+                await writer.drain()
+                return
+            await self._serve_http(reader, writer)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self.connections -= 1
+            writer.close()
+
+    async def _serve_http(self, reader, writer):
+        while True:
+            try:
+                request = await self._read_request(reader)
+            except HTTPError as e:
+                writer.write(self._response(e.status, {"error": str(e)}, False))
+                await writer.drain()
+                return
+            if request is None:
+                return
+            method, target, headers, body = request
+            if (target == "/ws"
+                    and headers.get("upgrade", "").lower() == "websocket"):
+                await self._serve_websocket(reader, writer, headers)
+                return
+            keep_alive = headers.get("connection", "").lower() != "close"
+            try:
+                status, payload = 200, await self._dispatch(method, target, body)
+            except HTTPError as e:
+                status, payload = e.status, {"error": str(e)}
+            except Exception:
+                _log_failure(f"{method} {target}")
+                status, payload = 500, _INTERNAL_ERROR
+            writer.write(self._response(status, payload, keep_alive))
+            await writer.drain()
+            if not keep_alive:
+                return
+            # Let other connections run between pipelined requests
+            await asyncio.sleep(0)
+
+    async def _read_request(self, reader):
+        try:
+            line = await reader.readline()
+        except (asyncio.LimitOverrunError, ValueError):
+            raise HTTPError(400, "request line too long")
+        if not line:
+            return None
+        parts = line.decode("latin-1").split()
+        if len(parts) != 3:
+            raise HTTPError(400, "malformed request line")
+        method, target, _ = parts
+        headers = {}
+        while True:
+            try:
+                line = await reader.readline()
+            except (asyncio.LimitOverrunError, ValueError):
+                raise HTTPError(400, "header too long")
+            if line in (b"\r\n", b"\n", b""):
+                break
+            if len(headers) >= MAX_HEADERS:
+                raise HTTPError(400, "too many headers")
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        body = b""
+        if "transfer-encoding" in headers:
+            raise HTTPError(411, "chunked bodies are not supported")
+        if "content-length" in headers:
+            try:
+                length = int(headers["content-length"])
+            except ValueError:
+                raise HTTPError(400, "bad Content-Length")
+            if length > self.max_body:
+                raise HTTPError(413)
+            body = await reader.readexactly(length)
+        return method.upper(), target, headers, body
+
+    async def _dispatch(self, method, target, body):
+        path = target.split("?", 1)[0]
+        if path == "/health":
+            if method != "GET":
+                raise HTTPError(405)
+            return self.health()
+        if path == "/metrics":
+            if method != "GET":
+                raise HTTPError(405)
+            return await self.metrics()
+        if path == "/chat":
+            if method != "POST":
+                raise HTTPError(405)
+            return await self._chat(body)
+        raise HTTPError(404)
+
+    async def _chat(self, body, session=None):
+        """Run a /chat JSON request; session is the fallback session id"""
+        try:
+            request = json.loads(body or b"{}")
+        except ValueError:
+            raise HTTPError(400, "body must be JSON")
+        if not isinstance(request, dict) or not isinstance(
+                request.get("input"), str):
+            raise HTTPError(400, 'expected {"input": "...", "session": "..."}')
+        session = request.get("session", session)
+        if session is not None and not isinstance(session, str):
+            raise HTTPError(400, "session must be a string")
+        return await self.turn(request["input"], session)
+
+    def _response(self, status, payload, keep_alive):
+        """Encode a response: JSON, or plain text when payload is a str"""
+        if isinstance(payload, str):
+            body, kind = payload.encode("utf-8"), _METRICS_TYPE
+        else:
+            body, kind = json.dumps(payload).encode("utf-8"), "application/json"
+        head = (f"HTTP/1.1 {status} {_REASONS.get(status, 'Error')}\r\n"
+                f"Content-Type: {kind}\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n")
+        return head.encode("latin-1") + body
+
+    async def _serve_websocket(self, reader, writer, headers):
+        key = headers.get("sec-websocket-key")
+        if not key:
+            writer.write(self._response(400, {"error": "missing key"}, False))
+            await writer.drain()
+            return
+        accept = base64.b64encode(
+            hashlib.sha1((key + _WS_GUID).encode("ascii")).digest()).decode()
+        writer.write(("HTTP/1.1 101 Switching Protocols\r\n"
+                      "Upgrade: websocket\r\nConnection: Upgrade\r\n"
+                      f"Sec-WebSocket-Accept: {accept}\r\n\r\n").encode("ascii"))
+        await writer.drain()
+        session = None
+        while True:
+            opcode, payload = await self._read_message(reader)
+            if opcode == _WS_CLOSE:
+                writer.write(_frame(_WS_CLOSE, payload[:2]))
+                await writer.drain()
+                return
+            if opcode == _WS_PING:
+                writer.write(_frame(_WS_PONG, payload))
+            elif opcode == _WS_TEXT:
+                reply = await self._ws_turn(payload.decode("utf-8", "replace"),
+                                            session)
+                session = reply.get("session", session)
+                writer.write(_frame(_WS_TEXT, json.dumps(reply).encode("utf-8")))
+            await writer.drain()
+            await asyncio.sleep(0)
+
+    async def _ws_turn(self, text, session):
+        """Handle one WebSocket message: JSON like /chat, or plain input text"""
+        try:
+            if not text.lstrip().startswith("{"):
+                return await self.turn(text, session)
+            return await self._chat(text.encode("utf-8"), session)
+        except HTTPError as e:
+            return {"error": str(e)}
+        except Exception:
+            _log_failure("WebSocket turn")
+            return _INTERNAL_ERROR
+
+    async def _read_message(self, reader):
+        """Read one (possibly fragmented) WebSocket message"""
+        message, message_opcode = [], None
+        while True:
+            b1, b2 = await reader.readexactly(2)
+            opcode, length = b1 & 0x0F, b2 & 0x7F
+            if length == 126:
+                length = struct.unpack("!H", await reader.readexactly(2))[0]
+            elif length == 127:
+                length = struct.unpack("!Q", await reader.readexactly(8))[0]
+            if length > self.max_body:
+                raise ConnectionError("WebSocket frame too large")
+            mask = await reader.readexactly(4) if b2 & 0x80 else None
+            data = await reader.readexactly(length)
+            if mask:
+                data = _unmask(data, mask)
+            if opcode >= 0x8:
+                return opcode, data
+            if opcode:
+                message_opcode = opcode
+            message.append(data)
+            if sum(map(len, message)) > self.max_body:
+                raise ConnectionError("WebSocket message too large")
+            if b1 & 0x80:
+                return message_opcode, b"".join(message)
+
+
+def serve(server):
+    """Run a ChatServer until interrupted"""
+    async def main():
+        await server.start()
+        print(f"PandaMania serving {server.bot.brain.size} categories on "
+              f"http://{server.host}:{server.port} (POST /chat, GET /ws)")
+        await server.serve_forever()
+
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
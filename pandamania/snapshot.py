@@ -0,0 +1,242 @@
+"""
+PandaMania Brain Snapshots
+Versioned, pickle-free binary snapshots of a compiled Brain
+"""
+
+import hashlib
+import marshal
+import os
+import struct
+import sys
+
+from .aiml import Category
+from .brain import (DEFAULT_CORPUS, PROPERTIES_FILE, Brain, discover_files,
+                    file_stamp)
+from .compiler import Srai
+from .graphmaster import Graphmaster, Match
+from .predicates import PredicateSchema
+from .template import Node
+
+MAGIC = b"PMBRAIN\0"
+FORMAT_VERSION = 4
+DEFAULT_SNAPSHOT = "brain.snapshot"
+
+# marshal output is only stable within one interpreter version, so the
+# snapshot records both its own format version and the Python version
+_HEADER = struct.Struct("<8sHBB32s")
+
+
+class SnapshotError(Exception):
+    """Raised when a snapshot is missing, corrupt, stale or incompatible"""
+
+
+def corpus_files(directory=DEFAULT_CORPUS):
+    """Every file whose content a compiled brain depends on"""
+    files = discover_files(directory)
+    properties = os.path.join(directory, PROPERTIES_FILE)
+    if os.path.exists(properties):
+        files.append(properties)
+    return files
+
+
+def corpus_digest(directory=DEFAULT_CORPUS, files=None):
+    """SHA-256 over the names and contents of every corpus file"""
+    digest = hashlib.sha256()
+    for path in files if files is not None else corpus_files(directory):
+        with open(path, "rb") as f:
+            data = f.read()
+        name = os.path.basename(path).encode("utf-8")
+        digest.update(struct.pack("<II", len(name), len(data)))
+        digest.update(name)
+        digest.update(data)
+    return digest.digest()
+
+
+def _encode_node(node, index, calls):
+    """Template tuple; a compiled <srai> also carries its link
+
+    Calls are numbered in calls as they are encoded, children first.
+    """
+    children = [child if isinstance(child, str)
+                else _encode_node(child, index, calls)
+                for child in node.children]
+    if not isinstance(node, Srai):
+        return (node.tag, node.attrs, children)
+    calls[id(node)] = len(calls)
+    tail = node.tail
+    if tail is not None:
+        # The tail is an optional partial word and then children[i:]
+        glued = isinstance(tail[0], str)
+        tail = (tail[0] if glued else "", len(node.children) - len(tail) + glued)
+    start, target, guard = node.link
+    if target is not None:
+        target = (index[id(target.category)], target.stars)
+    return (node.tag, node.attrs, children,
+            (node.words, tail, start is not None, target, sorted(guard)))
+
+
+def _decode_node(data, calls):
+    """Template from _encode_node(); compiled calls are appended to calls
+
+    Each call comes with its stored link, resolved later by _link().
+    """
+    children = [child if isinstance(child, str) else _decode_node(child, calls)
+                for child in data[2]]
+    if len(data) == 3:
+        return Node(data[0], data[1], children)
+    words, tail, started, target, guard = data[3]
+    if tail is not None:
+        glued, i = tail
+        tail = ([glued] if glued else []) + children[i:]
+    call = Srai.restore(data[1], children, words, tail, None)
+    calls.append((call, started, target, guard))
+    return call
+
+
+def _link(graphmaster, categories, calls):
+    """Publish the stored links of decoded calls"""
+    for call, started, target, guard in calls:
+        start = None
+        if started:
+            start = graphmaster.root
+            for word in call.words:
+                start = start.children[word]
+        if target is not None:
+            target = Match(categories[target[0]], target[1], [], [])
+        call.link = (start, target, frozenset(map(tuple, guard)))
+
+
+def dumps(brain, digest):
+    """Serialize a brain to snapshot bytes"""
+    # Every source category, shadowed ones included, so hot reloads of a
+    # snapshot-loaded brain can restore them
+    categories = [c for source in brain.sources.values() for c in source]
+    known = set(map(id, categories))
+    categories += [c for c in brain.graphmaster.categories() if id(c) not in known]
+    index = {id(category): i for i, category in enumerate(categories)}
+    calls = {}
+    encoded = [(tuple(c.pattern), tuple(c.that), tuple(c.topic),
+                _encode_node(c.template, index, calls), c.filename, c.line)
+               for c in categories]
+    topics, that_patterns = brain.link_context
+    payload = {
+        "properties": brain.properties,
+        "files": brain.files,
+        "declared": brain.declared,
+        "categories": encoded,
+        "trie": brain.graphmaster.to_tree(index),
+        # Everything Brain.compile() derives, so loading never recompiles
+        "calls": [calls[id(call)] for call in brain.calls],
+        "topics": sorted(topics),
+        "that_patterns": that_patterns,
+        "fillers": {word: index[id(c)] for word, c in brain.fillers.items()},
+        "conjunctions": [
+            (index[id(c)], word, calls[id(first)], calls[id(rest)])
+            for c, (word, first, rest) in brain.conjunctions.items()],
+        "pure": [index[id(c)] for c in brain.pure],
+    }
+    header = _HEADER.pack(MAGIC, FORMAT_VERSION, sys.version_info[0],
+                          sys.version_info[1], digest)
+    return header + marshal.dumps(payload)
+
+
+def loads(data, digest=None):
+    """Rebuild a brain from snapshot bytes, checking version and digest
+
+    Templates come back compiled and their <srai> calls linked as they were
+    saved, so no template is recompiled or relinked.
+    """
+    if len(data) < _HEADER.size:
+        raise SnapshotError("snapshot truncated")
+    magic, version, major, minor, stored = _HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise SnapshotError("not a PandaMania brain snapshot")
+    if version != FORMAT_VERSION or (major, minor) != sys.version_info[:2]:
+        raise SnapshotError(f"snapshot format {version} for Python {major}.{minor}"
+                            " is incompatible")
+    if digest is not None and stored != digest:
+        raise SnapshotError("snapshot is stale: corpus content changed")
+    try:
+        return _build(marshal.loads(memoryview(data)[_HEADER.size:]))
+    except (EOFError, ValueError, TypeError, KeyError, IndexError,
+            AttributeError) as e:
+        raise SnapshotError(f"snapshot corrupt: {e!r}") from e
+
+
+def _build(payload):
+    """Brain from an unmarshalled payload; malformed ones raise as they go"""
+    calls = []
+    categories = [
+        Category(list(pattern), list(that), list(topic),
+                 _decode_node(template, calls), filename, line)
+        for pattern, that, topic, template, filename, line in payload["categories"]
+    ]
+    brain = Brain(payload["properties"])
+    brain.sources = {name: [] for name in payload["files"]}
+    for category in categories:
+        brain.sources.setdefault(category.filename, []).append(category)
+    brain.index()
+    brain.declared = payload["declared"]
+    brain.graphmaster = Graphmaster.from_tree(payload["trie"], categories)
+    _link(brain.graphmaster, categories, calls)
+    brain.calls = [calls[i][0] for i in payload["calls"]]
+    topics = {tuple(topic) for topic in payload["topics"]}
+    brain.that_patterns = payload["that_patterns"]
+    brain.link_context = (topics, brain.that_patterns)
+    brain.fillers = {word: categories[i]
+                     for word, i in payload["fillers"].items()}
+    brain.conjunctions = {
+        categories[i]: (word, calls[first][0], calls[rest][0])
+        for i, word, first, rest in payload["conjunctions"]}
+    brain.pure = {categories[i] for i in payload["pure"]}
+    brain.schema = PredicateSchema(["topic"] + brain.declared)
+    brain.generation += 1
+    return brain
+
+
+def save(brain, path, digest):
+    """Atomically write a snapshot file"""
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(dumps(brain, digest))
+    os.replace(tmp, path)
+
+
+def load(path, digest=None):
+    """Read a snapshot file; raise SnapshotError if unusable"""
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+    except OSError as e:
+        raise SnapshotError(f"cannot read snapshot: {e}") from e
+    return loads(data, digest)
+
+
+def compile_brain(directory=DEFAULT_CORPUS, path=None):
+    """Parse the corpus and write its snapshot; return the brain"""
+    path = path or os.path.join(directory, DEFAULT_SNAPSHOT)
+    digest = corpus_digest(directory)
+    brain = Brain.load(directory)
+    save(brain, path, digest)
+    return brain
+
+
+def load_brain(directory=DEFAULT_CORPUS, path=None):
+    """Load the snapshot if it matches the corpus, recompiling it otherwise"""
+    path = path or os.path.join(directory, DEFAULT_SNAPSHOT)
+    # Stamp before hashing: a file edited in between looks changed to the
+    # next Brain.refresh() rather than silently current
+    stamps = {os.path.basename(p): file_stamp(p) for p in discover_files(directory)}
+    try:
+        brain = load(path, corpus_digest(directory))
+    except SnapshotError:
+        pass
+    else:
+        brain.directory = directory
+        brain.stamps = stamps
+        return brain
+    try:
+        return compile_brain(directory, path)
+    except OSError:
+        # Read-only deployments still get a working, if slower, brain
+        return Brain.load(directory)
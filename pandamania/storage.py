@@ -0,0 +1,221 @@
+"""
+PandaMania Storage
+Durable knowledge base facts, rules and session snapshots in SQLite (WAL
+mode), and a bulk importer for preloading domain knowledge from CSV or
+JSONL triples
+"""
+
+import csv
+import json
+import os
+import sqlite3
+import time
+from itertools import groupby
+
+from .inference import KnowledgeBase, Rule
+
+# Graph of the domain knowledge every session's knowledge base sits on
+SHARED_GRAPH = ""
+# Facts the shared graph may derive when it is loaded
+SHARED_INFERENCE_LIMIT = 1000000
+# Page cache per connection; bulk imports slow down once the index outgrows it
+CACHE_KIB = 65536
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS facts (
+    graph TEXT NOT NULL, subject TEXT NOT NULL, predicate TEXT NOT NULL,
+    object TEXT NOT NULL, PRIMARY KEY (graph, subject, predicate, object)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS rules (
+    graph TEXT NOT NULL, body TEXT NOT NULL, head TEXT NOT NULL,
+    PRIMARY KEY (graph, body, head)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS sessions (
+    id TEXT PRIMARY KEY, state TEXT NOT NULL, saved REAL NOT NULL
+);
+"""
+_ADD_FACT = "INSERT OR IGNORE INTO facts VALUES (?, ?, ?, ?)"
+_DELETE_FACT = ("DELETE FROM facts WHERE graph = ? AND subject = ?"
+                " AND predicate = ? AND object = ?")
+_ADD_RULE = "INSERT OR IGNORE INTO rules VALUES (?, ?, ?)"
+_SAVE_SESSION = "INSERT OR REPLACE INTO sessions VALUES (?, ?, ?)"
+_HEADER = ["subject", "predicate", "object"]
+
+
+class Storage:
+    """Facts and rules of every knowledge base, one graph per session id,
+    and the latest snapshot of each session the bot let go of
+
+    SHARED_GRAPH holds domain knowledge written by import_rows. Session
+    writes are queued and flush() (which the bot calls once per turn)
+    commits them as one transaction of executemany runs; sqlite3 keeps
+    their prepared statements cached. A process reopens the database after
+    a fork, so pre-forked workers never share a connection.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.pending = []
+        self._db = None
+        self._pid = None
+        self._inherited = []
+
+    @property
+    def db(self):
+        """This process's connection, opened on first use"""
+        if self._pid != os.getpid():
+            if self._db is not None:
+                # Closing a connection inherited across fork could release
+                # the parent's locks, so keep it referenced instead
+                self._inherited.append(self._db)
+            db = sqlite3.connect(self.path, isolation_level=None,
+                                 check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute(f"PRAGMA cache_size=-{CACHE_KIB}")
+            db.executescript(_SCHEMA)
+            self._db, self._pid = db, os.getpid()
+        return self._db
+
+    def close(self):
+        """Commit pending writes and close the connection"""
+        self.flush()
+        if self._db is not None and self._pid == os.getpid():
+            self._db.close()
+        self._db = self._pid = None
+
+    def facts(self, graph):
+        """(subject, predicate, object) rows stored for a graph"""
+        return self.db.execute(
+            "SELECT subject, predicate, object FROM facts WHERE graph = ?",
+            (graph,)).fetchall()
+
+    def rules(self, graph):
+        """Rules declared for a graph"""
+        return [Rule(body.split(), head) for body, head in self.db.execute(
+            "SELECT body, head FROM rules WHERE graph = ?", (graph,))]
+
+    def knowledge(self, graph=SHARED_GRAPH, limit=SHARED_INFERENCE_LIMIT,
+                  base=None):
+        """A KnowledgeBase holding a graph's facts and rules"""
+        kb = KnowledgeBase(limit=limit, base=base)
+        kb.load(self.facts(graph), self.rules(graph))
+        return kb
+
+    def add(self, graph, triple):
+        """Queue a stated fact for the next flush"""
+        self.pending.append((_ADD_FACT, (graph, *triple)))
+
+    def remove(self, graph, triple):
+        """Queue a fact's removal for the next flush"""
+        self.pending.append((_DELETE_FACT, (graph, *triple)))
+
+    def add_rule(self, graph, rule):
+        """Queue a declared rule for the next flush"""
+        body = rule.first if rule.second is None else f"{rule.first} {rule.second}"
+        self.pending.append((_ADD_RULE, (graph, body, rule.head)))
+
+    def save_session(self, session_id, state):
+        """Queue a JSON-ready session snapshot for the next flush"""
+        self.pending.append((_SAVE_SESSION, (session_id, json.dumps(state),
+                                             time.time())))
+
+    def load_session(self, session_id):
+        """The last snapshot saved for a session id, or None"""
+        self.flush()
+        row = self.db.execute("SELECT state FROM sessions WHERE id = ?",
+                              (session_id,)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def has_session(self, session_id):
+        """Whether a snapshot was saved for a session id"""
+        self.flush()
+        return self.db.execute("SELECT 1 FROM sessions WHERE id = ?",
+                               (session_id,)).fetchone() is not None
+
+    def flush(self):
+        """Commit the queued writes in one transaction"""
+        if not self.pending:
+            return
+        pending, self.pending = self.pending, []
+        with self.db as db:
+            db.execute("BEGIN")
+            # Consecutive writes of one kind share an executemany
+            for statement, writes in groupby(pending, key=lambda w: w[0]):
+                db.executemany(statement, [row for _, row in writes])
+
+    def rename(self, old, new):
+        """Move a graph and session snapshot to a new id"""
+        self.flush()
+        with self.db as db:
+            db.execute("BEGIN")
+            for table, column in (("facts", "graph"), ("rules", "graph"),
+                                  ("sessions", "id")):
+                db.execute(f"UPDATE OR IGNORE {table} SET {column} = ?"
+                           f" WHERE {column} = ?", (new, old))
+                db.execute(f"DELETE FROM {table} WHERE {column} = ?", (old,))
+
+    def import_rows(self, rows, graph=SHARED_GRAPH):
+        """Store (subject, predicate, object) rows; (rows read, facts added)
+
+        Rows stream through a single executemany in one transaction, so
+        nothing is normalized or held in memory on the way in, and a bad
+        row leaves the database as it was.
+        """
+        self.flush()
+        db = self.db
+        before = db.total_changes
+        read = [0]
+
+        def numbered():
+            for read[0], (s, p, o) in enumerate(rows, 1):
+                yield graph, s, p, o
+
+        with db:
+            db.execute("BEGIN")
+            db.executemany(_ADD_FACT, numbered())
+        return read[0], db.total_changes - before
+
+
+def _checked(path, number, row):
+    if not (isinstance(row, list) and len(row) == 3
+            and all(isinstance(term, str) and term.strip() for term in row)):
+        raise ValueError(f"{path}:{number}: expected subject, predicate, object")
+    return row
+
+
+def read_csv(path):
+    """Triples from a CSV file, skipping a subject,predicate,object header"""
+    with open(path, newline="", encoding="utf-8") as f:
+        for number, row in enumerate(csv.reader(f), 1):
+            if len(row) == 3 and row[0].strip() and row[1].strip() \
+                    and row[2].strip():
+                if number > 1 or [t.strip().lower() for t in row] != _HEADER:
+                    yield row
+            elif row:
+                _checked(path, number, row)
+
+
+def read_jsonl(path):
+    """Triples from JSONL: {"subject", "predicate", "object"} or [s, p, o]"""
+    with open(path, encoding="utf-8") as f:
+        for number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError as exc:
+                raise ValueError(f"{path}:{number}: {exc}") from None
+            if isinstance(record, dict):
+                record = [record.get(key) for key in _HEADER]
+            yield _checked(path, number, record)
+
+
+READERS = {"csv": read_csv, "jsonl": read_jsonl}
+
+
+def read_triples(path, kind=None):
+    """Triples from a file of a READERS kind, else guessed by extension"""
+    if kind is None:
+        kind = "jsonl" if path.endswith((".jsonl", ".json")) else "csv"
+    return READERS[kind](path)
@@ -0,0 +1,391 @@
+"""
+PandaMania Telemetry
+Low-overhead hot-path counters, readable by the bot as live_* properties,
+exported as text-format metrics, sampled into a JSONL turn trace and
+appended to a category coverage log
+"""
+
+import json
+import os
+import random
+import time
+from bisect import bisect_left
+from collections import Counter
+
+# <bot name="live_..."/> reads a live counter instead of a bot property
+LIVE_PREFIX = "live_"
+TOP_N = 3
+# Categories exported with their own time and hit series by /metrics
+TOP_METRICS = 10
+# Upper bounds in seconds of the sentence latency histogram buckets
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+                   0.01, 0.025, 0.05, 0.1, 0.25)
+_BOUNDS = [round(bound * 1e9) for bound in LATENCY_BUCKETS]
+# Seconds between coverage log writes while the bot is answering
+DEFAULT_COVERAGE_INTERVAL = 60
+
+
+# Numeric live_* values are whole numbers: the reply they land in is split
+# into sentences at every ".", which would break <that> matching after it
+def _us(total_ns, count):
+    return f"{round(total_ns / count / 1000)}us" if count else "0us"
+
+
+class Telemetry:
+    """Counters for one interpreter process
+
+    record() runs once per answered sentence with the categories it
+    rendered (top-level match first, then each <srai> hop); everything
+    derived (per-file totals, averages, predicate store sizes) is computed
+    only when a live_* property is read.
+    """
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.turns = 0
+        self.sentences = 0
+        self.hits = Counter()
+        # Wall time of the sentences each category answered at top level
+        self.time_ns = Counter()
+        # depths[n]: sentences answered with n <srai> hops
+        self.depths = []
+        self.match_ns = 0
+        self.render_ns = 0
+        # latency[i]: sentences taking at most LATENCY_BUCKETS[i] (last: more)
+        self.latency = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.trace_fd = None
+        self.trace_rate = 0.0
+        self.coverage_path = None
+        self.coverage_interval = None
+        # monotonic() time of the next periodic coverage write
+        self._coverage_due = None
+        # Hits per category id already appended to the coverage log
+        self._covered = Counter()
+        self._random = random.Random()
+
+    def open_trace(self, path, rate=1.0):
+        """Append a JSON record for a sampled fraction of sentences to path
+
+        Each record is one O_APPEND write, so forked workers can share the
+        file without interleaving lines.
+        """
+        self.trace_fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                                0o644)
+        self.trace_rate = rate
+
+    def sampled(self):
+        """Whether to trace the next sentence"""
+        return (self.trace_fd is not None
+                and self._random.random() < self.trace_rate)
+
+    def write_trace(self, record):
+        """Append one record to the trace log"""
+        os.write(self.trace_fd, (json.dumps(record) + "\n").encode("utf-8"))
+
+    def open_coverage(self, path, interval=DEFAULT_COVERAGE_INTERVAL):
+        """Append category hit counts to path at each write_coverage()
+
+        That is at close and, unless interval is None, from the first
+        sentence recorded interval seconds after the last write, so a
+        process that is killed loses at most that much coverage.
+        """
+        self.coverage_path = path
+        self.coverage_interval = interval
+        if interval is not None:
+            self._coverage_due = time.monotonic() + interval
+
+    def write_coverage(self):
+        """Append the hits counted since the last write as one JSON record
+
+        Like the trace log this is a single O_APPEND write, so every worker
+        process can add its own counts to the same file.
+        """
+        if self.coverage_path is None:
+            return
+        if self.coverage_interval is not None:
+            self._coverage_due = time.monotonic() + self.coverage_interval
+        totals = Counter()
+        for category, count in self.hits.items():
+            totals[category.id] += count
+        new = {cid: count - self._covered[cid] for cid, count in totals.items()
+               if count > self._covered[cid]}
+        self._covered = totals
+        if not new:
+            return
+        record = json.dumps({"time": round(time.time(), 3), "pid": os.getpid(),
+                             "hits": new})
+        fd = os.open(self.coverage_path,
+                     os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, (record + "\n").encode("utf-8"))
+        finally:
+            os.close(fd)
+
+    def record(self, chain, elapsed_ns, match_ns):
+        """Count one answered sentence"""
+        self.sentences += 1
+        self.latency[bisect_left(_BOUNDS, elapsed_ns)] += 1
+        self.hits.update(chain)
+        hops = max(0, len(chain) - 1)
+        depths = self.depths
+        while len(depths) <= hops:
+            depths.append(0)
+        depths[hops] += 1
+        self.match_ns += match_ns
+        self.render_ns += elapsed_ns - match_ns
+        if chain:
+            self.time_ns[chain[0]] += elapsed_ns
+        if (self._coverage_due is not None
+                and time.monotonic() >= self._coverage_due):
+            self.write_coverage()
+
+    def files(self):
+        """Category hits summed per source file"""
+        totals = Counter()
+        for category, count in self.hits.items():
+            totals[category.filename] += count
+        return totals
+
+    def top(self, n=TOP_METRICS):
+        """(category id, pattern, seconds, hits) of the n slowest in total"""
+        seconds, patterns = Counter(), {}
+        for category, ns in self.time_ns.items():
+            seconds[category.id] += ns / 1e9
+            patterns[category.id] = " ".join(category.pattern)
+        hits = Counter()
+        for category, count in self.hits.items():
+            hits[category.id] += count
+        return [(cid, patterns[cid], total, hits[cid])
+                for cid, total in seconds.most_common(n)]
+
+    def property(self, bot, name):
+        """Value of a live_* property, or None for an unknown name"""
+        reader = _PROPERTIES.get(name[len(LIVE_PREFIX):])
+        return None if reader is None else reader(self, bot)
+
+    def _uptime(self, bot):
+        return f"{time.monotonic() - self.started:.0f}s"
+
+    def _rate(self, bot):
+        elapsed = time.monotonic() - self.started
+        return f"{self.turns / elapsed:.0f}/s" if elapsed else "0/s"
+
+    def _srai_avg(self, bot):
+        total = sum(hops * count for hops, count in enumerate(self.depths))
+        return f"{total / self.sentences:.0f}" if self.sentences else "0"
+
+    def _srai_histogram(self, bot):
+        return " ".join(f"{hops}:{count}"
+                        for hops, count in enumerate(self.depths) if count) \
+            or "none"
+
+    def _top_categories(self, bot):
+        return "; ".join(f"{' '.join(category.pattern)} ({category.id}) x{count}"
+                         for category, count in self.hits.most_common(TOP_N)) \
+            or "none"
+
+    def _top_files(self, bot):
+        return "; ".join(f"{filename} x{count}"
+                         for filename, count in self.files().most_common(TOP_N)) \
+            or "none"
+
+    def _predicates(self, bot):
+        return str(sum(len(s.predicates) for s in bot.sessions.values()))
+
+    def _predicates_avg(self, bot):
+        sessions = bot.sessions.values()
+        if not sessions:
+            return "0"
+        return f"{sum(len(s.predicates) for s in sessions) / len(sessions):.0f}"
+
+    def _cache_hit_rate(self, bot):
+        lookups = bot.cache_hits + bot.cache_misses
+        return f"{100 * bot.cache_hits / lookups:.0f}%" if lookups else "0%"
+
+
+_PROPERTIES = {
+    "uptime": Telemetry._uptime,
+    "turns": lambda t, bot: str(t.turns),
+    "sentences": lambda t, bot: str(t.sentences),
+    "turns_per_sec": Telemetry._rate,
+    "match_avg": lambda t, bot: _us(t.match_ns, t.sentences),
+    "render_avg": lambda t, bot: _us(t.render_ns, t.sentences),
+    "srai_avg": Telemetry._srai_avg,
+    "srai_max": lambda t, bot: str(max(0, len(t.depths) - 1)),
+    "srai_histogram": Telemetry._srai_histogram,
+    "categories_hit": lambda t, bot: f"{len(t.hits)} of {bot.brain.size}",
+    "top_categories": Telemetry._top_categories,
+    "top_files": Telemetry._top_files,
+    "sessions": lambda t, bot: str(len(bot.sessions)),
+    "session_evictions": lambda t, bot: str(bot.session_evictions),
+    "predicates": Telemetry._predicates,
+    "predicates_avg": Telemetry._predicates_avg,
+    "predicate_evictions": lambda t, bot: str(
+        sum(s.predicates.evictions for s in bot.sessions.values())),
+    "hop_budget": lambda t, bot: str(bot.current_hop_budget()),
+    "budget_exhausted": lambda t, bot: str(bot.budget_exhausted),
+    "cache_hit_rate": Telemetry._cache_hit_rate,
+    "cache_entries": lambda t, bot: str(len(bot.cache)),
+}
+
+
+def turn_record(session, sentence, reply, chain, hops, start_ns, elapsed_ns,
+                match_ns, cached):
+    """Trace log record for one sentence
+
+    hops holds [chain index, start ns, end ns] for every category rendered;
+    filler hops and cache hits have no timing of their own.
+    """
+    timing = {hop[0]: hop for hop in hops if len(hop) == 3}
+    steps = []
+    for index, category in enumerate(chain):
+        step = {"category": category.id, "pattern": " ".join(category.pattern)}
+        if index in timing:
+            _, begin, end = timing[index]
+            step["start_us"] = round((begin - start_ns) / 1000, 1)
+            step["us"] = round((end - begin) / 1000, 1)
+        steps.append(step)
+    top = chain[0] if chain else None
+    return {
+        "time": round(time.time(), 3),
+        "session": session.id,
+        "input": sentence,
+        "response": reply,
+        "us": round(elapsed_ns / 1000, 1),
+        "match_us": round(match_ns / 1000, 1),
+        "cached": cached,
+        "category": top.id if top else None,
+        "pattern": " ".join(top.pattern) if top else None,
+        "file": top.filename if top else None,
+        "chain": steps,
+    }
+
+
+def read_coverage(paths):
+    """Hits per category id summed over coverage logs"""
+    hits = Counter()
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    hits.update(json.loads(line)["hits"])
+    return hits
+
+
+def snapshot(bot):
+    """JSON-ready counters of one bot, for metrics_text"""
+    telemetry = bot.telemetry or Telemetry()
+    return {
+        "uptime": time.monotonic() - telemetry.started,
+        "turns": telemetry.turns,
+        "sentences": telemetry.sentences,
+        "match_seconds": telemetry.match_ns / 1e9,
+        "render_seconds": telemetry.render_ns / 1e9,
+        "latency": telemetry.latency,
+        "depths": telemetry.depths,
+        "cache_hits": bot.cache_hits,
+        "cache_misses": bot.cache_misses,
+        "cache_entries": len(bot.cache),
+        "sessions": len(bot.sessions),
+        "session_evictions": bot.session_evictions,
+        "budget_exhausted": bot.budget_exhausted,
+        "predicates": sum(len(s.predicates) for s in bot.sessions.values()),
+        "top": telemetry.top(),
+    }
+
+
+def _escape(value):
+    return (str(value).replace("\\", "\\\\").replace('"', '\\"')
+            .replace("\n", "\\n"))
+
+
+def _series(name, labels, value):
+    if labels:
+        name += "{" + ",".join(f'{key}="{_escape(label)}"'
+                               for key, label in labels.items()) + "}"
+    return f"{name} {value:g}" if isinstance(value, float) else f"{name} {value}"
+
+
+def _histogram(name, labels, counts, bounds, total):
+    lines, running = [], 0
+    for bound, count in zip(bounds, counts):
+        running += count
+        lines.append(_series(f"{name}_bucket", {**labels, "le": f"{bound:g}"},
+                             running))
+    lines.append(_series(f"{name}_bucket", {**labels, "le": "+Inf"},
+                         sum(counts)))
+    lines.append(_series(f"{name}_sum", labels, total))
+    lines.append(_series(f"{name}_count", labels, sum(counts)))
+    return lines
+
+
+# name, type, help, reader(snapshot)
+_SIMPLE = (
+    ("pandamania_uptime_seconds", "gauge", "Seconds since the bot started",
+     lambda s: s["uptime"]),
+    ("pandamania_turns_total", "counter", "Turns answered",
+     lambda s: s["turns"]),
+    ("pandamania_turns_per_second", "gauge", "Turns per second since start",
+     lambda s: s["turns"] / s["uptime"] if s["uptime"] else 0.0),
+    ("pandamania_sentences_total", "counter", "Sentences answered",
+     lambda s: s["sentences"]),
+    ("pandamania_match_seconds_total", "counter",
+     "Time spent in graphmaster matching", lambda s: s["match_seconds"]),
+    ("pandamania_render_seconds_total", "counter",
+     "Time spent rendering templates", lambda s: s["render_seconds"]),
+    ("pandamania_cache_hits_total", "counter", "Response cache hits",
+     lambda s: s["cache_hits"]),
+    ("pandamania_cache_misses_total", "counter", "Response cache misses",
+     lambda s: s["cache_misses"]),
+    ("pandamania_cache_hit_ratio", "gauge", "Response cache hits per lookup",
+     lambda s: (s["cache_hits"] / (s["cache_hits"] + s["cache_misses"])
+                if s["cache_hits"] + s["cache_misses"] else 0.0)),
+    ("pandamania_cache_entries", "gauge", "Responses held in the cache",
+     lambda s: s["cache_entries"]),
+    ("pandamania_sessions_active", "gauge", "Sessions held in memory",
+     lambda s: s["sessions"]),
+    ("pandamania_session_evictions_total", "counter",
+     "Sessions let go of for max_sessions or session_ttl",
+     lambda s: s["session_evictions"]),
+    ("pandamania_budget_exhausted_total", "counter",
+     "Sentences cut short by the hop or turn time budget",
+     lambda s: s["budget_exhausted"]),
+    ("pandamania_predicates", "gauge", "Predicates held across sessions",
+     lambda s: s["predicates"]),
+)
+
+
+def metrics_text(snapshots):
+    """Text exposition format for [(labels, snapshot)], e.g. one per worker"""
+    lines = []
+    for name, kind, text, reader in _SIMPLE:
+        lines += [f"# HELP {name} {text}", f"# TYPE {name} {kind}"]
+        lines += [_series(name, labels, reader(s)) for labels, s in snapshots]
+
+    name = "pandamania_sentence_seconds"
+    lines += [f"# HELP {name} Time to answer one sentence",
+              f"# TYPE {name} histogram"]
+    for labels, s in snapshots:
+        lines += _histogram(name, labels, s["latency"], LATENCY_BUCKETS,
+                            s["match_seconds"] + s["render_seconds"])
+
+    name = "pandamania_srai_hops"
+    lines += [f"# HELP {name} <srai> hops taken per sentence",
+              f"# TYPE {name} histogram"]
+    for labels, s in snapshots:
+        depths = s["depths"]
+        lines += _histogram(name, labels, depths, range(len(depths)),
+                            sum(hops * n for hops, n in enumerate(depths)))
+
+    for name, kind, text, index in (
+            ("pandamania_category_seconds_total", "counter",
+             f"Time of sentences answered by the top {TOP_METRICS} categories",
+             2),
+            ("pandamania_category_hits_total", "counter",
+             "Hits (including <srai> hops) of the same categories", 3)):
+        lines += [f"# HELP {name} {text}", f"# TYPE {name} {kind}"]
+        for labels, s in snapshots:
+            for entry in s["top"]:
+                lines.append(_series(name, {**labels, "category": entry[0],
+                                            "pattern": entry[1]}, entry[index]))
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,50 @@
+"""
+PandaMania Template AST
+Lightweight element tree for compiled AIML templates
+"""
+
+import re
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+class Node:
+    """A template element: tag name, attributes and child nodes or strings"""
+
+    __slots__ = ("tag", "attrs", "children")
+
+    def __init__(self, tag, attrs=None, children=None):
+        self.tag = tag
+        self.attrs = attrs or {}
+        self.children = children if children is not None else []
+
+    def __repr__(self):
+        return f"Node({self.tag!r}, {self.attrs!r}, {self.children!r})"
+
+    def __eq__(self, other):
+        return (isinstance(other, Node) and self.tag == other.tag
+                and self.attrs == other.attrs and self.children == other.children)
+
+    def find(self, tag):
+        """Return the first direct child element with the given tag"""
+        for child in self.children:
+            if isinstance(child, Node) and child.tag == tag:
+                return child
+        return None
+
+    def iter(self):
+        """Yield this node and every descendant element, depth first"""
+        yield self
+        for child in self.children:
+            if isinstance(child, Node):
+                yield from child.iter()
+
+
+def collapse(text):
+    """Collapse runs of whitespace the way AIML renders template text"""
+    return _WHITESPACE.sub(" ", text)
+
+
+def tidy(text):
+    """Strip and collapse whitespace in rendered output, keeping <br/> lines"""
+    return "\n".join(" ".join(line.split()) for line in text.split("\n")).strip()
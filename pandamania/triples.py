@@ -0,0 +1,179 @@
+"""
+PandaMania Triple Store
+Indexed (subject, predicate, object) facts behind the knowledge base tags
+"""
+
+from collections import Counter
+
+from .normalize import normalize_words
+
+
+def term_key(text):
+    """Case- and punctuation-insensitive identity of a term ("" if empty)"""
+    if not text:
+        return ""
+    upper = text.upper()
+    words = upper.split()
+    # Plain ASCII words normalize to themselves; skip the regexes
+    if upper.isascii() and "".join(words).isalnum():
+        return " ".join(words)
+    return " ".join(normalize_words(text))
+
+
+def _prune(index, first, second):
+    """Drop index[first][second] (and index[first]) once empty"""
+    inner = index[first]
+    if not inner[second]:
+        del inner[second]
+        if not inner:
+            del index[first]
+
+
+class TripleStore:
+    """A set of triples indexed SPO, POS and OSP
+
+    Each index is nested dicts used as insertion-ordered sets, so a lookup
+    with any term bound starts from the index led by that term instead of
+    scanning. Terms compare like pattern words (case and punctuation are
+    ignored) and keep the spelling they were first stored with.
+    """
+
+    __slots__ = ("spo", "pos", "osp", "names", "counts", "size")
+
+    def __init__(self):
+        self.spo = {}
+        self.pos = {}
+        self.osp = {}
+        self.names = {}
+        # Triples per predicate, so counting one relation is O(1)
+        self.counts = Counter()
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, triple):
+        s, p, o = (term_key(term) for term in triple)
+        return o in self.spo.get(s, {}).get(p, ())
+
+    def name(self, key):
+        """Display spelling of a term key"""
+        return self.names.get(key, key)
+
+    def add(self, subject, predicate, obj):
+        """Add a triple; False if it was present or a term is empty"""
+        keys = []
+        for term in (subject, predicate, obj):
+            key = term_key(term)
+            if not key:
+                return False
+            self.names.setdefault(key, " ".join(term.split()))
+            keys.append(key)
+        return self._insert(*keys)
+
+    def extend(self, triples):
+        """add() many triples, normalizing each distinct spelling once"""
+        keys, names = {}, self.names
+        for triple in triples:
+            row = []
+            for term in triple:
+                key = keys.get(term)
+                if key is None:
+                    key = keys[term] = term_key(term)
+                    if key:
+                        names.setdefault(key, " ".join(term.split()))
+                row.append(key)
+            if all(row):
+                self._insert(*row)
+
+    def _insert(self, s, p, o):
+        """Add a triple given as term keys"""
+        objects = self.spo.setdefault(s, {}).setdefault(p, {})
+        if o in objects:
+            return False
+        objects[o] = None
+        self.pos.setdefault(p, {}).setdefault(o, {})[s] = None
+        self.osp.setdefault(o, {}).setdefault(s, {})[p] = None
+        self.counts[p] += 1
+        self.size += 1
+        return True
+
+    def remove(self, subject, predicate, obj):
+        """Remove a triple; False if it was not present"""
+        return self._delete(term_key(subject), term_key(predicate),
+                            term_key(obj))
+
+    def _delete(self, s, p, o):
+        """Remove a triple given as term keys"""
+        if o not in self.spo.get(s, {}).get(p, ()):
+            return False
+        del self.spo[s][p][o]
+        _prune(self.spo, s, p)
+        del self.pos[p][o][s]
+        _prune(self.pos, p, o)
+        del self.osp[o][s][p]
+        _prune(self.osp, o, s)
+        self.counts[p] -= 1
+        self.size -= 1
+        return True
+
+    def objects(self, s, p):
+        """Object keys of (s, p, ?) for term keys s and p"""
+        return list(self.spo.get(s, {}).get(p, ()))
+
+    def subjects(self, p, o):
+        """Subject keys of (?, p, o) for term keys p and o"""
+        return list(self.pos.get(p, {}).get(o, ()))
+
+    def match(self, subject=None, predicate=None, obj=None):
+        """Yield (s, p, o) keys of the triples matching the bound terms
+
+        None (or an empty term) matches anything.
+        """
+        s, p, o = term_key(subject), term_key(predicate), term_key(obj)
+        if s:
+            if p:
+                objects = self.spo.get(s, {}).get(p, {})
+                if o:
+                    if o in objects:
+                        yield s, p, o
+                    return
+                for o2 in objects:
+                    yield s, p, o2
+            elif o:
+                for p2 in self.osp.get(o, {}).get(s, ()):
+                    yield s, p2, o
+            else:
+                for p2, objects in self.spo.get(s, {}).items():
+                    for o2 in objects:
+                        yield s, p2, o2
+        elif p:
+            if o:
+                for s2 in self.pos.get(p, {}).get(o, ()):
+                    yield s2, p, o
+            else:
+                for o2, subjects in self.pos.get(p, {}).items():
+                    for s2 in subjects:
+                        yield s2, p, o2
+        elif o:
+            for s2, predicates in self.osp.get(o, {}).items():
+                for p2 in predicates:
+                    yield s2, p2, o
+        else:
+            for s2, relations in self.spo.items():
+                for p2, objects in relations.items():
+                    for o2 in objects:
+                        yield s2, p2, o2
+
+    def values(self, subject=None, predicate=None, obj=None, slot=2):
+        """Distinct display values of one slot (0 s, 1 p, 2 o) over a match"""
+        seen = dict.fromkeys(triple[slot] for triple in
+                             self.match(subject, predicate, obj))
+        return [self.name(key) for key in seen]
+
+    def count(self, subject=None, predicate=None, obj=None):
+        """Number of triples matching the bound terms"""
+        if not (term_key(subject) or term_key(obj)):
+            p = term_key(predicate)
+            return self.counts[p] if p else self.size
+        return sum(1 for _ in self.match(subject, predicate, obj))
@@ -0,0 +1,205 @@
+"""
+PandaMania Corpus Validator
+Parallel, cached single-parse checks of every AIML file in a corpus
+"""
+
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from .aiml import AIMLError, Category, parse_string
+from .analysis import PLACEHOLDER, probe_words
+from .brain import discover_files, file_stamp
+from .compiler import Srai
+from .graphmaster import Graphmaster
+from .maps import BUILTIN_MAPS
+from .normalize import WILDCARDS
+
+# Per-file scan results, kept in the corpus directory between runs
+DEFAULT_CACHE = ".validate-cache.json"
+# Bumped whenever the shape of a scan changes, invalidating old caches
+CACHE_VERSION = 1
+
+_UNKNOWN = ["UNKNOWN"]
+
+
+def _name(node):
+    """Static name="..." of an element, given as attribute or child element"""
+    name = node.attrs.get("name")
+    if name is None:
+        child = node.find("name")
+        if child is not None and all(isinstance(c, str) for c in child.children):
+            name = "".join(child.children).strip()
+    return name or None
+
+
+def scan(name, data):
+    """Parse one file's bytes into the JSON-ready facts the checks need"""
+    try:
+        categories = parse_string(data, name)
+    except AIMLError as e:
+        return {"file": name, "error": str(e)}
+    paths, calls, gets, sets, maps = [], [], {}, [], {}
+    for category in categories:
+        paths.append([category.pattern, category.that, category.topic,
+                      category.line])
+        for node in category.template.iter():
+            if node.tag == "srai":
+                words = probe_words(Srai(node))
+                # Calls made only of dynamic elements can reach anything
+                if any(word != PLACEHOLDER for word in words):
+                    calls.append([category.line, words, category.topic])
+            elif node.tag in ("get", "set", "map"):
+                found = _name(node)
+                if found is None or "var" in node.attrs:
+                    continue
+                if node.tag == "set":
+                    sets.append(found)
+                else:
+                    (gets if node.tag == "get" else maps).setdefault(
+                        found, category.line)
+    return {"file": name, "error": None, "categories": paths, "calls": calls,
+            "gets": gets, "sets": sorted(set(sets)), "maps": maps}
+
+
+def scan_file(path):
+    """scan() a file from disk, with the stamp and digest it was read at
+
+    A file that cannot be read is an error with no stamp, so it is never
+    taken from the cache.
+    """
+    name = os.path.basename(path)
+    try:
+        stamp = file_stamp(path)
+        with open(path, "rb") as f:
+            data = f.read()
+    except OSError as e:
+        return {"file": name, "error": f"{name}: {e}"}
+    result = scan(name, data)
+    result["stamp"] = list(stamp)
+    result["sha256"] = hashlib.sha256(data).hexdigest()
+    return result
+
+
+def _cached(path, entry):
+    """Whether a cached scan still describes a file: same stamp, or same hash"""
+    if entry is None or "stamp" not in entry:
+        return False
+    stamp = list(file_stamp(path))
+    if entry["stamp"] == stamp:
+        return True
+    with open(path, "rb") as f:
+        digest = hashlib.sha256(f.read()).hexdigest()
+    if entry["sha256"] != digest:
+        return False
+    # Touched but unchanged: refresh the stamp so the next run skips hashing
+    entry["stamp"] = stamp
+    return True
+
+
+def scan_corpus(directory, cache=DEFAULT_CACHE, workers=None):
+    """Scans of every .aiml file in a directory, parsing only changed files
+
+    Stale files are parsed in a process pool when there is more than one.
+    cache is a file name relative to directory (or None for no cache). It
+    is saved with every scan made, of valid files and failing ones alike,
+    even if the run is interrupted.
+    Returns (scans in load order, number of files parsed).
+    """
+    files = discover_files(directory)
+    cache_path = None if cache is None else os.path.join(directory, cache)
+    entries = {}
+    if cache_path is not None and os.path.exists(cache_path):
+        try:
+            with open(cache_path, encoding="utf-8") as f:
+                stored = json.load(f)
+            if stored.get("version") == CACHE_VERSION:
+                entries = stored["files"]
+        except (OSError, ValueError, KeyError):
+            entries = {}
+    stale = [path for path in files
+             if not _cached(path, entries.get(os.path.basename(path)))]
+    parsed = []
+    try:
+        if len(stale) > 1 and workers != 1:
+            with ProcessPoolExecutor(workers) as pool:
+                for result in pool.map(scan_file, stale):
+                    entries[result["file"]] = result
+                    parsed.append(result)
+        else:
+            for path in stale:
+                result = scan_file(path)
+                entries[result["file"]] = result
+                parsed.append(result)
+    finally:
+        if cache_path is not None and parsed:
+            names = [os.path.basename(path) for path in files]
+            _save_cache(cache_path, {name: entries[name] for name in names
+                                     if "stamp" in entries.get(name, {})})
+    scans = [entries[os.path.basename(path)] for path in files]
+    return scans, len(parsed)
+
+
+def _save_cache(path, entries):
+    temporary = f"{path}.{os.getpid()}.tmp"
+    with open(temporary, "w", encoding="utf-8") as f:
+        json.dump({"version": CACHE_VERSION, "files": entries}, f)
+    os.replace(temporary, path)
+
+
+def _catch_all(category):
+    """Whether a category matches any input at all (the default reply)"""
+    return all(word in WILDCARDS for word in category.pattern)
+
+
+class Report:
+    """Problems found across one corpus
+
+    errors are files that are not valid AIML; the other lists hold
+    (location, detail) warnings: <srai> text no category but the catch-all
+    matches, <get> predicates no template ever <set>s, and <map> names that
+    are not defined.
+    """
+
+    def __init__(self, scans, parsed=0):
+        self.scans = scans
+        self.parsed = parsed
+        self.errors = [s["error"] for s in scans if s["error"]]
+        valid = [s for s in scans if not s["error"]]
+        self.categories = sum(len(s["categories"]) for s in valid)
+        graphmaster = Graphmaster()
+        for s in valid:
+            for pattern, that, topic, line in s["categories"]:
+                graphmaster.add(Category(pattern, that, topic, None,
+                                         s["file"], line))
+        self.dead_srai = []
+        for s in valid:
+            for line, words, topic in s["calls"]:
+                if any(word in WILDCARDS for word in topic):
+                    topic = _UNKNOWN
+                match = graphmaster.match(words, _UNKNOWN, topic)
+                if match is None or _catch_all(match.category):
+                    self.dead_srai.append((f"{s['file']}:{line}",
+                                           " ".join(words)))
+        sets = {name for s in valid for name in s["sets"]}
+        self.unset_gets = [(f"{s['file']}:{line}", name) for s in valid
+                           for name, line in s["gets"].items()
+                           if name not in sets]
+        self.undefined_maps = [(f"{s['file']}:{line}", name) for s in valid
+                               for name, line in s["maps"].items()
+                               if name not in BUILTIN_MAPS]
+
+    @property
+    def warnings(self):
+        return self.dead_srai + self.unset_gets + self.undefined_maps
+
+    def counts(self):
+        """Categories per valid file, in load order"""
+        return {s["file"]: len(s["categories"]) for s in self.scans
+                if not s["error"]}
+
+
+def validate(directory, cache=DEFAULT_CACHE, workers=None):
+    """Scan a corpus (see scan_corpus) and check it"""
+    return Report(*scan_corpus(directory, cache, workers))
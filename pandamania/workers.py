@@ -0,0 +1,294 @@
+"""
+PandaMania Worker Pool
+Pre-forked interpreter processes sharing one brain, with session affinity
+"""
+
+import asyncio
+import gc
+import itertools
+import json
+import multiprocessing
+import os
+import signal
+import socket
+import stat
+import struct
+import sys
+import time
+import traceback
+import uuid
+import zlib
+
+from .aiml import AIMLError
+from .server import ChatServer, HTTPError, run_turn
+from .telemetry import metrics_text, snapshot
+
+_LENGTH = struct.Struct("!I")
+# Seconds a stopping worker gets to save its sessions before SIGTERM
+STOP_GRACE = 5
+# Seconds before a dead worker is replaced, so one that dies on startup
+# cannot spin the parent
+RESPAWN_DELAY = 1.0
+
+
+def affinity(session_id, size):
+    """Stable worker index for a session id"""
+    return zlib.crc32(session_id.encode("utf-8")) % size
+
+
+def _recv_exactly(sock, n):
+    chunks = []
+    while n:
+        chunk = sock.recv(n)
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        n -= len(chunk)
+    return b"".join(chunks)
+
+
+def _close_sockets(keep):
+    """Close every socket descriptor but keep's, as far as /dev/fd lists them
+
+    A worker forked by a running server inherits its listening socket and
+    client connections; holding them would keep closed connections open.
+    """
+    try:
+        fds = [int(name) for name in os.listdir("/dev/fd")]
+    except OSError:
+        return
+    for fd in fds:
+        if fd > 2 and fd != keep:
+            try:
+                if stat.S_ISSOCK(os.fstat(fd).st_mode):
+                    os.close(fd)
+            except OSError:
+                pass
+
+
+def _worker_main(bot, sock, index, size, inherited, reload_interval=None):
+    """Blocking request loop run in each forked worker
+
+    Each worker owns its copy of the brain, so with reload_interval it
+    checks the corpus for changes itself, before the next request it gets.
+    A turn that raises is answered with {"error": ...} instead of ending
+    the worker.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # Drop the parent's ends of other workers' sockets (and anything else
+    # the parent was serving) so they see EOF as soon as the parent goes away
+    for other in inherited:
+        other.close()
+    _close_sockets(sock.fileno())
+    next_reload = time.monotonic() + (reload_interval or 0)
+    while True:
+        header = _recv_exactly(sock, _LENGTH.size)
+        if header is None:
+            bot.close()
+            return
+        if reload_interval and time.monotonic() >= next_reload:
+            next_reload = time.monotonic() + reload_interval
+            try:
+                bot.brain.refresh()
+            except (AIMLError, OSError) as e:
+                print(f"Worker {index} reload failed: {e}", file=sys.stderr)
+        request = json.loads(_recv_exactly(sock, _LENGTH.unpack(header)[0]))
+        try:
+            if request.get("metrics"):
+                reply = {"metrics": snapshot(bot)}
+            else:
+                reply = run_turn(bot, request["input"], request.get("session"),
+                                 request.get("fresh"),
+                                 lambda wanted: affinity(wanted, size) == index)
+        except Exception as e:
+            print(f"Worker {index} turn failed:", file=sys.stderr)
+            traceback.print_exc()
+            reply = {"error": f"{type(e).__name__}: {e}"}
+        reply["id"] = request["id"]
+        data = json.dumps(reply).encode("utf-8")
+        sock.sendall(_LENGTH.pack(len(data)) + data)
+
+
+class _Worker:
+    """Parent-side handle: process, socket streams and in-flight requests"""
+
+    def __init__(self, index, process, sock):
+        self.index = index
+        self.process = process
+        self.sock = sock
+        self.reader = self.writer = self.task = None
+        self.pending = {}
+
+    @property
+    def alive(self):
+        return self.writer is not None and self.process.is_alive()
+
+
+class WorkerPool:
+    """Fork N interpreter workers after the brain is loaded
+
+    Forking after load shares the compiled brain copy-on-write; gc.freeze()
+    moves it out of the collector's reach so collections in the workers do
+    not touch (and so copy) those pages. A worker that dies fails its
+    in-flight turns with 500 and is replaced after respawn_delay seconds;
+    its sessions start over unless they are kept in storage.
+    """
+
+    def __init__(self, bot, size, reload_interval=None):
+        self.bot = bot
+        self.size = size
+        self.reload_interval = reload_interval
+        self.respawn_delay = RESPAWN_DELAY
+        self.workers = []
+        self.respawned = 0
+        self._ids = itertools.count()
+        self._stopping = False
+
+    def start(self):
+        """Fork the workers; call before the event loop starts"""
+        gc.collect()
+        gc.freeze()
+        for index in range(self.size):
+            self.workers.append(self._fork(index))
+
+    def _fork(self, index):
+        parent, child = socket.socketpair()
+        process = multiprocessing.get_context("fork").Process(
+            target=_worker_main,
+            args=(self.bot, child, index, self.size,
+                  [w.sock for w in self.workers if w.index != index] + [parent],
+                  self.reload_interval),
+            name=f"pandamania-worker-{index}", daemon=True)
+        process.start()
+        child.close()
+        return _Worker(index, process, parent)
+
+    async def connect(self):
+        """Attach the worker sockets to the running event loop"""
+        for worker in self.workers:
+            await self._attach(worker)
+
+    async def _attach(self, worker):
+        worker.reader, worker.writer = await asyncio.open_connection(
+            sock=worker.sock)
+        worker.task = asyncio.ensure_future(self._read_replies(worker))
+
+    async def _read_replies(self, worker):
+        try:
+            while True:
+                header = await worker.reader.readexactly(_LENGTH.size)
+                data = await worker.reader.readexactly(_LENGTH.unpack(header)[0])
+                reply = json.loads(data)
+                future = worker.pending.pop(reply.pop("id"), None)
+                if future is None or future.done():
+                    continue
+                if "error" in reply:
+                    future.set_exception(
+                        HTTPError(500, "internal server error"))
+                else:
+                    future.set_result(reply)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            worker.writer = None
+            for future in worker.pending.values():
+                if not future.done():
+                    future.set_exception(HTTPError(500, "worker exited"))
+            worker.pending.clear()
+        if not self._stopping:
+            await self._respawn(worker)
+
+    async def _respawn(self, worker):
+        """Replace a worker whose socket closed with a fresh fork"""
+        print(f"Worker {worker.index} (pid {worker.process.pid}) exited; "
+              "restarting it", file=sys.stderr)
+        worker.sock.close()
+        worker.process.join(timeout=0)
+        if worker.process.is_alive():
+            worker.process.terminate()
+        await asyncio.sleep(self.respawn_delay)
+        if self._stopping:
+            return
+        replacement = self._fork(worker.index)
+        self.workers[worker.index] = replacement
+        self.respawned += 1
+        await self._attach(replacement)
+
+    def route(self, session_id):
+        """Worker owning a session; falls through to the next live worker"""
+        start = affinity(session_id, self.size)
+        for offset in range(self.size):
+            worker = self.workers[(start + offset) % self.size]
+            if worker.alive:
+                return worker
+        raise HTTPError(503, "no live workers")
+
+    async def turn(self, text, session_id=None):
+        """Send a turn to the worker owning its session and await the reply"""
+        request = {"id": next(self._ids), "input": text}
+        if session_id:
+            request["session"] = session_id
+        else:
+            session_id = request["fresh"] = uuid.uuid4().hex
+        return await self._send(self.route(session_id), request)
+
+    async def metrics(self):
+        """(labels, telemetry snapshot) of every live worker"""
+        workers = [w for w in self.workers if w.alive]
+        replies = await asyncio.gather(
+            *(self._send(w, {"id": next(self._ids), "metrics": True})
+              for w in workers), return_exceptions=True)
+        return [({"worker": w.index}, reply["metrics"])
+                for w, reply in zip(workers, replies)
+                if not isinstance(reply, Exception)]
+
+    async def _send(self, worker, request):
+        future = asyncio.get_running_loop().create_future()
+        worker.pending[request["id"]] = future
+        data = json.dumps(request).encode("utf-8")
+        worker.writer.write(_LENGTH.pack(len(data)) + data)
+        await worker.writer.drain()
+        return await future
+
+    def stop(self):
+        """Stop every worker, letting it save its sessions first"""
+        self._stopping = True
+        for worker in self.workers:
+            if worker.task is not None:
+                worker.task.cancel()
+            if worker.writer is not None:
+                worker.writer.close()
+        for worker in self.workers:
+            # A worker exits by itself once its socket closes
+            worker.process.join(timeout=STOP_GRACE)
+            if worker.process.is_alive():
+                worker.process.terminate()
+            worker.process.join(timeout=5)
+
+    def status(self):
+        """Per-worker liveness for /health"""
+        return [{"worker": w.index, "pid": w.process.pid, "alive": w.alive,
+                 "pending": len(w.pending)} for w in self.workers]
+
+
+class PooledChatServer(ChatServer):
+    """ChatServer front end that routes turns to a WorkerPool"""
+
+    def __init__(self, pool, **options):
+        super().__init__(pool.bot, **options)
+        self.pool = pool
+
+    async def start(self):
+        await self.pool.connect()
+        return await super().start()
+
+    async def turn(self, text, session_id=None):
+        return await self.pool.turn(text, session_id)
+
+    async def metrics(self):
+        return metrics_text(await self.pool.metrics())
+
+    def health(self):
+        return {"status": "ok", "categories": self.bot.brain.size,
+                "connections": self.connections, "workers": self.pool.status(),
+                "pid": os.getpid()}
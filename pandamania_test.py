@@ -0,0 +1,933 @@
+#!/usr/bin/env python3
+"""
+PandaMania Interpreter Tests
+Exercises the built-in pandamania package against small corpora and the real one
+"""
+
+import asyncio
+import json
+import marshal
+import os
+import time
+
+import pytest
+
+from pandamania import (AIMLError, Bot, Brain, Graphmaster, Session,
+                        SnapshotError, parse_string, snapshot)
+from pandamania import bench, compiler
+from pandamania.analysis import MIN_HOP_BUDGET, UNBOUNDED, CallGraph, unreachable
+from pandamania.brain import DEFAULT_CORPUS
+from pandamania.generation import GENERATED_SOURCE, PatternGenerator
+from pandamania.inference import KnowledgeBase, Rule
+from pandamania.predicates import DictStore, PredicateSchema, SlotStore
+from pandamania.replay import replay
+from pandamania.server import ChatServer, _unmask
+from pandamania.storage import Storage, read_triples
+from pandamania.telemetry import read_coverage
+from pandamania.triples import TripleStore
+from pandamania.validate import DEFAULT_CACHE, scan, validate
+from pandamania.workers import PooledChatServer, WorkerPool, affinity
+
+WILDCARD_AIML = b"""<aiml version="2.0">
+<category><pattern>_ WORLD</pattern><template>underscore <star/></template></category>
+<category><pattern>HELLO WORLD</pattern><template>exact</template></category>
+<category><pattern># FOO ^</pattern><template>[<star/>][<star index="2"/>]</template></category>
+<category><pattern>$HI *</pattern><template>dollar <star/></template></category>
+<category><pattern>HI THERE</pattern><template>plain</template></category>
+<category><pattern>YES</pattern><that>DO YOU LIKE *</that>
+  <template>you like <thatstar/></template></category>
+<category><pattern>ASK</pattern><template>Do you like cheese?</template></category>
+<topic name="GAMES">
+  <category><pattern>*</pattern><template>game <star/></template></category>
+</topic>
+<category><pattern>PLAY</pattern><template><think><set name="topic">games</set></think>ok</template></category>
+<category><pattern>*</pattern><template>star <star/></template></category>
+</aiml>"""
+
+
+# <map name="boom"> raises once the test installs an ExplodingMap
+BOOM_AIML = b"""<aiml version="2.0">
+<category><pattern>HI</pattern><template>hello</template></category>
+<category><pattern>BOOM *</pattern><template><map name="boom"><star/></map></template></category>
+</aiml>"""
+
+
+class ExplodingMap:
+    def get(self, key, default=None):
+        raise LookupError(f"no {key}")
+
+
+def make_bot(source):
+    brain = Brain()
+    for category in parse_string(source):
+        brain.add_category(category)
+    return Bot(brain.compile())
+
+
+@pytest.fixture(scope="module")
+def corpus_brain():
+    return Brain.load()
+
+
+def test_wildcard_priority():
+    bot = make_bot(WILDCARD_AIML)
+    assert bot.respond("hello world") == "underscore HELLO"
+    assert bot.respond("hi there") == "dollar THERE"
+    assert bot.respond("foo") == "[][]"
+    assert bot.respond("x y foo z") == "[X Y][Z]"
+    assert bot.respond("anything else") == "star ANYTHING ELSE"
+
+
+def test_that_and_topic():
+    bot = make_bot(WILDCARD_AIML)
+    assert bot.respond("ask") == "Do you like cheese?"
+    assert bot.respond("yes") == "you like CHEESE"
+    assert bot.respond("yes") == "star YES"
+    assert bot.respond("play") == "ok"
+    assert bot.respond("chess") == "game CHESS"
+
+
+def test_sessions_are_isolated(corpus_brain):
+    bot = Bot(corpus_brain)
+    bot.respond("my name is Ada", "a")
+    assert bot.session("a").get("user_name") != "unknown"
+    assert bot.session("b").get("user_name") == "unknown"
+
+
+def test_corpus_loads(corpus_brain):
+    assert len(corpus_brain.files) >= 21
+    assert corpus_brain.size > 600
+    assert "meta-cognitive" in Bot(corpus_brain).respond("HELLO")
+
+
+def test_snapshot_roundtrip_and_invalidation(tmp_path):
+    (tmp_path / "a.aiml").write_bytes(WILDCARD_AIML)
+    (tmp_path / "bot.properties").write_text("name:Test\n")
+    path = str(tmp_path / "brain.snapshot")
+    compiled = snapshot.compile_brain(str(tmp_path), path)
+    loaded = snapshot.load(path, snapshot.corpus_digest(str(tmp_path)))
+    assert loaded.size == compiled.size
+    assert loaded.properties == {"name": "Test"}
+    assert Bot(loaded).respond("x y foo z") == "[X Y][Z]"
+
+    (tmp_path / "bot.properties").write_text("name:Changed\n")
+    with pytest.raises(SnapshotError):
+        snapshot.load(path, snapshot.corpus_digest(str(tmp_path)))
+    assert snapshot.load_brain(str(tmp_path), path).properties["name"] == "Changed"
+
+    # A well-formed header over a payload of the wrong shape is corrupt too
+    digest = snapshot.corpus_digest(str(tmp_path))
+    header = open(path, "rb").read()[:snapshot._HEADER.size]
+    for payload in ({"categories": []}, {"categories": [("X",)]}, [1]):
+        with open(path, "wb") as f:
+            f.write(header + marshal.dumps(payload))
+        with pytest.raises(SnapshotError, match="corrupt"):
+            snapshot.load(path, digest)
+    assert snapshot.load_brain(str(tmp_path), path).properties["name"] == "Changed"
+
+
+SRAI_AIML = b"""<aiml version="2.0">
+<category><pattern>GREET</pattern><template>hello</template></category>
+<category><pattern>HI</pattern><template><srai>GREET</srai></template></category>
+<category><pattern>DEFINE *</pattern><template>definition of <star/></template></category>
+<category><pattern>WHAT IS *</pattern><template><srai>DEFINE <star/></srai></template></category>
+<topic name="PIRATE">
+  <category><pattern>GREET</pattern><template>ahoy</template></category>
+</topic>
+<category><pattern>SAIL</pattern><template><think><set name="topic">pirate</set></think>ok</template></category>
+</aiml>"""
+
+
+def test_srai_compiled_to_direct_calls():
+    bot = make_bot(SRAI_AIML)
+    calls = {call.words: call for call in bot.brain.calls}
+    hi, what = calls[("GREET",)], calls[("DEFINE",)]
+    assert hi.target.category.template.children == ["hello"]
+    assert hi.guard == {("PIRATE",)}
+    assert what.target is None and what.start is not None
+    assert bot.respond("hi") == "hello"
+    assert bot.respond("what is a trie") == "definition of A TRIE"
+    bot.respond("sail")
+    assert bot.respond("hi") == "ahoy"
+
+
+def test_snapshot_load_restores_links_without_compiling(tmp_path, monkeypatch):
+    (tmp_path / "a.aiml").write_bytes(SRAI_AIML)
+    path = str(tmp_path / "brain.snapshot")
+    compiled = snapshot.compile_brain(str(tmp_path), path)
+
+    def refuse(*args):
+        raise AssertionError("snapshot load ran the compiler")
+    for name in ("compile_templates", "compile_template", "link",
+                 "fold_fillers", "find_conjunctions", "pure_categories"):
+        monkeypatch.setattr(f"pandamania.brain.{name}", refuse)
+    loaded = snapshot.load(path)
+    calls = {call.words: call for call in loaded.calls}
+    hi, what = calls[("GREET",)], calls[("DEFINE",)]
+    assert hi.target.category is loaded.graphmaster.get(
+        ["GREET", "<THAT>", "*", "<TOPIC>", "*"])
+    assert hi.guard == {("PIRATE",)} and what.start is not None
+    assert len(loaded.calls) == len(compiled.calls) == 2
+    assert {c.id for c in loaded.pure} == {c.id for c in compiled.pure}
+    bot = Bot(loaded)
+    assert bot.respond("what is a trie") == "definition of A TRIE"
+    assert bot.respond("hi") == "hello"
+    bot.respond("sail")
+    assert bot.respond("hi") == "ahoy"
+
+
+def test_builtin_arithmetic_maps(corpus_brain):
+    maps = corpus_brain.maps
+    assert maps["successor"].get("unknown") == "1"
+    assert maps["successor"].get(str(10 ** 30)) == str(10 ** 30 + 1)
+    assert maps["decrement"].get("0") == "0"
+    assert maps["subtract"].get("0.75:0.6") == "0.15"
+    assert maps["increment_grip"].get("0.70") == "0.75"
+    assert maps["increment_grip"].get("0.98") == "1.00"
+    assert maps["increment"].get("many") is None
+    for huge in ("1E999999", "1E-999999", "0E-999999", "0." + "1" * 100):
+        assert maps["increment"].get(huge) is None
+        assert maps["add"].get(f"1:{huge}") is None
+    assert maps["subtract"].get("1E3:0.5") == "999.5"
+
+    bot = Bot(corpus_brain)
+    bot.respond("KNOWLEDGE BASE INIT", "kb")
+    before = int(bot.session("kb").get("kb_facts_count"))
+    bot.respond("STORE FACT cat IS animal", "kb")
+    assert bot.session("kb").get("kb_facts_count") == str(before + 1)
+
+
+def test_slot_store_caps_dynamic_predicates():
+    store = SlotStore(PredicateSchema(["topic", "user_name"]), limit=3)
+    store.set("user_name", "Ada")
+    for i in range(10):
+        store.set(f"kb_item{i}_is", str(i))
+    assert store.get("user_name") == "Ada"
+    assert len(store) == 4 and store.evictions == 7
+    assert store.get("kb_item0_is") is None
+    assert store.get("kb_item9_is") == "9"
+    store.set("kb_item7_is", "seven")
+    store.set("kb_new_is", "new")
+    assert store.get("kb_item7_is") == "seven"
+    assert store.get("kb_item8_is") is None
+
+
+def test_sessions_use_declared_schema(corpus_brain):
+    assert "topic" in corpus_brain.schema.index
+    bot = Bot(corpus_brain, predicate_limit=8)
+    for i in range(20):
+        bot.respond(f"STORE FACT thing{i} IS item", "kb")
+    assert len(bot.session("kb").predicates.overflow) <= 8
+
+
+async def _http_exchange(port, requests):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    for payload in requests:
+        body = json.dumps(payload).encode()
+        writer.write(b"POST /chat HTTP/1.1\r\nContent-Length: %d\r\n\r\n"
+                     % len(body) + body)
+    await writer.drain()
+    replies = []
+    for _ in requests:
+        head = await reader.readuntil(b"\r\n\r\n")
+        length = int(head.lower().split(b"content-length: ")[1].split(b"\r\n")[0])
+        replies.append(json.loads(await reader.readexactly(length)))
+    writer.close()
+    return replies
+
+
+async def _websocket_exchange(port, text):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(b"GET /ws HTTP/1.1\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+                 b"Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\n\r\n")
+    assert b" 101 " in await reader.readuntil(b"\r\n\r\n")
+    mask, data = os.urandom(4), text.encode()
+    writer.write(bytes([0x81, 0x80 | len(data)]) + mask + _unmask(data, mask))
+    _, length = await reader.readexactly(2)
+    if length == 126:
+        length = int.from_bytes(await reader.readexactly(2), "big")
+    reply = json.loads(await reader.readexactly(length))
+    writer.write(bytes([0x88, 0x80]) + mask)
+    await reader.read()
+    writer.close()
+    return reply
+
+
+def test_server_pipelining_and_websocket(corpus_brain):
+    async def scenario():
+        server = ChatServer(Bot(corpus_brain), port=0)
+        await server.start()
+        replies = await _http_exchange(server.port, [
+            {"input": "SESSION INIT"},
+            {"input": "my name is Ada", "session": "s1"},
+            {"input": "what is my name", "session": "s1"},
+        ])
+        ws_reply = await _websocket_exchange(server.port, "hello")
+        server.server.close()
+        return server, replies, ws_reply
+
+    server, replies, ws_reply = asyncio.run(scenario())
+    assert replies[0]["session"] == server.bot.session(
+        replies[0]["session"]).get("session_id")
+    assert all(r["session"] == "s1" for r in replies[1:])
+    assert "ADA" in replies[2]["response"]
+    assert "meta-cognitive" in ws_reply["response"]
+
+
+def test_server_answers_500_and_keeps_reloading_after_failures(capsys):
+    bot = make_bot(BOOM_AIML)
+    bot.brain.maps["boom"] = ExplodingMap()
+    polls = []
+
+    def refresh():
+        polls.append(None)
+        if len(polls) == 1:
+            raise FileNotFoundError("renamed mid-poll")
+        return []
+    bot.brain.refresh = refresh
+
+    async def scenario():
+        server = ChatServer(bot, port=0, reload_interval=0.01)
+        await server.start()
+        replies = await _http_exchange(server.port, [
+            {"input": "boom x"}, {"input": "hi", "session": "s1"}])
+        ws_replies = [await _websocket_exchange(server.port, text)
+                      for text in ("boom y", '{"input": "boom z"}')]
+        await asyncio.sleep(0.05)
+        reloading = not server._reloader.done()
+        server._reloader.cancel()
+        server.server.close()
+        return replies, ws_replies, reloading
+
+    replies, ws_replies, reloading = asyncio.run(scenario())
+    assert replies == [{"error": "internal server error"},
+                       {"session": "s1", "response": "hello"}]
+    assert ws_replies == [{"error": "internal server error"}] * 2
+    assert reloading and len(polls) > 1
+    errors = capsys.readouterr().err
+    assert "Reload failed: renamed mid-poll" in errors
+    assert "LookupError: no X" in errors
+
+
+def test_worker_pool_keeps_session_affinity(corpus_brain):
+    pool = WorkerPool(Bot(corpus_brain), 2)
+    pool.start()
+
+    async def scenario():
+        server = PooledChatServer(pool, port=0)
+        await server.start()
+        replies = await _http_exchange(server.port, [
+            {"input": f"my name is user{i}", "session": f"s{i}"} for i in range(6)
+        ] + [{"input": "what is my name", "session": f"s{i}"} for i in range(6)])
+        metrics = await server.metrics()
+        server.server.close()
+        return replies, metrics
+
+    try:
+        replies, metrics = asyncio.run(scenario())
+    finally:
+        pool.stop()
+    assert {affinity(f"s{i}", 2) for i in range(6)} == {0, 1}
+    for i, reply in enumerate(replies[6:]):
+        assert f"USER{i}" in reply["response"]
+    turns = [line for line in metrics.splitlines()
+             if line.startswith("pandamania_turns_total{")]
+    assert sum(int(line.split()[1]) for line in turns) == 12
+    assert {line.split('"')[1] for line in turns} == {"0", "1"}
+
+
+class FatalMap:
+    def get(self, key, default=None):
+        if key == "DIE":
+            os._exit(1)
+        raise LookupError(f"no {key}")
+
+
+def test_worker_pool_answers_500_and_replaces_dead_workers(capsys):
+    bot = make_bot(BOOM_AIML)
+    bot.brain.maps["boom"] = FatalMap()
+    pool = WorkerPool(bot, 1)
+    pool.respawn_delay = 0
+    pool.start()
+    first = pool.workers[0].process.pid
+
+    async def scenario():
+        server = PooledChatServer(pool, port=0)
+        await server.start()
+        replies = await _http_exchange(server.port, [
+            {"input": "boom x", "session": "s1"}, {"input": "hi", "session": "s1"},
+            {"input": "boom die", "session": "s1"}])
+        while not pool.respawned:
+            await asyncio.sleep(0.01)
+        replies += await _http_exchange(server.port, [
+            {"input": "hi", "session": "s1"}])
+        server.server.close()
+        return replies
+
+    try:
+        replies = asyncio.run(scenario())
+    finally:
+        pool.stop()
+    assert replies == [{"error": "internal server error"},
+                       {"session": "s1", "response": "hello"},
+                       {"error": "worker exited"},
+                       {"session": "s1", "response": "hello"}]
+    assert pool.workers[0].process.pid != first
+    assert f"Worker 0 (pid {first}) exited; restarting it" in (
+        capsys.readouterr().err)
+
+
+def test_replay_carries_predicates_per_session(corpus_brain):
+    lines = []
+    for turn in range(2):
+        for i in range(4):
+            text = f"my name is user{i}" if turn == 0 else "what is my name"
+            lines.append(json.dumps({"session": f"s{i}", "input": text}))
+    lines.append("not json")
+    serial = list(replay(Bot(corpus_brain), lines))
+    parallel = sorted(replay(Bot(corpus_brain), lines, workers=2, batch_size=1),
+                      key=lambda record: record["line"])
+    assert parallel == serial
+    for record in serial[4:8]:
+        assert record["session"].replace("s", "USER") in record["response"]
+        assert record["category"] == record["chain"][0]
+        assert record["category"].endswith(tuple("0123456789"))
+    assert "error" in serial[-1]
+
+
+def test_replay_survives_skewed_shards_and_raises_worker_errors():
+    bot = make_bot(BOOM_AIML)
+    short, long = "s0", next(f"s{i}" for i in range(1, 10)
+                             if affinity(f"s{i}", 2) != affinity("s0", 2))
+    lines = [json.dumps({"session": short, "input": "hi"})]
+    lines += [json.dumps({"session": long, "input": "hi"})] * 20001
+    records = list(replay(bot, lines, workers=2))
+    assert len(records) == 20002
+    assert {record["response"] for record in records} == {"hello"}
+
+    bot.brain.maps["boom"] = ExplodingMap()
+    lines.append(json.dumps({"session": short, "input": "boom x"}))
+    with pytest.raises(LookupError, match="no X"):
+        list(replay(bot, lines, workers=2))
+
+
+def test_hot_reload_swaps_one_file(tmp_path, monkeypatch):
+    (tmp_path / "a.aiml").write_text(
+        '<aiml><category><pattern>HELLO</pattern><template>a</template></category>'
+        '<category><pattern>HI</pattern><template><srai>HELLO</srai></template>'
+        '</category><category><pattern>YO</pattern>'
+        '<template><srai>OTHER <star/></srai></template></category></aiml>')
+    (tmp_path / "b.aiml").write_text(
+        '<aiml><category><pattern>HELLO</pattern><template>b</template></category>'
+        '</aiml>')
+    brain = Brain.load(str(tmp_path))
+    bot = Bot(brain)
+    old_root = brain.graphmaster.root
+    assert bot.respond("hi") == "b"
+    relinked = []
+    monkeypatch.setattr("pandamania.brain.link", lambda *args: relinked.append(
+        compiler.link(*args)))
+
+    (tmp_path / "b.aiml").write_text(
+        '<aiml><category><pattern>BYE</pattern><template>bye</template></category>'
+        '</aiml>')
+    os.utime(tmp_path / "b.aiml", ns=(0, 0))
+    assert brain.refresh() == ["b.aiml"]
+    # Only the call into HELLO is relinked, not the one into OTHER
+    assert relinked == [1] and len(brain.calls) == 2
+    # The shadowed HELLO from a.aiml is back, and compiled <srai> follows it
+    assert bot.respond("hi") == "a"
+    assert bot.respond("bye") == "bye"
+    assert brain.graphmaster.root is not old_root
+    # Copy-on-write: a match still holding the old root sees the old trie
+    old = Graphmaster()
+    old.root = old_root
+    assert old.match(["HELLO"], ["X"], ["X"]).category.filename == "b.aiml"
+    assert old.match(["BYE"], ["X"], ["X"]) is None
+
+    (tmp_path / "b.aiml").unlink()
+    assert brain.refresh() == ["b.aiml"]
+    assert brain.files == ["a.aiml"] and brain.size == 3
+
+
+def test_priority_breaks_ties_and_shadowing_is_reported():
+    brain = Brain()
+    first = parse_string(b'<aiml><category><pattern>HELLO</pattern>'
+                         b'<template priority="5">first</template></category>'
+                         b'<category><pattern>BYE</pattern><template>first bye'
+                         b'</template></category></aiml>', "a.aiml")
+    second = parse_string(b'<aiml><category><pattern>HELLO</pattern>'
+                          b'<template>second</template></category>'
+                          b'<category><pattern>BYE</pattern><template>second bye'
+                          b'</template></category></aiml>', "b.aiml")
+    for category in first + second:
+        brain.add_category(category)
+    bot = Bot(brain.compile())
+    assert bot.respond("hello") == "first"
+    assert bot.respond("bye") == "second bye"
+    assert [(c.id, w.id) for c, w in brain.shadowed()] == [
+        ("a.aiml:1", "b.aiml:1"), ("b.aiml:1", "a.aiml:1")]
+    with pytest.raises(AIMLError, match="priority"):
+        parse_string(b'<aiml><category><pattern>X</pattern>'
+                     b'<template priority="high">x</template></category></aiml>')
+
+
+def test_identity_fillers_are_stripped_before_matching():
+    source = b"""<aiml>
+<category><pattern>UM *</pattern><template><srai><star/></srai></template></category>
+<category><pattern>WELL *</pattern><template><srai><star/></srai></template></category>
+<category><pattern>SO *</pattern><template><srai><star/></srai></template></category>
+<category><pattern>SO WHAT</pattern><template>whatever</template></category>
+<category><pattern>HELLO</pattern><template>hi</template></category>
+<category><pattern>*</pattern><template>star <star/></template></category>
+<category><pattern>PAD *</pattern><template><srai>um um um um <star/></srai></template></category>
+</aiml>"""
+    bot = make_bot(source)
+    # SO has its own exact continuation, so it cannot be stripped blindly
+    assert sorted(bot.brain.fillers) == ["UM", "WELL"]
+    trace = []
+    assert bot.respond("um well um hello", trace=trace) == "hi"
+    assert [c.id for c in trace] == ["<string>:2", "<string>:3", "<string>:2",
+                                     "<string>:6"]
+    assert bot.respond("um so what") == "whatever"
+    assert bot.respond("um") == "star UM"
+    assert bot.respond("um " * 40 + "hello") == ""
+    # Stripped fillers spend the hop budget like the hops they replace
+    bot.hop_budget = 1
+    assert bot.respond("pad hello") == "" and bot.budget_exhausted == 1
+
+
+def test_conjunctions_split_once_in_clause_order():
+    source = b"""<aiml>
+<category><pattern>* AND *</pattern>
+  <template>[<srai><star/></srai>|<srai><star index="2"/></srai>]</template></category>
+<category><pattern>SET A</pattern>
+  <template><think><set name="x">A</set></think>set</template></category>
+<category><pattern>SET B</pattern>
+  <template><think><set name="x">B</set></think>set</template></category>
+<category><pattern>GET</pattern><template><get name="x"/></template></category>
+<category><pattern>*</pattern><template><star/></template></category>
+</aiml>"""
+    recursive, split = make_bot(source), make_bot(source)
+    split.max_clauses = 4
+    text = "set a and get and set b and get"
+    assert recursive.respond(text) == "[set|[A|[set|B]]]"
+    trace = []
+    # Each GET reads the predicate the SET clause before it wrote
+    assert split.respond(text, trace=trace) == "[set|[A|[set|B]]]"
+    assert [c.pattern for c in trace].count(["*", "AND", "*"]) == 3
+    assert split.session().get("x") == "B"
+    split.max_clauses = 3
+    trace = []
+    assert split.respond(f"{text} and set a", trace=trace) == \
+        "[set|[A|[set|[B|set]]]]"
+    assert [c.pattern for c in trace].count(["*", "AND", "*"]) == 4
+    assert split.session().get("x") == "A"
+    assert split.respond("a and b and c") == recursive.respond("a and b and c")
+    assert split.respond("a and and b and") == "[A|AND B AND]"
+    assert recursive.respond("a and and b and") == "[A|AND B AND]"
+
+
+def test_pure_responses_are_cached_with_their_writes():
+    source = b"""<aiml>
+<category><pattern>FAQ</pattern>
+  <template><think><set name="seen">faq</set></think><srai>ANSWER</srai></template></category>
+<category><pattern>ANSWER</pattern><template>forty two</template></category>
+<category><pattern>WHO</pattern><template><get name="seen"/></template></category>
+</aiml>"""
+    bot = make_bot(source)
+    assert {c.pattern[0] for c in bot.brain.pure} == {"FAQ", "ANSWER"}
+    assert bot.respond("faq", "a") == "forty two"
+    trace = []
+    assert bot.respond("faq", "b", trace) == "forty two"
+    assert bot.cache_hits == 1 and [c.pattern[0] for c in trace] == ["FAQ", "ANSWER"]
+    assert bot.respond("who", "b") == "faq"
+    bot.respond("who", "b")
+    assert bot.cache_hits == 1 and len(bot.cache) == 1
+
+    generation = bot.brain.generation
+    bot.brain.relink()
+    assert bot.brain.generation != generation
+    bot.respond("faq", "c")
+    assert bot.cache_hits == 1
+
+
+def test_telemetry_counts_hits_and_feeds_live_properties():
+    source = b"""<aiml>
+<category><pattern>HI</pattern><template><srai>HELLO</srai></template></category>
+<category><pattern>HELLO</pattern><template><think><set name="x">1</set></think>hey</template></category>
+<category><pattern>STATS</pattern>
+  <template><bot name="live_sentences"/> <bot name="live_srai_histogram"/> <bot name="live_predicates"/></template></category>
+<category><pattern>TIMING</pattern><template>took <bot name="live_match_avg"/> each</template></category>
+<category><pattern>WHY</pattern><that>TOOK * EACH</that><template>measured</template></category>
+</aiml>"""
+    bot = make_bot(source)
+    assert not any(c.pattern == ["STATS"] for c in bot.brain.pure)
+    bot.respond("hi. hello", "a")
+    bot.respond("hi", "b")
+    telemetry = bot.telemetry
+    assert telemetry.turns == 2 and telemetry.sentences == 3
+    assert telemetry.depths == [1, 2]
+    assert sorted(telemetry.hits.values()) == [2, 3]
+    assert telemetry.files() == {"<string>": 5}
+    assert bot.respond("stats", "a") == "3 0:1 1:2 2"
+    assert bot.respond("stats", "a") == "4 0:2 1:2 2"
+    assert Bot(bot.brain, telemetry=False).respond("stats") == "unknown unknown unknown"
+    bot.respond("timing", "a")
+    assert bot.respond("why", "a") == "measured"
+    for name in ("uptime", "turns_per_sec", "match_avg", "render_avg",
+                 "srai_avg", "predicates_avg", "cache_hit_rate"):
+        assert "." not in telemetry.property(bot, f"live_{name}")
+
+
+def test_metrics_endpoint_and_sampled_trace_log(corpus_brain, tmp_path):
+    bot = Bot(corpus_brain, cache_size=0)
+    path = tmp_path / "trace.jsonl"
+    bot.telemetry.open_trace(str(path), 1.0)
+    bot.respond("hi there. hello", "t")
+    bot.telemetry.trace_rate = 0.0
+    bot.respond("hello", "t")
+    records = [json.loads(line) for line in path.read_text().splitlines()]
+    assert [r["input"] for r in records] == ["hi there", "hello"]
+    assert records[0]["pattern"] == "HI *" and records[0]["file"].endswith(".aiml")
+    assert len(records[0]["chain"]) > 1
+    for step in records[0]["chain"]:
+        assert step["us"] >= 0 and step["start_us"] >= 0
+
+    async def scenario():
+        server = ChatServer(bot, port=0)
+        await server.start()
+        reader, writer = await asyncio.open_connection("127.0.0.1", server.port)
+        writer.write(b"GET /metrics HTTP/1.1\r\nConnection: close\r\n\r\n")
+        response = await reader.read()
+        writer.close()
+        server.server.close()
+        return response.decode()
+
+    response = asyncio.run(scenario())
+    assert "Content-Type: text/plain; version=0.0.4" in response
+    assert "\npandamania_turns_total 2\n" in response
+    assert '\npandamania_sentence_seconds_bucket{le="+Inf"} 3\n' in response
+    assert "\npandamania_sessions_active 1\n" in response
+    assert 'pandamania_category_hits_total{category="' in response
+
+
+def test_triple_store_indexes_and_knowledge_base_tags(corpus_brain):
+    kb = TripleStore()
+    assert kb.add("Cat", "isa", "mammal") and not kb.add("CAT", "ISA", "Mammal!")
+    kb.add("dog", "isa", "mammal")
+    kb.add("dog", "has", "fur")
+    assert len(kb) == 3 and ("cat", "isa", "mammal") in kb
+    assert kb.values(None, "isa", "mammal", slot=0) == ["Cat", "dog"]
+    assert list(kb.match(None, None, "fur")) == [("DOG", "HAS", "FUR")]
+    assert list(kb.match("dog")) == [("DOG", "ISA", "MAMMAL"), ("DOG", "HAS", "FUR")]
+    assert kb.count(predicate="isa") == 2 and kb.count("dog") == 2
+    assert kb.remove("cat", "isa", "mammal") and not kb.remove("cat", "isa", "mammal")
+    assert "CAT" not in kb.spo and kb.pos["ISA"]["MAMMAL"] == {"DOG": None}
+
+    bot = Bot(corpus_brain)
+    bot.respond("store relationship cat isa mammal. store relationship dog isa mammal", "kb")
+    bot.respond("store fact dog has fur", "kb")
+    assert "CAT, DOG" in bot.respond("what is a mammal", "kb")
+    assert "DOG" in bot.respond("what has fur", "kb")
+    assert "Nothing" in bot.respond("what has fur", "other")
+    assert bot.session("kb").get("kb_relationships_count") == "2"
+    assert bot.session("kb").predicates.get("kb_DOG_has") is None
+
+
+def test_knowledge_base_forward_chains_incrementally():
+    kb = KnowledgeBase()
+    kb.tell("cat", "isa", "feline")
+    kb.tell("mammal", "has", "fur")
+    kb.tell("feline", "isa", "mammal")
+    kb.tell("mammal", "isa", "animal")
+    assert kb.values("cat", "isa") == ["feline", "mammal", "animal"]
+    assert kb.values("cat", "has", inferred=True) == ["fur"]
+    assert kb.count(inferred=True) == 5 and kb.count(inferred=False) == 4
+
+    assert kb.add_rule(Rule(("partof", "partof"), "partof"))
+    kb.tell("paw", "partof", "leg")
+    kb.tell("leg", "partof", "cat")
+    assert ("paw", "partof", "cat") in kb
+
+    assert not kb.retract("cat", "isa", "mammal")
+    assert kb.retract("feline", "isa", "mammal")
+    assert kb.values("cat", "isa") == ["feline"] and kb.count(inferred=True) == 1
+    assert kb.tell("paw", "partof", "cat") and kb.count(inferred=True) == 0
+
+    capped = KnowledgeBase(limit=50)
+    for i in range(100):
+        capped.tell(f"a{i}", "isa", f"a{i + 1}")
+    assert len(capped.derived) == 50 and capped.saturated
+    # A cap equal to the closure size is reached, not exceeded
+    exact = KnowledgeBase(limit=6)
+    exact.load([(f"b{i}", "isa", f"b{i + 1}") for i in range(4)])
+    assert len(exact.derived) == 6 and not exact.saturated
+    assert exact.tell("b0", "isa", "b2") and not exact.saturated
+    with pytest.raises(ValueError):
+        Rule(("a", "b", "c"), "d")
+
+
+def test_knowledge_base_persists_over_imported_domain_knowledge(
+        corpus_brain, tmp_path):
+    source = tmp_path / "domain.csv"
+    source.write_text("subject,predicate,object\ndog,isa,mammal\n"
+                      "Mammal,has,fur\n")
+    (tmp_path / "more.jsonl").write_text(
+        '{"subject": "dog", "predicate": "isa", "object": "mammal"}\n'
+        '["dog", "can", "bark"]\n')
+    (tmp_path / "bad.csv").write_text("dog,isa\n")
+    storage = Storage(str(tmp_path / "kb.db"))
+    assert storage.import_rows(read_triples(str(source))) == (2, 2)
+    assert storage.import_rows(read_triples(str(tmp_path / "more.jsonl"))) == (2, 1)
+    with pytest.raises(ValueError):
+        storage.import_rows(read_triples(str(tmp_path / "bad.csv")))
+
+    bot = Bot(corpus_brain, storage=storage)
+    bot.respond("store relationship Fido isa dog", "u1")
+    bot.respond("declare transitive partof", "u1")
+    bot.respond("store relationship Fido isa mammal", "u1")
+    kb = bot.session("u1").kb
+    assert kb.values("fido", "has") == ["fur"]
+    assert kb.count(inferred=False) == 5 and len(kb) == 3
+    assert not kb.retract("dog", "isa", "mammal")
+    bot.rename_session("u1", "u2")
+
+    fresh = Bot(corpus_brain, storage=Storage(str(tmp_path / "kb.db")))
+    kb = fresh.session("u2").kb
+    assert kb.values("fido", "isa") == ["DOG", "MAMMAL"]
+    assert kb.values("fido", "has", inferred=True) == ["fur"]
+    assert len(kb.rules) == 3 and len(fresh.session("u1").kb) == 0
+    fresh.respond("forget relationship Fido isa dog", "u2")
+    assert Storage(str(tmp_path / "kb.db")).facts("u2") == [
+        ("FIDO", "isa", "MAMMAL")]
+    assert kb.values("fido", "has") == ["fur"]
+
+
+def test_idle_sessions_are_evicted_and_rehydrated(corpus_brain, tmp_path):
+    path = str(tmp_path / "kb.db")
+    bot = Bot(corpus_brain, storage=Storage(path), max_sessions=2)
+    bot.respond("my name is Ada", "a")
+    bot.respond("store fact Ada can count", "a")
+    bot.respond("hello", "b")
+    bot.respond("hello", "c")
+    assert list(bot.sessions) == ["b", "c"] and bot.session_evictions == 1
+    assert bot.has_session("a") and not bot.has_session("z")
+    assert "ADA" in bot.respond("what is my name", "a")
+    assert bot.session("a").kb.values("ada", "can") == ["COUNT"]
+    assert bot.session("a").input(2) == "store fact Ada can count"
+    assert list(bot.sessions) == ["c", "a"]
+    bot.close()
+
+    later = Bot(corpus_brain, storage=Storage(path), session_ttl=0)
+    later.respond("hello", "b")
+    assert later.session("c").get("user_name") == "unknown"
+    assert list(later.sessions) == ["c"] and later.session_evictions == 1
+    assert later.session("a").get("user_name") == "ADA"
+
+    forgetful = Bot(corpus_brain, max_sessions=1)
+    forgetful.respond("my name is Ada", "a")
+    forgetful.respond("hello", "b")
+    assert forgetful.session("a").get("user_name") == "unknown"
+
+
+def test_history_is_a_bounded_ring_of_split_responses():
+    bot = make_bot(WILDCARD_AIML)
+    bot.history_size = 3
+    bot.respond("ask")
+    assert bot.respond("yes") == "you like CHEESE"
+    for text in ("one. two", "three"):
+        bot.respond(text)
+    session = bot.session()
+    assert len(session.inputs) == len(session.responses) == 3
+    assert [session.input(i) for i in (1, 3, 4)] == ["three", "one", "unknown"]
+    assert session.that() == "star THREE" and session.that(4) == "unknown"
+    assert session.that_words() == ["STAR", "THREE"]
+
+    restored = Session("copy", DictStore(), history=2)
+    restored.remember("First one. Second one!")
+    restored.restore(json.loads(json.dumps(session.snapshot())))
+    assert restored.that(1) == "star THREE" and restored.that(2) == "star TWO"
+    assert list(restored.inputs) == ["two", "three"]
+
+
+def test_call_graph_finds_cycles_and_budgets_cut_runaway_turns():
+    bot = make_bot(b"""<aiml version="2.0">
+<category><pattern>HI</pattern><template>hello</template></category>
+<category><pattern>GREET</pattern><template><srai>HI</srai> there</template></category>
+<category><pattern>LOOP</pattern><template>a<srai>LOOP</srai></template></category>
+<category><pattern>BOMB *</pattern>
+  <template><srai>BOMB <star/></srai><srai>BOMB <star/></srai></template></category>
+<category><pattern>ECHO *</pattern><template><srai><star/></srai></template></category>
+</aiml>""")
+    graph = CallGraph(bot.brain)
+    by_pattern = {" ".join(c.pattern): c for c in graph.categories}
+    assert sorted(" ".join(c[0].pattern) for c in graph.cycles) == ["BOMB *", "LOOP"]
+    greet = by_pattern["GREET"]
+    assert (graph.depth[greet], graph.hops[greet]) == (1, 1)
+    assert graph.hops[by_pattern["LOOP"]] == UNBOUNDED
+    assert list(graph.open) == [by_pattern["ECHO *"]]
+    assert bot.current_hop_budget() == MIN_HOP_BUDGET and bot.turn_budget is None
+
+    assert bot.respond("echo greet") == "hello there"
+    assert bot.budget_exhausted == 0
+    start = time.perf_counter()
+    assert bot.respond("bomb x") == ""
+    assert bot.budget_exhausted == 1
+    bot.hop_budget, bot.turn_budget = 10 ** 9, 0.05
+    bot.respond("bomb y")
+    assert bot.budget_exhausted == 2 and time.perf_counter() - start < 2
+    assert bot.respond("echo greet") == "hello there" and bot.budget_exhausted == 2
+
+
+def test_coverage_log_and_unreachable_categories(tmp_path):
+    bot = make_bot(b"""<aiml version="2.0">
+<category><pattern>_ WORLD</pattern><template>any world</template></category>
+<category><pattern>HELLO WORLD</pattern><template>never</template></category>
+<category><pattern>HELLO *</pattern><template>hello <star/></template></category>
+<category><pattern>GO</pattern><topic>T</topic><template>never</template></category>
+<category><pattern>GO</pattern><topic>#</topic><template>go</template></category>
+<category><pattern>HI</pattern><template>first</template></category>
+<category><pattern>HI</pattern><template>second</template></category>
+</aiml>""")
+    found = [(c.line, best.line, reason) for c, best, reason in unreachable(bot.brain)]
+    assert found == [(3, 2, "outranked"), (5, 6, "outranked"), (7, 8, "shadowed")]
+    path = str(tmp_path / "coverage.jsonl")
+    bot.telemetry.open_coverage(path)
+    assert bot.respond("hello world") == "any world"
+    assert bot.respond("hello there") == "hello THERE"
+    bot.close()
+    bot.respond("hello world")
+    bot.close()
+    bot.close()
+    with open(path) as f:
+        assert len(f.readlines()) == 2
+    assert read_coverage([path]) == {"<string>:2": 2, "<string>:4": 1}
+    # Periodic writes keep the log current without a close
+    bot.telemetry.open_coverage(path, interval=0)
+    bot.respond("hi")
+    assert read_coverage([path]) == {"<string>:2": 2, "<string>:4": 1,
+                                     "<string>:8": 1}
+
+
+def test_validator_parses_each_file_once_and_reports_dangling_uses(tmp_path):
+    (tmp_path / "a.aiml").write_text("""<aiml version="2.0">
+<category><pattern>HI</pattern><template><set name="mood">ok</set></template></category>
+<category><pattern>GREET *</pattern><template><srai>HI</srai><srai>HELLO <star/></srai></template></category>
+<category><pattern>MOOD</pattern><template><get name="mood"/><get name="age"/></template></category>
+<category><pattern>COUNT</pattern><template><map><name>successor</name>1</map><map name="nope">1</map></template></category>
+<category><pattern>*</pattern><template><srai><star/></srai></template></category>
+</aiml>""")
+    (tmp_path / "b.aiml").write_text("<aiml><category><pattern>X</pattern>")
+    report = validate(str(tmp_path), workers=2)
+    assert report.parsed == 2 and report.categories == 5
+    assert len(report.errors) == 1 and report.errors[0].startswith("b.aiml")
+    assert report.dead_srai == [("a.aiml:3", "HELLO X")]
+    assert report.unset_gets == [("a.aiml:4", "age")]
+    assert report.undefined_maps == [("a.aiml:5", "nope")]
+    assert (tmp_path / DEFAULT_CACHE).exists()
+
+    assert validate(str(tmp_path)).parsed == 0
+    os.utime(tmp_path / "a.aiml", ns=(0, 0))
+    assert validate(str(tmp_path)).parsed == 0
+    (tmp_path / "b.aiml").write_text(
+        "<aiml><category><pattern>HELLO *</pattern><template>hi</template>"
+        "</category></aiml>")
+    report = validate(str(tmp_path))
+    assert report.parsed == 1 and not report.errors
+    assert report.dead_srai == [] and report.categories == 6
+
+
+def test_validator_cache_survives_failing_runs(tmp_path, monkeypatch):
+    (tmp_path / "a.aiml").write_text("<aiml><category><pattern>X</pattern>")
+    (tmp_path / "b.aiml").write_text(
+        "<aiml><category><pattern>B</pattern><template>b</template>"
+        "</category></aiml>")
+    (tmp_path / "c.aiml").write_text(
+        "<aiml><category><pattern>C</pattern><template>c</template>"
+        "</category></aiml>")
+    def crash(name, data):
+        if name == "c.aiml":
+            raise RuntimeError("scanner bug")
+        return scan(name, data)
+    monkeypatch.setattr("pandamania.validate.scan", crash)
+    with pytest.raises(RuntimeError):
+        validate(str(tmp_path), workers=1)
+    monkeypatch.undo()
+    # The failing a.aiml and the valid b.aiml were kept; only c.aiml is redone
+    report = validate(str(tmp_path), workers=1)
+    assert report.parsed == 1 and len(report.errors) == 1
+    assert validate(str(tmp_path)).parsed == 0
+
+
+def test_pattern_generation_queues_for_operator_approval(tmp_path):
+    bot = make_bot(b"""<aiml version="2.0">
+<category><pattern>WHAT IS LOVE</pattern><template>baby dont hurt me</template></category>
+<category><pattern>_ TO FLY</pattern><template>flap</template></category>
+<category><pattern>MAKE *</pattern><template><generatepattern><star/></generatepattern></template></category>
+<category><pattern>OK *</pattern><template><approvepattern><star/></approvepattern></template></category>
+<category><pattern>PENDING</pattern><template><pendingpatterns/> <patterncount/></template></category>
+</aiml>""")
+    assert bot.respond("make love") == "unknown"
+    bot.patterns = PatternGenerator(str(tmp_path))
+    assert bot.respond("make love") == "WHAT IS LOVE is already answered by <string>:2"
+    assert bot.respond("make quantum computing") == "PG1"
+    added, rejected = bot.patterns.generate_many(bot.brain, [
+        ("comparison", ["cats", "dogs"]), ("definition", ["Quantum-Computing"]),
+        ("comparison", ["cats"]), ("process", ["fly"]), ("riddle", ["x"]),
+        ("reflection", ["R&D"])])
+    assert [c["id"] for c in added] == ["PG2", "PG3"]
+    assert [reason for _, reason in rejected] == [
+        "WHAT IS QUANTUM COMPUTING is already pending as PG1",
+        "the comparison template takes 2 terms",
+        "HOW TO FLY would always lose to <string>:3", "no riddle template"]
+    assert bot.respond("pending") == (
+        "PG1: WHAT IS QUANTUM COMPUTING; PG2: COMPARE CATS AND DOGS; "
+        "PG3: WHAT DO YOU THINK ABOUT R D 3")
+
+    assert bot.respond("what is quantum computing") == ""
+    # Chat cannot approve: the tag is not an interpreter extension
+    assert bot.respond("ok pg1") == "PG1"
+    assert bot.patterns.counts()["pending"] == 3
+    approved, refused = bot.patterns.approve(bot.brain, ["pg1"])
+    assert [c["id"] for c in approved] == ["PG1"] and refused == []
+    assert bot.patterns.approve(bot.brain, ["pg1"])[1] == [
+        ("pg1", "no pending pattern pg1")]
+    assert bot.respond("what is quantum computing") == "QUANTUM COMPUTING is [definition pending human input]."
+    assert bot.patterns.reject(["PG2"]) == ["PG2"]
+    approved, refused = bot.patterns.approve(bot.brain)
+    assert [c["id"] for c in approved] == ["PG3"] and refused == []
+    assert bot.respond("what do you think about R&D") == "Reflecting on R&D: [reflection pending human input]."
+    assert bot.patterns.counts() == {"generated": 3, "pending": 0,
+                                     "approved": 2, "rejected": 1}
+    reloaded = Brain.load(str(tmp_path))
+    assert [" ".join(c.pattern) for c in reloaded.sources[GENERATED_SOURCE]] == [
+        "WHAT IS QUANTUM COMPUTING", "WHAT DO YOU THINK ABOUT R D"]
+
+
+def test_bench_report_feeds_benchmark_category(tmp_path):
+    report = bench.run(DEFAULT_CORPUS, samples=20, loads=1)
+    assert set(report["results"]) == {
+        "cold_load", "snapshot_load", "trie_build", "direct_match", "srai_1hop",
+        "srai_2hop", "srai_3hop", "predicate_heavy", "condition"}
+    for result in report["results"].values():
+        assert 0 < result["p50_us"] <= result["p99_us"]
+    path = tmp_path / "bench.json"
+    bench.save(report, path)
+    assert json.loads(path.read_text()) == report
+
+    brain = Brain.load()
+    brain.properties.update(bench.properties(path))
+    reply = Bot(brain).respond("benchmark")
+    assert report["created"] in reply
+    assert bench.properties(tmp_path / "missing.json") == {}
+
+
+def test_bench_skips_cases_without_inputs(tmp_path):
+    (tmp_path / "a.aiml").write_text(
+        '<aiml><category><pattern>*</pattern><template>x</template></category>'
+        '</aiml>')
+    report = bench.run(str(tmp_path), samples=5, loads=1)
+    assert set(report["results"]) == {"cold_load", "snapshot_load", "trie_build"}
+    with pytest.raises(ValueError, match="no benchmark inputs"):
+        bench._measure(len, [], 5)
@@ -4,68 +4,87 @@ PandaMania Phase 2 Test Script
 Tests Phase 1 completion and Phase 2 foundation
 """
 
-import xml.etree.ElementTree as ET
 import os
 import sys
 
-def test_xml_validity():
-    """Test that all AIML files are valid XML"""
-    print("=" * 60)
-    print("XML VALIDATION TEST")
-    print("=" * 60)
-    print()
-    
-    aiml_files = [
+from pandamania.validate import validate
+
+CORPUS = os.path.dirname(os.path.abspath(__file__))
+
+# Report grouping only; files are discovered, and any not listed here are
+# counted under "Other"
+PHASES = {
+    "Core Architecture": [
         "config.aiml",
         "bot.aiml",
         "advanced_metacog.aiml",
         "topics.aiml",
-        "layer4_metacog.aiml",
+        "layer4_metacog.aiml"
+    ],
+    "Domain Knowledge (Phase 1)": [
         "math_logic.aiml",
         "programming_tech.aiml",
         "psychology_cognition.aiml",
-        "ethics_philosophy.aiml",
+        "ethics_philosophy.aiml"
+    ],
+    "Performance & NL (Phase 1)": [
         "natural_language.aiml",
-        "performance_optimized.aiml",
-        "emotional_intelligence.aiml",
+        "performance_optimized.aiml"
+    ],
+    "Emotional Intelligence (Phase 2)": [
+        "emotional_intelligence.aiml"
+    ],
+    "Autognosis System (Phase 2)": [
         "autognosis.aiml",
-        "autognosis_commands.aiml",
+        "autognosis_commands.aiml"
+    ],
+    "Holistic Metamodel (Phase 2)": [
         "holistic_metamodel.aiml",
         "organizational_dynamics.aiml",
-        "holistic_commands.aiml",
+        "holistic_commands.aiml"
+    ],
+    "Learning & Adaptation (Phase 2)": [
         "session_learning.aiml",
         "knowledge_base.aiml"
+    ],
+    "Pattern Generation (Phase 3)": [
+        "pattern_generation.aiml",
+        "pattern_gen_commands.aiml"
     ]
+}
+
+_report = None
+
+def corpus_report():
+    """Validate the corpus once per run; every file is parsed a single time"""
+    global _report
+    if _report is None:
+        _report = validate(CORPUS)
+    return _report
+
+def test_xml_validity():
+    """Test that all AIML files are valid XML"""
+    print("=" * 60)
+    print("XML VALIDATION TEST")
+    print("=" * 60)
+    print()
     
-    passed = 0
-    failed = 0
+    report = corpus_report()
+    counts = report.counts()
     
-    for filename in aiml_files:
-        try:
-            tree = ET.parse(filename)
-            root = tree.getroot()
-            
-            # Count categories
-            categories = len(root.findall(".//category"))
-            
-            print(f"✓ {filename:<30} Valid ({categories:>3} patterns)")
-            passed += 1
-        except FileNotFoundError:
-            print(f"✗ {filename:<30} Not found")
-            failed += 1
-        except ET.ParseError as e:
-            print(f"✗ {filename:<30} XML Error: {e}")
-            failed += 1
-        except Exception as e:
-            print(f"✗ {filename:<30} Error: {e}")
-            failed += 1
+    for error in report.errors:
+        print(f"✗ {error}")
+    for filename, categories in counts.items():
+        print(f"✓ {filename:<30} Valid ({categories:>3} patterns)")
+    for location, detail in report.warnings:
+        print(f"! {location:<30} {detail}")
     
     print()
-    print(f"Passed: {passed}/{len(aiml_files)}")
-    print(f"Failed: {failed}/{len(aiml_files)}")
+    print(f"Passed: {len(counts)}/{len(report.scans)}")
+    print(f"Failed: {len(report.errors)}/{len(report.scans)}")
     print()
     
-    return failed == 0
+    return not report.errors and bool(report.scans)
 
 def count_total_patterns():
     """Count total patterns across all files"""
@@ -74,56 +93,25 @@ def count_total_patterns():
     print("=" * 60)
     print()
     
-    aiml_files = {
-        "Core Architecture": [
-            "config.aiml",
-            "bot.aiml",
-            "advanced_metacog.aiml",
-            "topics.aiml",
-            "layer4_metacog.aiml"
-        ],
-        "Domain Knowledge (Phase 1)": [
-            "math_logic.aiml",
-            "programming_tech.aiml",
-            "psychology_cognition.aiml",
-            "ethics_philosophy.aiml"
-        ],
-        "Performance & NL (Phase 1)": [
-            "natural_language.aiml",
-            "performance_optimized.aiml"
-        ],
-        "Emotional Intelligence (Phase 2)": [
-            "emotional_intelligence.aiml"
-        ],
-        "Autognosis System (Phase 2)": [
-            "autognosis.aiml",
-            "autognosis_commands.aiml"
-        ],
-        "Holistic Metamodel (Phase 2)": [
-            "holistic_metamodel.aiml",
-            "organizational_dynamics.aiml",
-            "holistic_commands.aiml"
-        ],
-        "Learning & Adaptation (Phase 2)": [
-            "session_learning.aiml",
-            "knowledge_base.aiml"
-        ]
-    }
+    counts = corpus_report().counts()
+    listed = {filename for files in PHASES.values() for filename in files}
+    groups = dict(PHASES)
+    groups["Other"] = [filename for filename in counts if filename not in listed]
     
     grand_total = 0
     
-    for category, files in aiml_files.items():
+    for category, files in groups.items():
+        if not files:
+            continue
         print(f"{category}:")
         category_total = 0
         
         for filename in files:
-            try:
-                tree = ET.parse(filename)
-                root = tree.getroot()
-                count = len(root.findall(".//category"))
+            if filename in counts:
+                count = counts[filename]
                 print(f"  {filename:<30} {count:>3} patterns")
                 category_total += count
-            except:
+            else:
                 print(f"  {filename:<30} Error reading")
         
         print(f"  {'Subtotal:':<30} {category_total:>3} patterns")
@@ -163,7 +163,8 @@ def main():
     print("-" * 50)
     print()
     
-    print("System ready. Load AIML files into your interpreter to begin.")
+    print("System ready. Run `python -m pandamania chat` to start the built-in")
+    print("interpreter, or load the AIML files into your own interpreter.")
     print()
 
 if __name__ == "__main__":